@@ -0,0 +1,197 @@
+# Needed libraries
+import asyncio
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from Store import Product, Customer, SalesManager
+
+'''
+Purpose: Async versions of the Product, Customer and SalesManager methods for asyncio services such as the web
+         checkout, so SQLite work runs off the event loop. Reads share a small pool of threads, writes go through
+         one writer thread so they never wait on each other for the database lock, and the number of operations
+         in flight is capped so a burst of checkouts waits its turn instead of piling up unbounded work
+
+Contract: AsyncStore(): Creates the executors and the async managers for one database
+          products / customers / sales: The AsyncProduct, AsyncCustomer and AsyncSalesManager of the store
+          close(): Waits for the running operations and shuts the executors down
+          AsyncProduct, AsyncCustomer, AsyncSalesManager: Async counterparts of the CRUD and aggregate methods, each
+                                                          one awaitable and cancellable until it starts running
+'''
+
+
+class AsyncStore:
+    # Initializes the store with the database path, the number of reader threads and the most operations that may be
+    # waiting or running at once, high_throughput is passed on to the SalesManager
+    def __init__(self, db_path, max_workers=4, max_pending=256, high_throughput=False):
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")  # Raises an error if nothing could ever run
+        self.db_path = db_path  # Initializes database path
+        self.max_pending = max_pending  # Most operations in flight before callers have to wait
+        self.__readers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='store-read')
+        self.__writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store-write')
+        self.__pending = asyncio.Semaphore(max_pending)  # Backpressure on callers once max_pending are in flight
+        self.products = AsyncProduct(self, Product(db_path))
+        self.customers = AsyncCustomer(self, Customer(db_path))
+        self.sales = AsyncSalesManager(self, SalesManager(db_path, high_throughput=high_throughput))
+
+    # Runs a read method on the reader threads
+    async def _read(self, method, *args, **kwargs):
+        return await self.__run(self.__readers, method, args, kwargs)
+
+    # Runs a write method on the writer thread
+    async def _write(self, method, *args, **kwargs):
+        return await self.__run(self.__writer, method, args, kwargs)
+
+    # Runs a write method handing back a Future, like add_sale in high-throughput mode, on the writer thread and waits
+    # for the Future. Its place under max_pending is only given back once the Future resolves, so sales queued for a
+    # group commit count as in flight, or once the method is cancelled before it starts
+    async def _write_queued(self, method, *args, **kwargs):
+        await self.__pending.acquire()
+        loop = asyncio.get_running_loop()
+        release = functools.partial(loop.call_soon_threadsafe, self.__pending.release)
+
+        # Runs the method and hands the place on to the Future it returned, or gives it back straight away
+        def call():
+            try:
+                result = method(*args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            if isinstance(result, Future):
+                result.add_done_callback(lambda _: release())
+            else:
+                release()
+            return result
+
+        task = self.__writer.submit(call)
+        task.add_done_callback(lambda done: release() if done.cancelled() else None)  # Never started
+        result = await asyncio.wrap_future(task)
+        if isinstance(result, Future):
+            return await asyncio.wrap_future(result)  # Waits for the group commit without holding a thread
+        return result
+
+    # Waits for room under max_pending and runs the method on an executor, cancelling the caller before the method
+    # has started also cancels the method, once it is running it finishes but its result is dropped
+    async def __run(self, executor, method, args, kwargs):
+        async with self.__pending:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+
+    # Waits for the running operations, commits any queued sales and shuts the executors down
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.__shutdown)
+
+    # Shuts the executors down and stops the sales writer, run off the event loop since it blocks
+    def __shutdown(self):
+        self.__writer.shutdown(wait=True)
+        self.__readers.shutdown(wait=True)
+        self.sales.manager.close()
+
+    # Lets the store be used with async with, closing it at the end of the block
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncProduct:
+    # Initializes the async product manager with the store running its methods and the Product doing the work
+    def __init__(self, store, manager):
+        self.store = store
+        self.manager = manager
+
+    # Adds a product on the writer thread and returns its product_id
+    async def add_product(self, name, price):
+        return await self.store._write(self.manager.add_product, name, price)
+
+    # Adds many products in one transaction on the writer thread and returns their IDs
+    async def add_products(self, products, **options):
+        return await self.store._write(self.manager.add_products, list(products), **options)
+
+    # Gets a ProductRecord on a reader thread
+    async def get_product(self, product_id):
+        return await self.store._read(self.manager.get_product, product_id)
+
+    # Gets many ProductRecords in one query per chunk on a reader thread
+    async def get_products(self, product_ids, **options):
+        return await self.store._read(self.manager.get_products, list(product_ids), **options)
+
+    # Updates a product from a ProductRecord on the writer thread, checked against the version it was read at if given
+    async def update_product(self, product, version=None):
+        return await self.store._write(self.manager.update_product, product, version)
+
+    # Deletes a product on the writer thread
+    async def delete_product(self, product_id):
+        return await self.store._write(self.manager.delete_product, product_id)
+
+    # Sets a new price for a product on the writer thread, checked against the version it was read at if given
+    async def update_price(self, new_price, product_id, version=None):
+        return await self.store._write(self.manager.update_price, new_price, product_id, version)
+
+    # Loads every product into a dataframe on a reader thread
+    async def load_products(self):
+        return await self.store._read(self.manager.load_products)
+
+
+class AsyncCustomer:
+    # Initializes the async customer manager with the store running its methods and the Customer doing the work
+    def __init__(self, store, manager):
+        self.store = store
+        self.manager = manager
+
+    # Adds a customer on the writer thread and returns their customer_id
+    async def add_customer(self, name, contact):
+        return await self.store._write(self.manager.add_customer, name, contact)
+
+    # Adds many customers in one transaction on the writer thread and returns their IDs
+    async def add_customers(self, customers, **options):
+        return await self.store._write(self.manager.add_customers, list(customers), **options)
+
+    # Gets a CustomerRecord on a reader thread
+    async def get_customer(self, customer_id):
+        return await self.store._read(self.manager.get_customer, customer_id)
+
+    # Gets many CustomerRecords in one query per chunk on a reader thread
+    async def get_customers(self, customer_ids, **options):
+        return await self.store._read(self.manager.get_customers, list(customer_ids), **options)
+
+    # Updates a customer from a CustomerRecord on the writer thread, checked against the version they were read at
+    async def update_customer(self, customer, version=None):
+        return await self.store._write(self.manager.update_customer, customer, version)
+
+    # Deletes a customer on the writer thread
+    async def delete_customer(self, customer_id):
+        return await self.store._write(self.manager.delete_customer, customer_id)
+
+    # Loads every customer into a dataframe on a reader thread
+    async def load_customers(self):
+        return await self.store._read(self.manager.load_customers)
+
+
+class AsyncSalesManager:
+    # Initializes the async sales manager with the store running its methods and the SalesManager doing the work
+    def __init__(self, store, manager):
+        self.store = store
+        self.manager = manager
+
+    # Records a sale, in high-throughput mode it returns the sale_id once the sale has been committed
+    async def add_sale(self, sale):
+        return await self.store._write_queued(self.manager.add_sale, sale)
+
+    # Records many sales in one transaction on the writer thread and returns their IDs
+    async def add_sales(self, sales, **options):
+        return await self.store._write(self.manager.add_sales, list(sales), **options)
+
+    # Loads every sale into a dataframe on a reader thread
+    async def load_sales(self):
+        return await self.store._read(self.manager.load_sales)
+
+    # Returns the total quantity sold, with the same filters as SalesManager, on a reader thread
+    async def calculate_total_sales(self, **filters):
+        return await self.store._read(self.manager.calculate_total_sales, **filters)
+
+    # Returns the quantity sold per product, with the same filters as SalesManager, on a reader thread
+    async def sales_per_product(self, **filters):
+        return await self.store._read(self.manager.sales_per_product, **filters)
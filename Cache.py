@@ -0,0 +1,141 @@
+# Needed libraries
+import os
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Purpose: Keeps recently looked up rows in memory so the products and customers fetched over and over at the till
+         don't go back to the database every time, with a size limit, an optional time limit and hit/miss counters
+
+Contract: LRUCache(): Creates a cache holding at most maxsize entries, each for at most ttl seconds
+          get_or_load(): Returns the cached value for a key or loads, caches and returns it
+          get_or_load_many(): Returns the cached values for many keys, loading every missing one in a single call
+          get(): Returns the cached value for a key or a default, counting the hit or miss
+          put(): Caches a value for a key, dropping the least recently used entry when the cache is full
+          invalidate(): Drops a key so the next lookup reads it from the database again
+          clear(): Drops every entry
+          stats(): Returns the hit, miss, eviction and expiry counters with the current size
+          get_cache(): Returns the cache shared by every manager of one database for one kind of row
+'''
+
+_MISSING = object()  # Marks a lookup that found nothing, since None is a value loaders may return
+
+
+class LRUCache:
+    # Initializes the cache with the most entries it holds and how many seconds an entry stays fresh,
+    # maxsize=0 turns caching off and ttl=None keeps entries until they are invalidated or evicted
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        if maxsize < 0:
+            raise ValueError("Cache size can't be negative")  # Raises an error for a size that can't be held
+        self.maxsize = maxsize  # Most entries held at once
+        self.ttl = ttl  # Seconds an entry stays fresh
+        self.__clock = clock  # Source of the current time in seconds
+        self.__entries = OrderedDict()  # key -> (value, expiry time), least recently used first
+        self.__lock = threading.Lock()
+        self.__generation = 0  # Goes up on every invalidation so loads that raced one aren't cached
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # Returns the cached value for a key or a default, counting the hit or miss
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > self.__clock():
+                    self.__entries.move_to_end(key)  # Marks it as the most recently used
+                    self.hits += 1
+                    return value
+                del self.__entries[key]  # Drops the stale entry
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    # Returns the cached value for a key, or calls load(key), caches the result unless it is None and returns it
+    def get_or_load(self, key, load):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        generation = self.__generation  # Remembered so an invalidation during the load isn't undone by it
+        value = load(key)
+        if value is not None:
+            self.put(key, value, generation)
+        return value
+
+    # Returns {key: value} for many keys, calling load_many(missing_keys) once for every key not cached, which returns
+    # {key: value} for the keys it found, those are cached and keys found nowhere are left out of the result
+    def get_or_load_many(self, keys, load_many):
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):  # Looks each key up once even if it was asked for twice
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            generation = self.__generation  # Remembered so an invalidation during the load isn't undone by it
+            for key, value in load_many(missing).items():
+                self.put(key, value, generation)
+                found[key] = value
+        return found
+
+    # Caches a value for a key, dropping the least recently used entries when the cache is full
+    # When generation is given the value is only cached if nothing was invalidated since it was read
+    def put(self, key, value, generation=None):
+        if self.maxsize == 0:
+            return
+        with self.__lock:
+            if generation is not None and generation != self.__generation:
+                return  # The value may have been read before a write that invalidated it
+            expires = None if self.ttl is None else self.__clock() + self.ttl
+            self.__entries[key] = (value, expires)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)  # Drops the least recently used entry
+                self.evictions += 1
+
+    # Drops a key so the next lookup reads it from the database again
+    def invalidate(self, key):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.pop(key, None)
+
+    # Drops every entry
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+
+    # Returns the hit, miss, eviction and expiry counters along with the current size and the hit rate
+    def stats(self):
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self.__entries),
+                'maxsize': self.maxsize,
+            }
+
+
+_caches = {}  # Shared caches keyed by (database path, kind of row)
+_caches_lock = threading.Lock()
+
+
+# Returns the cache shared by every manager of a database for one kind of row, so a write through any manager
+# invalidates what the others see, options only apply when the cache is first created
+def get_cache(db_path, name, **options):
+    key = (db_path if db_path == ':memory:' else os.path.abspath(db_path), name)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = LRUCache(**options)
+            _caches[key] = cache
+        return cache
@@ -0,0 +1,82 @@
+# Needed libraries
+import io
+
+from Cache import get_cache
+
+'''
+Purpose: Draws the store charts either in a window through pyplot or headless into PNG/SVG bytes for the report
+         servers, keeping rendered charts in a cache keyed on the version of the data they were drawn from so
+         repeated dashboard hits skip both the query and the render
+
+Contract: CHART_FORMATS: The formats charts can be rendered to
+          data_versions(): Returns the current version of each table, which goes up on every write to it
+          show_chart(): Draws a chart in a pyplot window and closes its figure once the window is dismissed
+          render_chart(): Draws a chart on a figure that never touches pyplot and returns the encoded bytes
+          cached_chart(): Returns a chart's bytes from the cache while its tables haven't changed, or renders it
+          plot(): Shows a chart in a window, or returns it as cached bytes when a format is given
+'''
+
+CHART_FORMATS = ('png', 'svg')
+DEFAULT_CHART_CACHE_SIZE = 64  # Rendered charts kept per database, older versions of a chart age out of it
+
+
+# Returns (table, version) for the given tables, a version goes up with every row inserted, updated or deleted
+def data_versions(conn, tables):
+    placeholders = ', '.join('?' * len(tables))
+    rows = dict(conn.execute(f'SELECT name, version FROM data_versions WHERE name IN ({placeholders})', tables))
+    return tuple((table, rows.get(table, 0)) for table in tables)
+
+
+# Draws a chart in a pyplot window, draw(ax) adds the data and labels to the axes, the figure is closed
+# afterwards so windows opened one after another don't pile up in pyplot
+def show_chart(draw, figsize):
+    import matplotlib.pyplot as plt  # Only loaded when a chart is shown on screen
+
+    figure = plt.figure(figsize=figsize)  # Sets the figure size
+    try:
+        draw(figure.gca())
+        plt.show()  # Displays the chart
+    finally:
+        plt.close(figure)
+
+
+# Draws a chart on a standalone figure and returns it as PNG or SVG bytes, the figure is never registered with
+# pyplot so no GUI backend is needed and nothing is left behind once the bytes are returned
+def render_chart(draw, figsize, fmt='png'):
+    if fmt not in CHART_FORMATS:
+        raise ValueError(f"Chart format must be one of {', '.join(CHART_FORMATS)}")  # Raises an error for other formats
+    from matplotlib.figure import Figure  # Only loaded when a chart is rendered
+
+    figure = Figure(figsize=figsize)  # Sets the figure size
+    draw(figure.subplots())
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format=fmt, bbox_inches='tight')
+    figure.clear()  # Drops the artists straight away instead of waiting for the garbage collector
+    return buffer.getvalue()
+
+
+# Returns the rendered chart from the cache of its database while none of its tables have changed, otherwise calls
+# load(conn) for its data and draw(ax, data) to render and cache it, connect() borrows a connection
+def cached_chart(db_path, connect, name, tables, load, draw, figsize, fmt):
+    if fmt not in CHART_FORMATS:
+        raise ValueError(f"Chart format must be one of {', '.join(CHART_FORMATS)}")  # Raises an error for other formats
+    cache = get_cache(db_path, 'charts', maxsize=DEFAULT_CHART_CACHE_SIZE)
+    with connect() as conn:
+        key = (name, fmt, data_versions(conn, tables))  # A write to any of the tables makes a new key
+        chart = cache.get(key)
+        if chart is not None:
+            return chart
+        data = load(conn)  # Read after the versions, so a write in between can only make the chart newer than its key
+    chart = render_chart(lambda ax: draw(ax, data), figsize, fmt)
+    cache.put(key, chart)
+    return chart
+
+
+# Shows a chart in a window when fmt is None, otherwise returns it as cached PNG or SVG bytes, load(conn) reads the
+# chart's data from the given tables and draw(ax, data) draws it
+def plot(db_path, connect, name, tables, load, draw, figsize, fmt=None):
+    if fmt is not None:
+        return cached_chart(db_path, connect, name, tables, load, draw, figsize, fmt)
+    with connect() as conn:
+        data = load(conn)
+    show_chart(lambda ax: draw(ax, data), figsize)
@@ -0,0 +1,342 @@
+# Needed libraries
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+import weakref
+from collections import namedtuple
+from contextlib import contextmanager
+
+'''
+Purpose: Keeps a small set of open SQLite connections per database so the Product, Customer and SalesManager classes
+         don't pay the cost of opening and closing a new connection for every single operation
+
+Contract: ConnectionPool(): Creates a pool of connections to one database with a maximum size and a checkout mode,
+                            read_only=True opens them read-only for report workers that must never write
+          connection(): Lends out a connection, commits on success, rolls back on errors and takes it back afterwards
+          write(): Lends out a connection inside a write transaction, retrying while another writer holds the lock
+          configure(): Changes the PRAGMAs set on connections, reopening idle ones so they pick up the new settings
+          instrument(): Times every statement, commit and connection checkout through an Instrumentation, or stops
+          apply_pragmas(): Sets a dictionary of PRAGMAs on a single connection
+          RetryPolicy: How many times a locked write is tried and the bounds of the random wait between tries
+          WriteStats: Counts the writes retried or given up on because the database was locked, and the updates
+                      refused because the row changed since it was read
+          is_locked(): Checks whether an error means another connection holds a lock the statement needed
+          retry_locked(): Calls a function again after a random, growing wait each time it finds the database locked
+          close(): Closes every idle connection and stops the pool from handing out new ones
+          get_pool(): Returns the shared pool for a database path, creating it the first time it is asked for
+          close_all(): Closes and forgets every shared pool
+'''
+
+# Errors after which a connection is still usable, any other sqlite3 error throws the connection away, apart from
+# the database being locked which only means another connection got there first
+RECOVERABLE_ERRORS = (sqlite3.IntegrityError,)
+
+RetryPolicy = namedtuple('RetryPolicy', ['attempts', 'base_delay', 'max_delay'])
+
+DEFAULT_BUSY_TIMEOUT = 2.0  # Seconds SQLite keeps trying for a lock before reporting the database as locked
+# Tries of a write before giving up, the wait before the nth retry is random up to base_delay * 2 ** n seconds so
+# writers that collided don't all come back at the same moment, and never more than max_delay seconds
+DEFAULT_RETRY = RetryPolicy(attempts=6, base_delay=0.01, max_delay=0.5)
+_LOCKED_CODES = (5, 6)  # SQLITE_BUSY and SQLITE_LOCKED, the primary codes behind every 'database is locked' error
+
+# PRAGMAs for the opt-in high-throughput mode: write-ahead logging so readers don't block the writer, a 64MB page
+# cache and 256MB of memory-mapped I/O. synchronous=NORMAL only syncs the log at checkpoints, so a committed sale
+# survives the application crashing but not the machine losing power, use 'FULL' where that matters
+HIGH_THROUGHPUT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 268435456,
+}
+
+
+# Sets a dictionary of PRAGMAs on a connection
+def apply_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+# Checks whether an error means the database or a table was locked by another connection, including a write
+# transaction that couldn't start because its snapshot went stale in WAL mode
+def is_locked(error):
+    code = getattr(error, 'sqlite_errorcode', None)
+    return isinstance(error, sqlite3.OperationalError) and code is not None and code & 0xff in _LOCKED_CODES
+
+
+class WriteStats:
+    # Initializes the counters of one database's writes
+    def __init__(self):
+        self.retries = 0  # Tries repeated after finding the database locked
+        self.lock_failures = 0  # Writes given up on after every try found the database locked
+        self.conflicts = 0  # Updates refused because the row's version moved since it was read
+        self.__lock = threading.Lock()
+
+    # Adds to one of the counters
+    def add(self, counter, amount=1):
+        with self.__lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    # Returns the retry, lock failure and conflict counters
+    def stats(self):
+        with self.__lock:
+            return {'retries': self.retries, 'lock_failures': self.lock_failures, 'conflicts': self.conflicts}
+
+
+# Calls function and returns what it returned, calling it again after a random wait that grows with each try for as
+# long as it finds the database locked and the policy allows, counting the retries and failures in stats
+def retry_locked(function, retry=DEFAULT_RETRY, stats=None):
+    for attempt in range(retry.attempts):
+        try:
+            return function()
+        except sqlite3.OperationalError as error:
+            if not is_locked(error):
+                raise
+            if attempt + 1 >= retry.attempts:
+                if stats is not None:
+                    stats.add('lock_failures')
+                raise
+            if stats is not None:
+                stats.add('retries')
+            time.sleep(random.uniform(0, min(retry.max_delay, retry.base_delay * 2 ** attempt)))
+
+
+class ConnectionPool:
+    # Initializes the pool with the database path, the maximum number of connections and how they are handed out
+    # mode='checkout' lends a connection out for the length of a with block and takes it back afterwards
+    # mode='thread' pins one connection to each thread until the thread finishes
+    # read_only=True opens every connection read-only, any write on them fails while their TEMP objects still work
+    # busy_timeout is how many seconds a statement waits for another connection's lock, write() then retries the
+    # lock and the commit as the retry policy says
+    def __init__(self, db_path, size=5, mode='checkout', timeout=None, pragmas=None, instrumentation=None,
+                 read_only=False, busy_timeout=DEFAULT_BUSY_TIMEOUT, retry=DEFAULT_RETRY):
+        if mode not in ('checkout', 'thread'):
+            raise ValueError("Pool mode must be 'checkout' or 'thread'")  # Raises an error for unknown modes
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")  # Raises an error if the pool can't hold a connection
+        self.db_path = db_path  # Initializes database path
+        self.size = size  # Maximum number of open connections
+        self.mode = mode  # How connections are handed out
+        self.timeout = timeout  # Seconds to wait for a free connection, None waits forever
+        self.pragmas = dict(pragmas or {})  # PRAGMAs set on every new connection
+        self.instrumentation = instrumentation  # Opens timed connections when set, see Instrumentation.py
+        self.read_only = read_only  # Opens connections with mode=ro so they can't change the database
+        self.busy_timeout = busy_timeout  # Seconds a statement waits for a lock held by another connection
+        self.retry = retry  # How write() retries a lock or commit that found the database locked
+        self.write_stats = WriteStats()  # Retries, lock failures and conflicts of the writes through the pool
+        self.__idle = queue.LifoQueue()  # Connections waiting to be reused, most recently used first
+        self.__slots = threading.BoundedSemaphore(size)  # Limits the number of open connections
+        self.__local = threading.local()  # Holds the pinned connection of each thread in 'thread' mode
+        self.__pinned = weakref.WeakSet()  # Every pinned connection so close() can reach other threads' ones
+        self.__closed = False
+
+    # Opens a brand-new connection to the database
+    def _open(self):
+        # The connection may be closed from another thread so it can't be tied to the one that opened it
+        connect = sqlite3.connect if self.instrumentation is None else self.instrumentation.connect
+        if self.read_only:
+            uri = f'file:{urllib.parse.quote(os.path.abspath(self.db_path))}?mode=ro'
+            conn = connect(uri, uri=True, timeout=self.busy_timeout, check_same_thread=False)
+        else:
+            conn = connect(self.db_path, timeout=self.busy_timeout, check_same_thread=False)
+        apply_pragmas(conn, self.pragmas)
+        return conn
+
+    # Adds to the PRAGMAs set on new connections and closes the idle ones so they are reopened with them
+    def configure(self, pragmas):
+        self.pragmas.update(pragmas)
+        self.__close_idle()
+
+    # Times everything done on the pool's connections through an Instrumentation, or stops timing when given None,
+    # idle connections are reopened straight away, connections in use once they are handed back and connections
+    # pinned to threads once they are replaced
+    def instrument(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.__close_idle()
+
+    # Closes the idle connections so the next callers open new ones
+    def __close_idle(self):
+        while True:
+            try:
+                conn = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            self.__slots.release()
+
+    # Lends out a connection for the length of a with block
+    @contextmanager
+    def connection(self):
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            conn = self.__acquire()  # Gets a connection from the pool
+        else:
+            start = time.perf_counter()
+            conn = self.__acquire()
+            instrumentation.record('acquire', None, time.perf_counter() - start)
+        failure = None
+        try:
+            yield conn  # Hands the connection to the with block
+            conn.commit()  # Commits whatever the block left uncommitted
+        except BaseException as error:
+            failure = error  # Remembers the error so the connection can be checked before reuse
+            raise
+        finally:
+            self.__release(conn, failure)  # Gives the connection back to the pool
+
+    # Lends out a connection in a write transaction started with BEGIN IMMEDIATE, which takes the write lock up front
+    # so the transaction can't fail half way through because another writer got the lock after it had read. Taking
+    # the lock and committing are retried while the database is locked, the with block itself only ever runs once
+    @contextmanager
+    def write(self):
+        with self.connection() as conn:
+            if conn.in_transaction:
+                conn.commit()  # Ends whatever an earlier caller left open so the lock is taken now
+            retry_locked(lambda: conn.execute('BEGIN IMMEDIATE'), self.retry, self.write_stats)
+            yield conn
+            retry_locked(conn.commit, self.retry, self.write_stats)  # Still open if another reader held it up
+
+    # Closes every idle connection and stops the pool from handing out new ones
+    def close(self):
+        self.__closed = True
+        while True:
+            try:
+                conn = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            self.__slots.release()
+        for pinned in list(self.__pinned):
+            pinned.discard()  # Closes the connections pinned to threads in 'thread' mode
+
+    # Gets a connection either pinned to this thread or from the idle connections
+    def __acquire(self):
+        if self.__closed:
+            raise sqlite3.ProgrammingError("Cannot use a closed connection pool")
+
+        if self.mode == 'thread':
+            pinned = getattr(self.__local, 'pinned', None)
+            if pinned is not None and _is_open(pinned.conn):
+                return pinned.conn  # Reuses the connection already pinned to this thread
+            if pinned is not None:
+                pinned.discard()  # Frees the slot of the broken connection before opening a new one
+            conn = self.__open_in_slot()
+            self.__local.pinned = _PinnedConnection(conn, self.__slots)  # Pins it until the thread finishes
+            self.__pinned.add(self.__local.pinned)
+            return conn
+
+        # Reuses an idle connection if there is one that is still open
+        while True:
+            try:
+                conn = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            if _is_open(conn):
+                return conn
+            self.__slots.release()  # Drops the broken connection and frees its slot
+        return self.__open_in_slot()
+
+    # Waits for a free slot and opens a connection in it
+    def __open_in_slot(self):
+        if not self.__slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free connection to {self.db_path} after {self.timeout} seconds")
+        try:
+            return self._open()
+        except BaseException:
+            self.__slots.release()  # Gives the slot back if the database couldn't be opened
+            raise
+
+    # Takes a connection back, throwing it away if the error it raised may have left it broken
+    def __release(self, conn, failure):
+        broken = False
+        if failure is not None:
+            try:
+                conn.rollback()  # Undoes whatever the failed block left behind
+            except sqlite3.Error:
+                broken = True
+            recoverable = isinstance(failure, RECOVERABLE_ERRORS) or is_locked(failure)
+            if isinstance(failure, sqlite3.Error) and not recoverable:
+                broken = True
+
+        if self.mode == 'thread':
+            if broken:
+                self.__local.pinned.discard()  # The next call on this thread opens a fresh connection
+                self.__local.pinned = None
+            return
+
+        # Connections opened before instrument() changed the instrumentation are replaced rather than reused
+        stale = getattr(conn, 'instrumentation', None) is not self.instrumentation
+        if broken or stale or self.__closed or not _is_open(conn):
+            _close_quietly(conn)
+            self.__slots.release()
+        else:
+            self.__idle.put(conn)  # Makes the connection available to the next caller
+
+
+# Connection pinned to a single thread that closes itself and frees its slot when the thread finishes
+class _PinnedConnection:
+    def __init__(self, conn, slots):
+        self.conn = conn
+        # Runs once, either when discard() is called or when the thread's local storage is cleaned up
+        self.__finalizer = weakref.finalize(self, _close_pinned, conn, slots)
+
+    # Closes the connection and frees its slot straight away
+    def discard(self):
+        self.__finalizer()
+
+
+# Closes a pinned connection and frees its slot
+def _close_pinned(conn, slots):
+    _close_quietly(conn)
+    slots.release()
+
+
+# Checks whether a connection is still open
+def _is_open(conn):
+    try:
+        conn.in_transaction  # Raises ProgrammingError once the connection has been closed
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+
+# Closes a connection ignoring errors from connections that are already broken
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+_pools = {}  # Shared pools keyed by database path
+_pools_lock = threading.Lock()
+
+
+# Returns the key a database path is shared under
+def _pool_key(db_path):
+    if db_path == ':memory:' or str(db_path).startswith('file:'):
+        return str(db_path)
+    return os.path.abspath(db_path)
+
+
+# Returns the pool shared by every manager using this database, options only apply when the pool is first created
+def get_pool(db_path, **options):
+    key = _pool_key(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(db_path, **options)
+            _pools[key] = pool
+        return pool
+
+
+# Closes and forgets every shared pool
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
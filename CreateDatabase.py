@@ -1,36 +1,150 @@
 # Needed libraries
 import sqlite3
+import argparse
+import functools
 
-# ONLY NEEDS TO BE RUN ONCE IF THE DATABASE DOESN'T ALREADY, ONLY INITIALIZES IT AND DOESN'T FILL WITH DATA
+# SAFE TO RUN ON EXISTING DATABASES, ONLY APPLIES THE MIGRATIONS A DATABASE IS MISSING AND DOESN'T FILL IT WITH DATA
 
 '''
-Purpose: Create a new database for a grocery store with tables for products, sales, and customers 
-         with each one having it's own table and data 
+Purpose: Create and upgrade the database for a grocery store with tables for products, sales, customers and lots
+         through a list of numbered migrations, the version a database is at is kept in its user_version so
+         existing databases are brought up to date in place
+
+Contract: MIGRATIONS: The numbered list of schema changes, each one a list of SQL commands or functions
+          schema_version(): Returns the migration version a database is at
+          migrate(): Applies every migration a connection's database is missing and returns the new version
+          create_database(): Creates or upgrades a database at the given path, 'shop.db' by default
+          create_test_database(): Creates or upgrades the 'TESTshop.db' database used for testing
+          rebuild_rollups(): Recomputes the sales rollup tables, or only the given ones, from the sales table
+          check_rollups(): Returns the rollup rows that don't match the sales table, empty when they are consistent
+          VERSIONED_TABLES: The tables whose writes are counted in the data_versions table
+          area_code_sql(): Returns the SQL expression normalizing a phone number to its area code
+'''
+
+# Rollup tables kept up to date by triggers on sales, each with the query recomputing it from the sales table
+# Sales without a date are only counted in sales_totals, sales without a product or customer are left out of that
+# daily table, since neither can be placed in a day or a product/customer
+ROLLUPS = {
+    'sales_daily_product': '''
+        SELECT date, product_id, SUM(IFNULL(quantity, 0)) AS quantity, COUNT(*) AS sale_count FROM sales
+        WHERE date IS NOT NULL AND product_id IS NOT NULL GROUP BY date, product_id''',
+    'sales_daily_customer': '''
+        SELECT date, customer_id, SUM(IFNULL(quantity, 0)) AS quantity, COUNT(*) AS sale_count FROM sales
+        WHERE date IS NOT NULL AND customer_id IS NOT NULL GROUP BY date, customer_id''',
+    'sales_totals': '''
+        SELECT 1 AS id, IFNULL(SUM(IFNULL(quantity, 0)), 0) AS quantity, COUNT(*) AS sale_count FROM sales''',
+    'sales_product_totals': '''
+        SELECT product_id, SUM(IFNULL(quantity, 0)) AS quantity, COUNT(*) AS sale_count FROM sales
+        WHERE product_id IS NOT NULL GROUP BY product_id''',
+    'sales_customer_totals': '''
+        SELECT customer_id, SUM(IFNULL(quantity, 0)) AS quantity, COUNT(*) AS sale_count FROM sales
+        WHERE customer_id IS NOT NULL GROUP BY customer_id''',
+}
+
+# Rollups added by migration 3, the ones after it are created by later migrations
+_DAILY_ROLLUPS = ('sales_daily_product', 'sales_daily_customer', 'sales_totals')
+
+# Trigger bodies adding a sale (NEW) to the rollups and taking a sale (OLD) back out of them
+_ADD_TO_ROLLUPS = '''
+    INSERT INTO sales_daily_product (date, product_id, quantity, sale_count)
+    SELECT NEW.date, NEW.product_id, IFNULL(NEW.quantity, 0), 1
+    WHERE NEW.date IS NOT NULL AND NEW.product_id IS NOT NULL
+    ON CONFLICT (date, product_id) DO UPDATE SET quantity = quantity + excluded.quantity, sale_count = sale_count + 1;
+    INSERT INTO sales_daily_customer (date, customer_id, quantity, sale_count)
+    SELECT NEW.date, NEW.customer_id, IFNULL(NEW.quantity, 0), 1
+    WHERE NEW.date IS NOT NULL AND NEW.customer_id IS NOT NULL
+    ON CONFLICT (date, customer_id) DO UPDATE SET quantity = quantity + excluded.quantity, sale_count = sale_count + 1;
+    UPDATE sales_totals SET quantity = quantity + IFNULL(NEW.quantity, 0), sale_count = sale_count + 1 WHERE id = 1;
+'''
+_REMOVE_FROM_ROLLUPS = '''
+    UPDATE sales_daily_product SET quantity = quantity - IFNULL(OLD.quantity, 0), sale_count = sale_count - 1
+    WHERE date = OLD.date AND product_id = OLD.product_id;
+    DELETE FROM sales_daily_product WHERE date = OLD.date AND product_id = OLD.product_id AND sale_count = 0;
+    UPDATE sales_daily_customer SET quantity = quantity - IFNULL(OLD.quantity, 0), sale_count = sale_count - 1
+    WHERE date = OLD.date AND customer_id = OLD.customer_id;
+    DELETE FROM sales_daily_customer WHERE date = OLD.date AND customer_id = OLD.customer_id AND sale_count = 0;
+    UPDATE sales_totals SET quantity = quantity - IFNULL(OLD.quantity, 0), sale_count = sale_count - 1 WHERE id = 1;
 '''
 
+# Trigger bodies adding a sale to the all-time totals per product and per customer and taking it back out
+_ADD_TO_TOTALS = '''
+    INSERT INTO sales_product_totals (product_id, quantity, sale_count)
+    SELECT NEW.product_id, IFNULL(NEW.quantity, 0), 1 WHERE NEW.product_id IS NOT NULL
+    ON CONFLICT (product_id) DO UPDATE SET quantity = quantity + excluded.quantity, sale_count = sale_count + 1;
+    INSERT INTO sales_customer_totals (customer_id, quantity, sale_count)
+    SELECT NEW.customer_id, IFNULL(NEW.quantity, 0), 1 WHERE NEW.customer_id IS NOT NULL
+    ON CONFLICT (customer_id) DO UPDATE SET quantity = quantity + excluded.quantity, sale_count = sale_count + 1;
+'''
+_REMOVE_FROM_TOTALS = '''
+    UPDATE sales_product_totals SET quantity = quantity - IFNULL(OLD.quantity, 0), sale_count = sale_count - 1
+    WHERE product_id = OLD.product_id;
+    DELETE FROM sales_product_totals WHERE product_id = OLD.product_id AND sale_count = 0;
+    UPDATE sales_customer_totals SET quantity = quantity - IFNULL(OLD.quantity, 0), sale_count = sale_count - 1
+    WHERE customer_id = OLD.customer_id;
+    DELETE FROM sales_customer_totals WHERE customer_id = OLD.customer_id AND sale_count = 0;
+'''
+
+
+# Recomputes the sales rollup tables, or only the given ones, from the sales table, used when they are first created
+# and to repair them
+def rebuild_rollups(conn, tables=None):
+    for table in ROLLUPS if tables is None else tables:
+        conn.execute(f'DELETE FROM {table}')
+        conn.execute(f'INSERT INTO {table} {ROLLUPS[table]}')
+
+
+# Returns (table, row) for every rollup row that doesn't match the sales table, an empty list when they all match
+def check_rollups(conn):
+    mismatches = []
+    for table, query in ROLLUPS.items():
+        # Rows the rollup should have but doesn't, then rows the rollup has but shouldn't
+        expected_only = conn.execute(f'{query} EXCEPT SELECT * FROM {table}').fetchall()
+        actual_only = conn.execute(f'SELECT * FROM {table} EXCEPT {query}').fetchall()
+        mismatches.extend((table, row) for row in expected_only + actual_only)
+    return mismatches
 
-def create_database():
-    connection = sqlite3.connect('shop.db')  # Creates a connection to 'shop.db'
-    cursor = connection.cursor()  # Creates a cursor
 
-    # Creates a table for products if it doesn't already exist
-    cursor.execute('''
+# Returns the SQL expression giving the area code of the phone number in value (a column or parameter), the usual
+# separators and a leading country code of 1 are ignored and anything but a 10 digit North American number, whose
+# area codes never start with 0 or 1, gives NULL, so 9 digit and mistyped numbers aren't counted as an area code
+def area_code_sql(value):
+    digits = value
+    for separator in (' ', '-', '(', ')', '.', '+'):
+        digits = f"REPLACE({digits}, '{separator}', '')"
+    number = '[2-9]' + '[0-9]' * 9
+    return (f"CASE WHEN {digits} GLOB '{number}' THEN substr({digits}, 1, 3) "
+            f"WHEN {digits} GLOB '1{number}' THEN substr({digits}, 2, 3) END")
+
+
+# Tables whose writes are counted in data_versions, so cached results drawn from them know when they are stale
+VERSIONED_TABLES = ('products', 'customers', 'sales')
+
+
+# Returns the steps creating the triggers that bump a table's data version on every insert, update and delete
+def _data_version_triggers(table):
+    return [f'''CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+            BEGIN UPDATE data_versions SET version = version + 1 WHERE name = '{table}'; END'''
+            for event in ('INSERT', 'UPDATE', 'DELETE')]
+
+
+# Each migration is (version, steps), a step is either an SQL command or a function taking the connection
+# New migrations are only ever added to the end, a migration that has shipped is never changed
+MIGRATIONS = [
+    # 1: The original tables for products, customers, and sales with foreign keys to products and customers
+    (1, [
+        '''
         CREATE TABLE IF NOT EXISTS products (
             product_id INTEGER PRIMARY KEY,
             name TEXT,
             price REAL
-        )''')
-
-    # Create the customers table if it doesn't already exist
-    cursor.execute('''
-            CREATE TABLE IF NOT EXISTS customers (
-                customer_id INTEGER PRIMARY KEY,
-                name TEXT,
-                contact TEXT
-            )''')
-
-    # Create the sales table with a foreign key to reference products and customers tables if it doesn't already exist
-    cursor.execute('''
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS customers (
+            customer_id INTEGER PRIMARY KEY,
+            name TEXT,
+            contact TEXT
+        )''',
+        '''
         CREATE TABLE IF NOT EXISTS sales (
             sale_id INTEGER PRIMARY KEY,
             product_id INTEGER,
@@ -39,47 +153,212 @@ def create_database():
             date TEXT,
             FOREIGN KEY (product_id) REFERENCES products (product_id),
             FOREIGN KEY (customer_id) REFERENCES customers (customer_id)
-        )''')
+        )''',
+    ]),
+    # 2: Covering indexes for the sales reports grouping by product, by customer and by date, each one carries the
+    # quantity so the reports never have to read the sales rows themselves. Dates stay ISO-8601 TEXT (YYYY-MM-DD),
+    # which sorts in date order so the date index serves range queries
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_sales_product ON sales (product_id, quantity)',
+        'CREATE INDEX IF NOT EXISTS idx_sales_customer ON sales (customer_id, quantity)',
+        'CREATE INDEX IF NOT EXISTS idx_sales_date ON sales (date, quantity)',
+    ]),
+    # 3: Rollup tables holding daily totals per product, daily totals per customer and the overall totals, kept up to
+    # date by triggers so every way of writing sales updates them, then filled from the sales already recorded
+    (3, [
+        '''
+        CREATE TABLE IF NOT EXISTS sales_daily_product (
+            date TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL,
+            PRIMARY KEY (date, product_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_daily_product_product ON sales_daily_product (product_id, quantity)',
+        '''
+        CREATE TABLE IF NOT EXISTS sales_daily_customer (
+            date TEXT NOT NULL,
+            customer_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL,
+            PRIMARY KEY (date, customer_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_daily_customer_customer ON sales_daily_customer (customer_id, quantity)',
+        '''
+        CREATE TABLE IF NOT EXISTS sales_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            quantity INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL
+        )''',
+        f'CREATE TRIGGER IF NOT EXISTS sales_rollup_insert AFTER INSERT ON sales BEGIN {_ADD_TO_ROLLUPS} END',
+        f'CREATE TRIGGER IF NOT EXISTS sales_rollup_delete AFTER DELETE ON sales BEGIN {_REMOVE_FROM_ROLLUPS} END',
+        f'''CREATE TRIGGER IF NOT EXISTS sales_rollup_update AFTER UPDATE OF product_id, customer_id, quantity, date
+        ON sales BEGIN {_REMOVE_FROM_ROLLUPS} {_ADD_TO_ROLLUPS} END''',
+        functools.partial(rebuild_rollups, tables=_DAILY_ROLLUPS),
+    ]),
+    # 4: A version counter per table that goes up on every write to it, so rendered charts and other cached results
+    # can be keyed on the data they were drawn from
+    (4, [
+        '''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )''',
+        *(f"INSERT OR IGNORE INTO data_versions (name, version) VALUES ('{table}', 0)" for table in VERSIONED_TABLES),
+        *(step for table in VERSIONED_TABLES for step in _data_version_triggers(table)),
+    ]),
+    # 5: Lots of perishable products with their quantity and expiry date, indexed by expiry date for the expiring and
+    # expired queries of the markdown job and by product for a product's lots in expiry order
+    (5, [
+        '''
+        CREATE TABLE IF NOT EXISTS product_lots (
+            lot_id INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            expiry_date TEXT NOT NULL,
+            FOREIGN KEY (product_id) REFERENCES products (product_id)
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_lots_expiry ON product_lots (expiry_date, product_id, quantity)',
+        'CREATE INDEX IF NOT EXISTS idx_lots_product ON product_lots (product_id, expiry_date)',
+    ]),
+    # 6: All-time totals per product and per customer, indexed from the highest quantity down so the best and worst
+    # sellers are read off the end of an index without sorting every product or customer
+    (6, [
+        '''
+        CREATE TABLE IF NOT EXISTS sales_product_totals (
+            product_id INTEGER PRIMARY KEY,
+            quantity INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_product_totals_rank ON sales_product_totals '
+        '(quantity DESC, product_id, sale_count)',
+        '''
+        CREATE TABLE IF NOT EXISTS sales_customer_totals (
+            customer_id INTEGER PRIMARY KEY,
+            quantity INTEGER NOT NULL,
+            sale_count INTEGER NOT NULL
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_customer_totals_rank ON sales_customer_totals '
+        '(quantity DESC, customer_id, sale_count)',
+        f'CREATE TRIGGER IF NOT EXISTS sales_totals_insert AFTER INSERT ON sales BEGIN {_ADD_TO_TOTALS} END',
+        f'CREATE TRIGGER IF NOT EXISTS sales_totals_delete AFTER DELETE ON sales BEGIN {_REMOVE_FROM_TOTALS} END',
+        f'''CREATE TRIGGER IF NOT EXISTS sales_totals_update AFTER UPDATE OF product_id, customer_id, quantity
+        ON sales BEGIN {_REMOVE_FROM_TOTALS} {_ADD_TO_TOTALS} END''',
+        functools.partial(rebuild_rollups, tables=('sales_product_totals', 'sales_customer_totals')),
+    ]),
+    # 7: The area code of each customer's phone number, normalized once when it is written and indexed so the area
+    # code distribution is counted from the index instead of slicing every contact, filled in for existing customers.
+    # The customer index of sales also takes the date and product so customer segmentation reads every customer's
+    # sales in order from the index alone, it still leads with customer_id and covers quantity like the old one
+    (7, [
+        'ALTER TABLE customers ADD COLUMN area_code TEXT',
+        f'UPDATE customers SET area_code = {area_code_sql("contact")}',
+        'CREATE INDEX IF NOT EXISTS idx_customers_area_code ON customers (area_code)',
+        'DROP INDEX IF EXISTS idx_sales_customer',
+        'CREATE INDEX IF NOT EXISTS idx_sales_customer_activity ON sales (customer_id, date, product_id, quantity)',
+    ]),
+    # 8: The unit price and cost of each sale, taken from its product when it is recorded so later price changes
+    # don't rewrite past revenue, with the line total worked out from them. Sales recorded before this migration get
+    # their product's current price, the best there is for them. The date index of sales also takes the customer and
+    # the revenue columns so daily revenue, margin and basket values are read from the index alone, and the customer
+    # index swaps the product for the line total so segmentation no longer joins the products
+    (8, [
+        'ALTER TABLE products ADD COLUMN cost REAL',
+        'ALTER TABLE sales ADD COLUMN unit_price REAL',
+        'ALTER TABLE sales ADD COLUMN unit_cost REAL',
+        'ALTER TABLE sales ADD COLUMN line_total REAL GENERATED ALWAYS AS (quantity * unit_price) VIRTUAL',
+        '''UPDATE sales SET unit_price = p.price, unit_cost = p.cost
+        FROM products p WHERE p.product_id = sales.product_id''',
+        'DROP INDEX IF EXISTS idx_sales_date',
+        'CREATE INDEX IF NOT EXISTS idx_sales_date_revenue ON sales '
+        '(date, customer_id, quantity, line_total, unit_cost)',
+        'DROP INDEX IF EXISTS idx_sales_customer_activity',
+        'CREATE INDEX IF NOT EXISTS idx_sales_customer_revenue ON sales (customer_id, date, quantity, line_total)',
+    ]),
+    # 9: The catalog of sales partitions, tables holding the sales of a month, quarter or year moved out of sales,
+    # each with the dates it covers (end_date is the day after its last) and the path of its archive when it has been
+    # moved out of the database, see Partitions.py
+    (9, [
+        '''CREATE TABLE IF NOT EXISTS sales_partitions (
+            name TEXT PRIMARY KEY,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            archive TEXT
+        ) WITHOUT ROWID''',
+    ]),
+    # 10: A version on each product and customer that goes up with every update, so an update made from a copy read
+    # earlier can check nobody else changed the row in between instead of silently overwriting their change
+    (10, [
+        'ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE customers ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+    ]),
+]
 
-    connection.commit()
-    connection.close()
+LATEST_VERSION = MIGRATIONS[-1][0]  # Version every database is brought up to
 
 
-# Same function as defined earlier just redefined to create a TESTshop.db for testing all the methods
-def create_test_database():
-    connection = sqlite3.connect('TESTshop.db')
-    cursor = connection.cursor()
-    # Create the products table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS products (
-            product_id INTEGER PRIMARY KEY,
-            name TEXT,
-            price REAL
-        )''')
+# Returns the migration version a database is at, 0 for a database that has never been migrated
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
 
-    # Create the sales table with a foreign key to customers
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sales (
-            sale_id INTEGER PRIMARY KEY,
-            product_id INTEGER,
-            customer_id INTEGER,
-            quantity INTEGER,
-            date TEXT,
-            FOREIGN KEY (product_id) REFERENCES products (product_id),
-            FOREIGN KEY (customer_id) REFERENCES customers (customer_id)
-        )''')
 
-    # Create the customers table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customers (
-            customer_id INTEGER PRIMARY KEY,
-            name TEXT,
-            contact TEXT
-        )''')
+# Applies every migration the connection's database is missing, each in its own transaction, and returns the version
+def migrate(conn):
+    if schema_version(conn) >= LATEST_VERSION:
+        return schema_version(conn)  # Nothing to do, checked first so up-to-date databases never take the write lock
+
+    if conn.in_transaction:
+        conn.commit()  # Migrations run in their own transactions
+    for version, steps in MIGRATIONS:
+        if schema_version(conn) >= version:
+            continue  # Skips migrations the database already has
+        conn.execute('BEGIN IMMEDIATE')  # Takes the write lock so two processes can't apply the same migration
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()  # Already applied, possibly by another process while this one waited
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)  # Runs a function step such as a data backfill
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {version}')  # Records the migration as part of its transaction
+            conn.commit()
+        except BaseException:
+            conn.rollback()  # Leaves the database at the last migration that fully applied
+            raise
+    return schema_version(conn)
+
+
+# Creates the database at the given path or brings an existing one up to the latest schema
+def create_database(db_path='shop.db'):
+    connection = sqlite3.connect(db_path)  # Creates a connection to the database
+    try:
+        return migrate(connection)  # Applies the migrations it is missing
+    finally:
+        connection.close()
+
+
+# Same function as defined earlier just pointed at TESTshop.db for testing all the methods
+def create_test_database(db_path='TESTshop.db'):
+    return create_database(db_path)
+
 
-    connection.commit()
-    connection.close()
+# Creates the databases or upgrades them to the latest schema in place, optionally rebuilding their sales rollups
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or upgrade the store databases")
+    parser.add_argument('databases', nargs='*', default=['shop.db', 'TESTshop.db'], help="Databases to upgrade")
+    parser.add_argument('--rebuild-rollups', action='store_true', help="Recompute the sales rollup tables")
+    parser.add_argument('--check-rollups', action='store_true', help="Report rollup rows that don't match sales")
+    args = parser.parse_args()
 
-# Calls and creates the databases (Commented out since they are already created)
-# create_database()
-# create_test_database()
+    for path in args.databases:
+        print(f"{path} is at schema version {create_database(path)}")
+        with sqlite3.connect(path) as connection:
+            if args.rebuild_rollups:
+                rebuild_rollups(connection)
+                print(f"{path}: rebuilt the sales rollups")
+            if args.check_rollups:
+                mismatches = check_rollups(connection)
+                print(f"{path}: {len(mismatches)} rollup rows don't match the sales table")
+        connection.close()
@@ -1,7 +1,14 @@
 # Needed libraries
 from Store import *
+import argparse
+import os
 import random
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta, datetime
+import numpy as np
+from ConnectionPool import apply_pragmas
+from CreateDatabase import create_database, rebuild_rollups
 
 '''
 Purpose: To fill the shop.db database with data for products, customers, and sales to represent what a real store 
@@ -11,8 +18,25 @@ Contract: fill_products(): Fills the products table with a defined list of produ
           fill_customers(): Fills the customer table with a defined list of customers
           fill_sales(): # Fills the sales table with a defined, randomly generated list of transactions
           random_date(): Creates a random date within a given range use for sales_data
+          generate_database(): Fills a new database with a seeded synthetic dataset of any size for load testing
+          generate_shards(): Generates a dataset split by date into several database files in parallel processes
+          bulk_load(): Inserts batches of rows into a table, rebuilding its indexes and rollups once at the end
 '''
 
+DEFAULT_BATCH_SIZE = 100000  # Rows generated and sent to executemany at a time by the synthetic data generator
+PRODUCT_POPULARITY = 1.1  # Zipf exponent of product popularity, a few products make up most of the sales
+CUSTOMER_ACTIVITY = 0.6  # Zipf exponent of how often customers shop, regulars shop far more than most
+AREA_CODES = ('201', '973', '891', '732', '908', '609', '856', '862')  # Area codes of the generated phone numbers
+
+# Words the names of the generated products and customers are made from
+PRODUCT_NAMES = ('Apple', 'Banana', 'Orange', 'Milk', 'Bread', 'Cheese', 'Yogurt', 'Chicken', 'Beef', 'Pork',
+                 'Salmon', 'Lettuce', 'Tomato', 'Potato', 'Onion', 'Pepper', 'Ice Cream', 'Candy', 'Cereal',
+                 'Oatmeal', 'Rice', 'Cookies', 'Chips', 'Cold Cuts')
+FIRST_NAMES = ('Robyn', 'Sallie', 'Fern', 'Duane', 'Dallas', 'Rita', 'Saul', 'Sheldon', 'Leanna', 'Deon', 'Markus',
+               'Hilario', 'Carlos', 'Sharlene', 'Trent', 'Lynne', 'Millard', 'Sadie', 'Nelson', 'Julius', 'Chloe')
+LAST_NAMES = ('Ford', 'Boyer', 'Kane', 'Donovan', 'Morris', 'Clark', 'Walsh', 'Compton', 'Bradford', 'Campbell',
+              'Rojas', 'Cline', 'Monroe', 'Waller', 'Jarvis', 'Moore', 'Cardenas', 'Benjamin', 'Stevens', 'Gross')
+
 
 # Fills the shop database, product table with the following list of products with their price:
 def fill_products(db_path):
@@ -44,11 +68,7 @@ def fill_products(db_path):
         ("Sandwhich", 10.00),
         ("Cold Cuts", 4.00),
     ]
-    for name, price in products:
-        product = Product(db_path=db_path)
-        product.name = name
-        product.price = price
-        product.add_product()
+    Product(db_path=db_path).add_products(products)  # Adds every product in one transaction
 
 
 # Fills the shop database, customer table with the following list of customers with their phone number:
@@ -76,11 +96,7 @@ def fill_customers(db_path):
         ("Julius Gross", "2016018899"),
         ("Chloe Long", "9738235661")
     ]
-    for name, contact in customers:
-        customer = Customer(db_path=db_path)
-        customer.name = name
-        customer.contact = contact
-        customer.add_customer()
+    Customer(db_path=db_path).add_customers(customers)  # Adds every customer in one transaction
 
 
 # Creates a random date between certain dates already defined
@@ -103,15 +119,170 @@ def fill_sales(db_path):
     sales = []  # List of sales transactions
 
     for _ in range(100):  # Generate 100 transactions
-        customer_id = random.choice(list(customers))  # Picks a random customer
-        product_id = random.choice(list(products))  # Picks a random product
+        customer_id = random.choice(customers)  # Picks a random customer
+        product_id = random.choice(products)  # Picks a random product
         quantity = random.randint(1, 15)  # Picks a random amount between 1 and 15
         date = random_date(start_date, end_date).strftime("%Y-%m-%d")  # Picks a random date between start/end time
         sales.append(Sale(product_id, customer_id, quantity, date))  # Adds the transaction to the list
 
-    # Iterates through sales list adding each transaction to the database 
-    for sale in sales:
-        sales_manager.add_sale(sale)
+    # Adds every transaction in the sales list to the database in one transaction
+    sales_manager.add_sales(sales)
+
+
+# Inserts batches of rows into a table of a database nothing else is writing to, in one transaction. The table's
+# indexes and triggers are dropped for the load and recreated afterwards so each index is built in one sorted pass
+# instead of row by row, then the sales rollups are recomputed once and the table's data version is bumped
+def bulk_load(conn, table, columns, batches):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        schema = conn.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? "
+                              "AND type IN ('index', 'trigger') AND sql IS NOT NULL", (table,)).fetchall()
+        for kind, name, _ in schema:
+            conn.execute(f'DROP {kind.upper()} {name}')
+        sql = f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+        count = 0
+        for batch in batches:
+            conn.executemany(sql, batch)
+            count += len(batch)
+        for _, _, definition in schema:
+            conn.execute(definition)  # Recreates the indexes and triggers exactly as they were
+        if table == 'sales':
+            rebuild_rollups(conn)
+        conn.execute('UPDATE data_versions SET version = version + 1 WHERE name = ?', (table,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()  # Also brings back the dropped indexes and triggers
+        raise
+    return count
+
+
+# Returns the cumulative probabilities of a Zipf distribution over count items, the first item being the most likely
+def _zipf_cdf(count, exponent):
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+# Picks size IDs from 1 to len(order) where order[rank] is the ID with that popularity rank
+def _pick(rng, cdf, order, size):
+    ranks = np.searchsorted(cdf, rng.random(size), side='right')
+    return order[np.minimum(ranks, len(order) - 1)]
+
+
+# Returns the days between start and end and how likely a sale is on each, higher in November and December and at
+# weekends, with a gentle summer dip
+def _sale_days(start, end):
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+    day_of_year = (days - days.astype('datetime64[Y]')).astype(int)
+    weekday = (days.astype(int) + 3) % 7  # 1970-01-01 was a Thursday, 0 is Monday
+    weights = 1.0 + 0.25 * np.cos(2 * np.pi * (day_of_year - 350) / 365)  # Peaks just before Christmas
+    weights *= np.where(weekday >= 5, 1.3, 1.0)
+    return days, weights / weights.sum()
+
+
+# Splits the sales across the days and the days into shards of consecutive dates, returning for each shard its days,
+# the number of sales on each of them and the sale_id of its first sale so IDs are unique across shards
+def _plan_sales(seed, sales, start, end, shards):
+    days, weights = _sale_days(start, end)
+    per_day = np.random.default_rng([seed, 0]).multinomial(sales, weights)
+    plan = []
+    first_id = 1
+    for shard_days, shard_counts in zip(np.array_split(days, shards), np.array_split(per_day, shards)):
+        plan.append((shard_days, shard_counts, first_id))
+        first_id += int(shard_counts.sum())
+    return plan
+
+
+# Generates the (product_id, name, price) of count products, the same ones for a seed
+def _generate_products(seed, count):
+    rng = np.random.default_rng([seed, 1])
+    picks = rng.integers(0, len(PRODUCT_NAMES), count).tolist()
+    prices = np.maximum(np.round(rng.lognormal(0.7, 0.8, count), 2), 0.1).tolist()
+    return [(product_id, f"{PRODUCT_NAMES[pick]} {product_id}", price)
+            for product_id, pick, price in zip(range(1, count + 1), picks, prices)]
+
+
+# Generates the (customer_id, name, contact, area_code) of count customers, the same ones for a seed
+def _generate_customers(seed, count):
+    rng = np.random.default_rng([seed, 2])
+    firsts = rng.integers(0, len(FIRST_NAMES), count).tolist()
+    lasts = rng.integers(0, len(LAST_NAMES), count).tolist()
+    codes = rng.integers(0, len(AREA_CODES), count).tolist()
+    numbers = rng.integers(0, 10 ** 7, count).tolist()
+    return [(customer_id, f"{FIRST_NAMES[first]} {LAST_NAMES[last]}", f"{AREA_CODES[code]}{number:07d}",
+             AREA_CODES[code])
+            for customer_id, first, last, code, number in zip(range(1, count + 1), firsts, lasts, codes, numbers)]
+
+
+# Yields the sales of one shard in batches of about batch_size rows in date order, products picked by Zipfian
+# popularity, customers by how often they shop and quantities mostly small. Each column has its own random stream
+# drawn only through random(), so the data doesn't depend on how it is split into batches
+def _generate_sales(seed, shard, days, counts, first_id, prices, customers, batch_size):
+    products = len(prices) - 1  # prices[product_id] is the price of each product, charged as the sale's unit price
+    product_rng, customer_rng, quantity_rng = (np.random.default_rng([seed, 3, shard, column]) for column in range(3))
+    order = np.random.default_rng([seed, 4])  # Same popularity order in every shard
+    product_cdf, product_order = _zipf_cdf(products, PRODUCT_POPULARITY), order.permutation(products) + 1
+    customer_cdf, customer_order = _zipf_cdf(customers, CUSTOMER_ACTIVITY), order.permutation(customers) + 1
+    day_text = np.datetime_as_string(days)
+    ends = np.cumsum(counts)
+    next_id = first_id
+    day = 0
+    while day < len(days):
+        last_day = max(int(np.searchsorted(ends, ends[day] - counts[day] + batch_size, side='right')), day + 1)
+        dates = np.repeat(day_text[day:last_day], counts[day:last_day])  # Whole days per batch, in date order
+        size = len(dates)
+        if size:
+            # Geometric quantities with a mean of about 3, capped at 15
+            quantities = np.minimum(np.ceil(np.log1p(-quantity_rng.random(size)) / np.log(0.65)), 15).astype(int)
+            product_ids = _pick(product_rng, product_cdf, product_order, size)
+            yield list(zip(range(next_id, next_id + size), product_ids.tolist(),
+                           _pick(customer_rng, customer_cdf, customer_order, size).tolist(),
+                           np.maximum(quantities, 1).tolist(), dates.tolist(), prices[product_ids].tolist()))
+        next_id += size
+        day = last_day
+
+
+# Splits rows into lists of batch_size
+def _batches(rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+# Creates a database and fills it with a synthetic dataset that is the same every time for the same seed, with
+# realistic distributions: Zipfian product popularity, regular and occasional customers, seasonal and weekend peaks.
+# With shards > 1 only the sales of shard number shard are written, the products and customers are written to every
+# shard. Returns the number of sales written
+def generate_database(db_path, products=1000, customers=10000, sales=100000, seed=0, start='2023-01-01',
+                      end='2024-12-31', shard=0, shards=1, batch_size=DEFAULT_BATCH_SIZE):
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    create_database(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        # A half-written file is thrown away rather than recovered, so nothing is journaled or synced until the end
+        apply_pragmas(conn, {'journal_mode': 'OFF', 'synchronous': 'OFF', 'cache_size': -262144})
+        product_rows = _generate_products(seed, products)
+        bulk_load(conn, 'products', ('product_id', 'name', 'price'), _batches(product_rows, batch_size))
+        bulk_load(conn, 'customers', ('customer_id', 'name', 'contact', 'area_code'),
+                  _batches(_generate_customers(seed, customers), batch_size))
+        days, counts, first_id = _plan_sales(seed, sales, start, end, shards)[shard]
+        prices = np.array([0.0] + [price for _, _, price in product_rows])
+        return bulk_load(conn, 'sales', ('sale_id', 'product_id', 'customer_id', 'quantity', 'date', 'unit_price'),
+                         _generate_sales(seed, shard, days, counts, first_id, prices, customers, batch_size))
+    finally:
+        conn.close()
+
+
+# Generates the dataset into shards database files in folder, each holding the sales of one run of consecutive
+# dates, using up to workers processes, and returns the paths of the files in date order
+def generate_shards(folder, shards, workers=None, **options):
+    os.makedirs(folder, exist_ok=True)
+    paths = [os.path.join(folder, f'shard{shard:03d}.db') for shard in range(shards)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(generate_database, path, shard=shard, shards=shards, **options)
+                for shard, path in enumerate(paths)]
+        for job in jobs:
+            job.result()  # Raises the error of any shard that failed
+    return paths
 
 
 # Same methods as earlier to fill a database with predefined data but condensed and simplified to test all methods in
@@ -127,11 +298,7 @@ def test_populate_products(db_path):
         ("Mozzarella", 1.50),
         ("Cereal", 1.20)
     ]
-    product_manager = Product(db_path)
-    for name, price in products:
-        product_manager.name = name
-        product_manager.price = price
-        product_manager.add_product()
+    Product(db_path).add_products(products)
 
 
 # Fills the test database with customers
@@ -143,11 +310,7 @@ def test_populate_customers(db_path):
         ("Chris Fox", "9998887777"),
         ("Brianna Molleen", "5553338888")
     ]
-    customer_manager = Customer(db_path)
-    for name, contact in customers:
-        customer_manager.name = name
-        customer_manager.contact = contact
-        customer_manager.add_customer()
+    Customer(db_path).add_customers(customers)
 
 
 # Fills the test database with sales (not randomly generated)
@@ -159,26 +322,48 @@ def test_populate_sales(db_path):
         (1, 9, 2, "2024-04-17"),
         (3, 4, 3, "2024-04-18")
     ]
-    sales_manager = SalesManager(db_path)
-    for product_id, customer_id, quantity, date in sales:
-        sale = Sale(product_id=product_id, customer_id=customer_id, quantity=quantity, date=date)
-        sales_manager.add_sale(sale)
+    SalesManager(db_path).add_sales(Sale(product_id=product_id, customer_id=customer_id, quantity=quantity, date=date)
+                                    for product_id, customer_id, quantity, date in sales)
 
 
 # Main function to run and fill the databases with the predefined data
 # Incorporates both the main and test methods defined earlier, in order to run
 # either one just uncomment/comment the block below
+# With --generate it writes a synthetic dataset instead, for example the standard benchmark dataset:
+# python FillDatabase.py --generate bench.db --products 100000 --customers 1000000 --sales 10000000
 if __name__ == "__main__":
-    '''
-    # For the main 'shop.db' database 
-    db_path = 'shop.db'
-    fill_products(db_path)
-    fill_customers(db_path)
-    fill_sales(db_path)
-    '''
-
-    # For the testing database
-    db_path = 'TESTshop.db'
-    test_populate_products(db_path)
-    test_populate_customers(db_path)
-    test_populate_sales(db_path)
+    parser = argparse.ArgumentParser(description="Fill the store databases")
+    parser.add_argument('--generate', metavar='PATH', help="Database file, or folder with --shards, to generate")
+    parser.add_argument('--products', type=int, default=1000, help="Number of products to generate")
+    parser.add_argument('--customers', type=int, default=10000, help="Number of customers to generate")
+    parser.add_argument('--sales', type=int, default=100000, help="Number of sales to generate")
+    parser.add_argument('--seed', type=int, default=0, help="Seed, the same seed always generates the same data")
+    parser.add_argument('--start', default='2023-01-01', help="Date of the first sales")
+    parser.add_argument('--end', default='2024-12-31', help="Date of the last sales")
+    parser.add_argument('--shards', type=int, default=1, help="Number of files to split the sales into by date")
+    parser.add_argument('--workers', type=int, help="Processes generating shards at once, one per CPU by default")
+    args = parser.parse_args()
+
+    if args.generate:
+        sizes = dict(products=args.products, customers=args.customers, sales=args.sales, seed=args.seed,
+                     start=args.start, end=args.end)
+        if args.shards > 1:
+            for path in generate_shards(args.generate, args.shards, args.workers, **sizes):
+                print(f"Generated {path}")
+        else:
+            generate_database(args.generate, **sizes)
+            print(f"Generated {args.generate}")
+    else:
+        '''
+        # For the main 'shop.db' database 
+        db_path = 'shop.db'
+        fill_products(db_path)
+        fill_customers(db_path)
+        fill_sales(db_path)
+        '''
+
+        # For the testing database
+        db_path = 'TESTshop.db'
+        test_populate_products(db_path)
+        test_populate_customers(db_path)
+        test_populate_sales(db_path)
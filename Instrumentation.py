@@ -0,0 +1,264 @@
+# Needed libraries
+import bisect
+import collections
+import functools
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+'''
+Purpose: Times every SQL statement the Product, Customer and SalesManager classes run, along with how long they wait
+         for a pooled connection and how long each commit takes, and hands the measurements to pluggable sinks so a
+         slow report can be traced back to the query that caused it. Instrumented connections are only opened once a
+         pool is instrumented, so a pool without instrumentation runs on plain sqlite3 connections at full speed
+
+Contract: Instrumentation(): Times the connections it opens and sends every measurement to its sinks, capturing the
+                             EXPLAIN QUERY PLAN of statements slower than slow_query_seconds
+          instrument(): Turns instrumentation on for the shared pool of a database, or off when given None
+          QueryEvent: One measurement, its kind ('execute', 'fetch', 'acquire' or 'commit'), the statement, the
+                      seconds it took, the rows it returned or changed and the query plan when it was slow
+          MemorySink: Keeps latency histograms, row counts and the latest slow queries in memory
+          LoggingSink: Logs every measurement at DEBUG and slow queries at WARNING
+          PrometheusSink: A MemorySink that can dump its measurements in the Prometheus text format
+'''
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket catches everything slower
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+QueryEvent = namedtuple('QueryEvent', ['kind', 'statement', 'seconds', 'rows', 'plan'])
+
+
+# Collapses the whitespace of a statement so the same query written over several lines is counted as one
+@functools.lru_cache(maxsize=1024)
+def _statement_key(sql):
+    return ' '.join(sql.split())
+
+
+class Instrumentation:
+    # Initializes the instrumentation with the sinks receiving the measurements and the seconds after which a
+    # statement counts as slow and has its query plan captured, None never captures plans
+    def __init__(self, sinks=(), slow_query_seconds=None):
+        self.sinks = list(sinks)  # Objects with a record(event) method
+        self.slow_query_seconds = slow_query_seconds
+
+    # Opens a connection whose statements, fetches and commits are timed, used by the pool in place of sqlite3.connect
+    def connect(self, db_path, **options):
+        conn = sqlite3.connect(db_path, factory=_InstrumentedConnection, **options)
+        conn.instrumentation = self
+        return conn
+
+    # Sends a measurement to every sink
+    def record(self, kind, statement, seconds, rows=None, plan=None):
+        event = QueryEvent(kind, statement, seconds, rows, plan)
+        for sink in self.sinks:
+            sink.record(event)
+
+    # Times a statement run by run(), recording it with its plan when it was slow, and returns what run() returned
+    def _execute(self, conn, sql, parameters, run):
+        start = time.perf_counter()
+        result = run()
+        seconds = time.perf_counter() - start
+        plan = None
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds and parameters is not None:
+            plan = _query_plan(conn, sql, parameters)
+        rows = result.rowcount if result.rowcount >= 0 else None  # Only writes report their row count up front
+        self.record('execute', _statement_key(sql), seconds, rows, plan)
+        return result
+
+
+# Returns the EXPLAIN QUERY PLAN of a statement as a list of plan lines, None if it can't be explained
+def _query_plan(conn, sql, parameters):
+    try:
+        rows = sqlite3.Connection.execute(conn, f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+    except sqlite3.Error:
+        return None  # Statements such as BEGIN or PRAGMA have no plan
+    return [row[-1] for row in rows]
+
+
+# Connection timing every statement run on it or on its cursors, and every commit
+class _InstrumentedConnection(sqlite3.Connection):
+    instrumentation = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or _InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        cursor = self.cursor()
+        return cursor.execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        cursor = self.cursor()
+        return cursor.executemany(sql, parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        self.instrumentation.record('commit', None, time.perf_counter() - start)
+
+
+# Cursor timing its statements and counting the rows fetched from them
+class _InstrumentedCursor(sqlite3.Cursor):
+    _statement = None
+
+    def execute(self, sql, parameters=()):
+        self._statement = _statement_key(sql)
+        run = functools.partial(sqlite3.Cursor.execute, self, sql, parameters)
+        return self.connection.instrumentation._execute(self.connection, sql, parameters, run)
+
+    def executemany(self, sql, parameters):
+        self._statement = _statement_key(sql)
+        run = functools.partial(sqlite3.Cursor.executemany, self, sql, parameters)
+        return self.connection.instrumentation._execute(self.connection, sql, None, run)  # Rows can't be explained
+
+    def fetchone(self):
+        return self.__fetched(super().fetchone, lambda row: 0 if row is None else 1)
+
+    def fetchmany(self, size=None):
+        return self.__fetched(functools.partial(sqlite3.Cursor.fetchmany, self, size or self.arraysize), len)
+
+    def fetchall(self):
+        return self.__fetched(super().fetchall, len)
+
+    def __next__(self):
+        return self.__fetched(super().__next__, lambda row: 1)
+
+    # Times a fetch and records the rows it returned against the statement that produced them
+    def __fetched(self, fetch, count):
+        start = time.perf_counter()
+        result = fetch()
+        self.connection.instrumentation.record('fetch', self._statement, time.perf_counter() - start, count(result))
+        return result
+
+
+# Turns instrumentation on for the pool shared by every manager of a database, or off again when given None
+def instrument(db_path, instrumentation):
+    from ConnectionPool import get_pool
+    get_pool(db_path).instrument(instrumentation)
+    return instrumentation
+
+
+# Counts how many measurements fell in each latency bucket along with their total and the slowest one
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {'count': self.count, 'total_seconds': self.total, 'max_seconds': self.max,
+                'buckets': dict(zip([*LATENCY_BUCKETS, float('inf')], self.buckets))}
+
+
+class MemorySink:
+    # Initializes the sink keeping up to slow_query_limit of the latest slow queries
+    def __init__(self, slow_query_limit=100):
+        self.__lock = threading.Lock()
+        self.__statements = collections.defaultdict(_Histogram)  # Execute latency per statement
+        self.__fetches = collections.defaultdict(_Histogram)  # Fetch latency per statement
+        self.__rows = collections.Counter()  # Rows returned or changed per statement
+        self.__acquire = _Histogram()
+        self.__commit = _Histogram()
+        self.slow_queries = collections.deque(maxlen=slow_query_limit)
+
+    # Adds a measurement to the histograms
+    def record(self, event):
+        with self.__lock:
+            if event.kind == 'execute':
+                self.__statements[event.statement].observe(event.seconds)
+                if event.plan is not None:
+                    self.slow_queries.append(event)
+            elif event.kind == 'fetch':
+                self.__fetches[event.statement].observe(event.seconds)
+            elif event.kind == 'acquire':
+                self.__acquire.observe(event.seconds)
+            elif event.kind == 'commit':
+                self.__commit.observe(event.seconds)
+            if event.rows:
+                self.__rows[event.statement] += event.rows
+
+    # Returns the histograms per statement, the connection-acquire and commit histograms and the slow queries
+    def stats(self):
+        with self.__lock:
+            return {
+                'statements': {statement: dict(histogram.as_dict(), rows=self.__rows[statement],
+                                               fetch=self.__fetches[statement].as_dict())
+                               for statement, histogram in self.__statements.items()},
+                'acquire': self.__acquire.as_dict(),
+                'commit': self.__commit.as_dict(),
+                'slow_queries': list(self.slow_queries),
+            }
+
+    # Forgets every measurement
+    def reset(self):
+        with self.__lock:
+            self.__statements.clear()
+            self.__fetches.clear()
+            self.__rows.clear()
+            self.__acquire = _Histogram()
+            self.__commit = _Histogram()
+            self.slow_queries.clear()
+
+
+class LoggingSink:
+    # Initializes the sink with the logger to write to
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('store.sql')
+
+    # Logs a slow query with its plan at WARNING and every other measurement at DEBUG
+    def record(self, event):
+        if event.plan is not None:
+            self.logger.warning("Slow query (%.3fs): %s\n  plan: %s", event.seconds, event.statement,
+                                '\n        '.join(event.plan))
+        elif self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s %.6fs rows=%s %s", event.kind, event.seconds, event.rows, event.statement or '')
+
+
+class PrometheusSink(MemorySink):
+    # Returns the measurements in the Prometheus text exposition format, prefix starting every metric name
+    def dump(self, prefix='store'):
+        stats = self.stats()
+        lines = []
+        _histogram_lines(lines, f'{prefix}_sql_execute_seconds', 'Time to run each SQL statement',
+                         [({'statement': statement}, values) for statement, values in stats['statements'].items()])
+        _histogram_lines(lines, f'{prefix}_sql_fetch_seconds', 'Time to fetch the rows of each SQL statement',
+                         [({'statement': statement}, values['fetch'])
+                          for statement, values in stats['statements'].items()])
+        lines.append(f'# HELP {prefix}_sql_rows_total Rows returned or changed by each SQL statement')
+        lines.append(f'# TYPE {prefix}_sql_rows_total counter')
+        for statement, values in stats['statements'].items():
+            lines.append(f'{prefix}_sql_rows_total{_labels({"statement": statement})} {values["rows"]}')
+        _histogram_lines(lines, f'{prefix}_connection_acquire_seconds', 'Time waiting for a pooled connection',
+                         [({}, stats['acquire'])])
+        _histogram_lines(lines, f'{prefix}_commit_seconds', 'Time to commit a transaction', [({}, stats['commit'])])
+        return '\n'.join(lines) + '\n'
+
+
+# Adds the lines of one histogram metric with a series per set of labels
+def _histogram_lines(lines, name, description, series):
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} histogram')
+    for labels, values in series:
+        cumulative = 0
+        for bound, count in values['buckets'].items():
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{_labels(dict(labels, le=le))} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {values["total_seconds"]}')
+        lines.append(f'{name}_count{_labels(labels)} {values["count"]}')
+
+
+# Formats Prometheus labels, escaping backslashes, quotes and newlines in their values
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
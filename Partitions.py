@@ -0,0 +1,326 @@
+# Needed libraries
+import datetime
+import gzip
+import os
+import re
+import shutil
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from ConnectionPool import ConnectionPool
+
+'''
+Purpose: Splits the sales history of a database into a table per month, quarter or year kept next to the sales table,
+         which goes on holding the current sales and handing out sale IDs, so reads over a date range only touch the
+         partitions it overlaps and cold partitions can be moved out into compressed files, keeping the database
+         small to vacuum and back up. Reads see the sales table and its partitions as one through a temporary view
+         named sales, created on the connections lent out for reading, so every sales query works unchanged
+
+Contract: PARTITION_PERIODS: The lengths of time a partition can cover and the months in each
+          Partition: A partition's table name, its first date, the date after its last one and the path of its
+                     compressed archive, None while its sales are in the database
+          partition_of(): Returns the Partition a date falls in for a period
+          SalesPartitions(): The partitions of one database, lends out connections reading the partitions a date
+                             range overlaps, moves old sales into partitions, archives partitions and restores them
+          SalesPartitions.tables(): Lends out a connection with the tables holding the sales of a date range
+'''
+
+PARTITION_PERIODS = {'month': 1, 'quarter': 3, 'year': 12}
+
+Partition = namedtuple('Partition', ['name', 'start', 'end', 'archive'])
+
+# Statements creating the sales table, its indexes and its triggers, rewritten for a partition by _partition_schema
+_SALES_SCHEMA_QUERY = '''
+    SELECT type, sql FROM main.sqlite_master WHERE tbl_name = 'sales' AND sql IS NOT NULL
+    ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END, rowid'''
+_TABLE_NAME = re.compile(r'^CREATE TABLE\s+(?:IF NOT EXISTS\s+)?"?sales"?', re.IGNORECASE)
+_ON_SALES = re.compile(r'^(CREATE (?:INDEX|TRIGGER)\s+)(?:IF NOT EXISTS\s+)?(\w+)(.*?\bON\s+)sales\b',
+                       re.IGNORECASE | re.DOTALL)
+
+
+# Turns a date, datetime or text starting with 'YYYY-MM-DD' into that 'YYYY-MM-DD' text
+def _day(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime('%Y-%m-%d')
+    return str(value)[:10]
+
+
+# Returns the Partition holding the sales made on date when partitions cover a month, quarter or year
+def partition_of(date, period='month'):
+    if period not in PARTITION_PERIODS:
+        raise ValueError(f"Partition period must be one of {', '.join(PARTITION_PERIODS)}")
+    months = PARTITION_PERIODS[period]
+    day = _day(date)
+    year, month = int(day[:4]), int(day[5:7])
+    first = (month - 1) // months * months + 1
+    names = {'month': f'sales_{year}_{first:02d}', 'quarter': f'sales_{year}_q{(first + 2) // 3}',
+             'year': f'sales_{year}'}
+    end_year, end_month = (year, first + months) if first + months <= 12 else (year + 1, first + months - 12)
+    return Partition(names[period], f'{year}-{first:02d}-01', f'{end_year}-{end_month:02d}-01', None)
+
+
+# Returns the CREATE statements of the sales table, its indexes and its triggers rewritten for a partition table
+# named name, (kind, statement) pairs in the order they have to run, so partitions always match the sales table
+def _partition_schema(conn, name):
+    statements = []
+    for kind, sql in conn.execute(_SALES_SCHEMA_QUERY):
+        if kind == 'table':
+            sql = _TABLE_NAME.sub(f'CREATE TABLE {name}', sql, count=1)
+        else:
+            sql = _ON_SALES.sub(lambda match: f'{match[1]}{name}_{match[2]}{match[3]}{name}', sql, count=1)
+        statements.append((kind, sql))
+    return statements
+
+
+# Returns the columns of a table that hold values, leaving out generated ones since they can't be inserted into
+def _stored_columns(conn, table, schema='main'):
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_xinfo({table})') if row[6] == 0]
+
+
+# Drops the triggers on a table and returns the statements creating them again
+def _drop_triggers(conn, table):
+    triggers = conn.execute("SELECT name, sql FROM main.sqlite_master WHERE type = 'trigger' AND tbl_name = ?",
+                            (table,)).fetchall()
+    for name, _ in triggers:
+        conn.execute(f'DROP TRIGGER main.{name}')
+    return [sql for _, sql in triggers]
+
+
+# Makes the temporary sales view of a connection read the given tables, leaving the connection alone when its view
+# already does and dropping the view when only the sales table is read. A view of one table is flattened into the
+# queries on it so they keep using its covering indexes, a view of several can't be and reads every column of the
+# matching rows, so the fewer tables a read overlaps the faster it is
+def _install_view(conn, tables):
+    body = ' UNION ALL '.join(f'SELECT * FROM main.{table}' for table in tables)
+    row = conn.execute("SELECT sql FROM temp.sqlite_master WHERE type = 'view' AND name = 'sales'").fetchone()
+    current = row[0] if row else None
+    wanted = None if tables in ([], ['sales']) else f'CREATE VIEW sales AS {body}'  # Stored without TEMP
+    if current == wanted:
+        return
+    if current is not None:
+        conn.execute('DROP VIEW temp.sales')
+    if wanted is not None:
+        conn.execute(f'CREATE TEMP VIEW sales AS {body}')
+
+
+# Returns whether the sales table holds any sale made between first and last, both inclusive and one of them None
+def _has_sales(conn, first, last):
+    conditions = [condition for condition, value in (('date >= ?', first), ("date < date(?, '+1 day')", last))
+                  if value is not None]
+    params = [value for value in (first, last) if value is not None]
+    return conn.execute(f'SELECT EXISTS (SELECT 1 FROM main.sales WHERE {" AND ".join(conditions)})',
+                        params).fetchone()[0]
+
+
+# Compresses a file into path.gz and removes the original
+def _compress(path):
+    with open(path, 'rb') as source, gzip.open(f'{path}.gz', 'wb', compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1 << 20)
+    os.remove(path)
+
+
+# Decompresses path.gz back into path
+def _decompress(path):
+    with gzip.open(f'{path}.gz', 'rb') as source, open(path, 'wb') as target:
+        shutil.copyfileobj(source, target, 1 << 20)
+
+
+class SalesPartitions:
+    # Initializes the partitions of the database behind pool, new partitions each covering one period
+    def __init__(self, db_path, pool, period='month'):
+        partition_of('2000-01-01', period)  # Raises an error for an unknown period
+        self.db_path = db_path  # Initializes database path
+        self.pool = pool  # Pool the sales are written and partitions maintained through
+        self.period = period  # Length of time each new partition covers
+        self.__readers = None  # Pool of connections with the sales view, only opened once there are partitions
+        self.__catalog = (None, ())  # (schema version, partitions in the database) as last read
+        self.__lock = threading.Lock()
+
+    # Lends out a connection for the length of a with block on which sales reads the partitions in the database that
+    # overlap start to end (both inclusive, None leaves that side open), along with the sales table when it holds
+    # sales in that range. Without partitions it is a plain connection from the pool, so an unpartitioned database
+    # pays one PRAGMA per read for this
+    @contextmanager
+    def connection(self, start=None, end=None):
+        with self.pool.connection() as conn:
+            tables = self.__tables(conn, start, end)
+            if tables is None:
+                yield conn
+                return
+        with self.__reader().connection() as conn:
+            _install_view(conn, tables)
+            yield conn
+
+    # Lends out a plain connection with the list of tables holding the sales between start and end, just sales when
+    # the database has no partitions or nothing is in the range, for aggregates worked out one table at a time and
+    # then combined, which keep using each table's indexes where the view reads every column of every matching row
+    @contextmanager
+    def tables(self, start=None, end=None):
+        with self.pool.connection() as conn:
+            tables = self.__tables(conn, start, end)
+            yield conn, ['sales'] if not tables else [f'main.{table}' for table in tables]
+
+    # Returns every partition as Partitions in date order, archived ones included
+    def list(self):
+        with self.pool.connection() as conn:
+            return [Partition(*row) for row in conn.execute(
+                'SELECT name, start_date, end_date, archive FROM sales_partitions ORDER BY start_date, name')]
+
+    # Moves the sales dated before `before`, the start of the current period by default, out of the sales table into
+    # their partitions, creating the ones that don't exist yet, and returns how many were moved. The rollups are left
+    # alone since the sales they count don't change. The sale with the highest sale_id always stays behind as the
+    # sales table hands out IDs one above its highest, and sales falling in an archived partition stay until it is
+    # restored, both are read with the partitions until the next split
+    def split(self, before=None):
+        before = partition_of(datetime.date.today(), self.period).start if before is None else _day(before)
+        with self.pool.write() as conn:  # Keeps sales from being written while they are moved
+            last_id = conn.execute('SELECT MAX(sale_id) FROM main.sales').fetchone()[0]
+            months = [row[0] for row in conn.execute('SELECT DISTINCT substr(date, 1, 7) FROM main.sales '
+                                                     'WHERE date < ? AND sale_id < ?', (before, last_id))]
+            catalog = [Partition(*row) for row in conn.execute(
+                'SELECT name, start_date, end_date, archive FROM sales_partitions')]
+            existing = {partition.name for partition in catalog}
+            targets = {}
+            for month in months:
+                day = f'{month}-01'
+                partition = next((known for known in catalog if known.start <= day < known.end), None)
+                if partition is None:
+                    partition = partition_of(day, self.period)
+                    catalog.append(partition)
+                if partition.archive is None:
+                    targets[partition.name] = partition
+            if not targets:
+                return 0
+
+            columns = ', '.join(_stored_columns(conn, 'sales'))
+            schemas = {name: _partition_schema(conn, name) for name in targets if name not in existing}
+            restore = _drop_triggers(conn, 'sales')  # The moved sales are already in the rollups
+            moved = 0
+            for name, partition in targets.items():
+                indexes = []
+                if name in existing:
+                    restore.extend(_drop_triggers(conn, name))
+                else:
+                    for kind, sql in schemas[name]:
+                        if kind == 'table':
+                            conn.execute(sql)
+                        elif kind == 'index':
+                            indexes.append(sql)  # Built once the moved sales are in, quicker than row by row
+                        else:
+                            restore.append(sql)  # Created once the partition holds the moved sales
+                    conn.execute('INSERT INTO sales_partitions (name, start_date, end_date) VALUES (?, ?, ?)',
+                                 (name, partition.start, partition.end))
+                where = 'WHERE date >= ? AND date < ? AND date < ? AND sale_id < ?'
+                params = (partition.start, partition.end, before, last_id)
+                moved += conn.execute(f'INSERT INTO main.{name} ({columns}) SELECT {columns} FROM main.sales {where}',
+                                      params).rowcount
+                conn.execute(f'DELETE FROM main.sales {where}', params)
+                for sql in indexes:
+                    conn.execute(sql)
+            for sql in restore:
+                conn.execute(sql)
+        return moved
+
+    # Moves a partition out of the database into a compressed SQLite file in directory, '<database>.archive' by
+    # default, and returns the path of the file. Its sales are taken out of the rollups, so until it is restored every
+    # total and chart only counts the sales still in the database
+    def archive(self, name, directory=None):
+        self.__lookup(name, archived=False)
+        directory = directory or f'{self.db_path}.archive'
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{name}.db')
+        if os.path.exists(path):
+            os.remove(path)  # Left behind by an archive that didn't finish
+        with self.pool.connection() as conn:
+            conn.execute('ATTACH DATABASE ? AS archive', (path,))
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute(f'CREATE TABLE archive.sales AS SELECT * FROM main.{name}')
+                conn.execute(f'DELETE FROM main.{name}')  # Fires its triggers, taking the sales out of the rollups
+                conn.execute(f'DROP TABLE main.{name}')
+                conn.execute('UPDATE sales_partitions SET archive = ? WHERE name = ?', (f'{path}.gz', name))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute('DETACH DATABASE archive')
+        _compress(path)
+        return f'{path}.gz'
+
+    # Brings an archived partition back into the database, adding its sales to the rollups again, removes its archive
+    # and returns how many sales it held
+    def restore(self, name):
+        archive = self.__lookup(name, archived=True).archive
+        path = archive[:-len('.gz')] if archive.endswith('.gz') else archive
+        if path != archive and os.path.exists(archive):
+            _decompress(path)  # Otherwise the archive was never compressed and the plain file is read
+        with self.pool.connection() as conn:
+            conn.execute('ATTACH DATABASE ? AS archive', (path,))
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for _, sql in _partition_schema(conn, name):
+                    conn.execute(sql)
+                archived = set(_stored_columns(conn, 'sales', 'archive'))
+                columns = ', '.join(column for column in _stored_columns(conn, 'sales') if column in archived)
+                restored = conn.execute(f'INSERT INTO main.{name} ({columns}) SELECT {columns} FROM archive.sales'
+                                        ).rowcount
+                conn.execute('UPDATE sales_partitions SET archive = NULL WHERE name = ?', (name,))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute('DETACH DATABASE archive')
+        for leftover in {path, archive}:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        return restored
+
+    # Closes the connections opened for reading partitions
+    def close(self):
+        if self.__readers is not None:
+            self.__readers.close()
+
+    # Returns the tables holding the sales between start and end, the sales table only when it has some in that
+    # range, None when the database has no partitions
+    def __tables(self, conn, start, end):
+        online = self.__online(conn)
+        if not online:
+            return None
+        first, last = (None if start is None else _day(start)), (None if end is None else _day(end))
+        tables = ['sales'] if first is None and last is None or _has_sales(conn, first, last) else []
+        tables.extend(partition.name for partition in online
+                      if (first is None or partition.end > first) and (last is None or partition.start <= last))
+        return tables
+
+    # Returns the partitions in the database, reading the catalog again only when the schema has changed, which it
+    # does whenever a partition is created, archived or restored
+    def __online(self, conn):
+        version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        cached_version, online = self.__catalog
+        if version != cached_version:
+            online = tuple(Partition(*row) for row in conn.execute(
+                'SELECT name, start_date, end_date, archive FROM sales_partitions WHERE archive IS NULL '
+                'ORDER BY start_date, name'))
+            self.__catalog = (version, online)
+        return online
+
+    # Returns the pool of connections carrying the sales view, opened like the main pool the first time it is needed
+    def __reader(self):
+        with self.__lock:
+            if self.__readers is None:
+                self.__readers = ConnectionPool(self.db_path, size=self.pool.size, timeout=self.pool.timeout,
+                                                pragmas=self.pool.pragmas, instrumentation=self.pool.instrumentation,
+                                                read_only=self.pool.read_only, busy_timeout=self.pool.busy_timeout,
+                                                retry=self.pool.retry)
+            return self.__readers
+
+    # Returns the catalog entry of a partition, raising an error if it doesn't exist or is (not) archived
+    def __lookup(self, name, archived):
+        partition = next((partition for partition in self.list() if partition.name == name), None)
+        if partition is None:
+            raise ValueError(f"No sales partition named {name}")
+        if (partition.archive is not None) != archived:
+            raise ValueError(f"Sales partition {name} is {'not ' if archived else ''}archived")
+        return partition
@@ -0,0 +1,204 @@
+# Needed libraries
+import argparse
+import math
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ConnectionPool import ConnectionPool, get_pool
+from CreateDatabase import migrate
+from Partitions import SalesPartitions
+from Store import Product, Customer, SalesManager, _sales_filter, pd
+
+'''
+Purpose: Runs a pack of reports such as the end-of-day one at the same time instead of one after another. Each report
+         is a read method of Product, Customer or SalesManager run on a thread over read-only connections, SQLite
+         lets the queries run side by side. Aggregates over every sale are split into ranges of sale_id summed by a
+         pool of processes, each with its own connection, and their partial sums are added up, so the pack scales
+         with the number of cores instead of taking the sum of its steps
+
+Contract: Report: A report's name, the manager it is read from ('products', 'customers' or 'sales'), the method called
+                  and the keyword arguments it is called with, charts have to be given a fmt to be rendered to
+          Aggregate: A report's name, the sales column it groups by (None for one total), the sales columns it sums
+                     and an optional first and last date, the number of sales is always counted
+          END_OF_DAY_REPORTS: The reports of the end-of-day pack
+          ReportRunner(): Runs reports on a database through read-only connections, threads and processes
+          ReportRunner.run(): Runs a list of reports at the same time and returns their results by name
+          ReportRunner.aggregate(): Sums an Aggregate over ranges of sale_id in parallel and merges the partial sums
+'''
+
+Report = namedtuple('Report', ['name', 'manager', 'method', 'kwargs'], defaults=(None,))
+Aggregate = namedtuple('Aggregate', ['name', 'group_by', 'measures', 'start', 'end'],
+                       defaults=(None, ('quantity',), None, None))
+
+DEFAULT_SPLIT_ROWS = 250000  # Fewest sale IDs a process is given, smaller aggregates are summed on one thread
+
+END_OF_DAY_REPORTS = [
+    Report('products', 'products', 'load_products'),
+    Report('customers', 'customers', 'load_customers'),
+    Report('sales', 'sales', 'load_sales'),
+    Report('total_sales', 'sales', 'calculate_total_sales'),
+    Report('sales_per_product', 'sales', 'sales_per_product'),
+    Aggregate('revenue_per_product', 'product_id', ('quantity', 'line_total')),
+    Aggregate('sales_per_customer', 'customer_id', ('quantity',)),
+    Report('product_prices_chart', 'products', 'plot_product_prices', {'fmt': 'png'}),
+    Report('sales_by_product_chart', 'products', 'plot_sales_by_product', {'fmt': 'png'}),
+    Report('customer_contacts_chart', 'customers', 'plot_customer_contact_distribution', {'fmt': 'png'}),
+    Report('sales_over_time_chart', 'sales', 'plot_sales_over_time', {'fmt': 'png'}),
+    Report('sales_by_customer_chart', 'sales', 'plot_sales_by_customer', {'fmt': 'png'}),
+]
+
+
+# Builds the query summing an Aggregate over a range of sale_id, the group first, then each measure and the count,
+# and the parameters following the range, start and end dates are both inclusive just as for the other sales reports
+def _aggregate_query(aggregate):
+    sums = ', '.join(f'COALESCE(SUM({measure}), 0)' for measure in aggregate.measures)
+    where, params = _sales_filter(aggregate.start, aggregate.end)
+    where = ' WHERE sale_id BETWEEN ? AND ?' + where.replace(' WHERE ', ' AND ', 1)
+    selected = f'{sums}, COUNT(*)' if aggregate.group_by is None else f'{aggregate.group_by}, {sums}, COUNT(*)'
+    group = '' if aggregate.group_by is None else f' GROUP BY {aggregate.group_by}'
+    return f'SELECT {selected} FROM sales{where}{group}', tuple(params)
+
+
+# Sums the sales with sale_id from low to high in a worker process through a read-only connection of its own, the
+# sales view covers the partitions between start and end just as it does in the runner
+def _aggregate_range(db_path, query, params, start, end, low, high):
+    pool = ConnectionPool(db_path, size=1, read_only=True)
+    partitions = SalesPartitions(db_path, pool)
+    try:
+        with partitions.connection(start, end) as conn:
+            return conn.execute(query, (low, high, *params)).fetchall()
+    finally:
+        partitions.close()
+        pool.close()
+
+
+# Splits the sale IDs from low to high into at most parts ranges of at least split_rows IDs each
+def _ranges(low, high, parts, split_rows):
+    span = high - low + 1
+    parts = max(1, min(parts, math.ceil(span / split_rows)))
+    step = math.ceil(span / parts)
+    return [(first, min(high, first + step - 1)) for first in range(low, high + 1, step)]
+
+
+class ReportRunner:
+    # Initializes the runner for a database with the number of reports run at once and of processes aggregates are
+    # split across (one per core by default), split_rows is the fewest sale IDs worth sending to a process
+    def __init__(self, db_path, max_workers=4, processes=None, split_rows=DEFAULT_SPLIT_ROWS):
+        if split_rows < 1:
+            raise ValueError("split_rows must be at least 1")  # Raises an error if no range could ever be summed
+        self.db_path = db_path  # Initializes database path
+        self.processes = processes or os.cpu_count() or 1  # Most ranges of sale IDs summed at once
+        self.split_rows = split_rows  # Fewest sale IDs a process is given
+        with get_pool(db_path).connection() as conn:
+            migrate(conn)  # The report connections can't bring the database up to the latest schema themselves
+        self.pool = ConnectionPool(db_path, size=max_workers, read_only=True)  # Reports can never write
+        self.managers = {'products': Product(db_path, self.pool), 'customers': Customer(db_path, self.pool),
+                         'sales': SalesManager(db_path, self.pool)}
+        self.__threads = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='report')
+        self.__workers = None  # Process pool, only started by the first aggregate big enough to split
+
+    # Runs the reports at the same time and returns a dictionary of each report's result by name, in the order given,
+    # raising the error of the first report that failed once they have all finished
+    def run(self, reports):
+        names = [report.name for report in reports]
+        if len(set(names)) != len(names):
+            raise ValueError("Report names must be unique")  # Raises an error if a result would be overwritten
+        calls = [self.__call(report) for report in reports]  # Every report is checked before any of them runs
+        futures = [self.__threads.submit(call) for call in calls]
+        errors = [future.exception() for future in futures]  # Waits for every report
+        failed = next((error for error in errors if error is not None), None)
+        if failed is not None:
+            raise failed
+        return {name: future.result() for name, future in zip(names, futures)}
+
+    # Returns the function producing a report's result, checking the report before anything runs
+    def __call(self, report):
+        if isinstance(report, Aggregate):
+            return lambda: self.aggregate(report)
+        manager = self.managers.get(report.manager)
+        if manager is None:
+            raise ValueError(f"Unknown manager {report.manager!r} for report {report.name}")
+        method = getattr(manager, report.method, None) if not report.method.startswith('_') else None
+        if method is None:
+            raise ValueError(f"Unknown method {report.method!r} for report {report.name}")
+        kwargs = dict(report.kwargs or {})
+        if report.method.startswith('plot_') and kwargs.get('fmt') is None:
+            # Raises an error for a chart that would open a window from a worker thread
+            raise ValueError(f"Chart report {report.name} needs a fmt to be rendered to")
+        return lambda: method(**kwargs)
+
+    # Sums an Aggregate and returns a dataframe indexed by its group with a column per measure and sale_count, or
+    # for group_by=None a series of the totals. Large ranges of sale IDs are split across the process pool
+    def aggregate(self, aggregate):
+        columns = [*aggregate.measures, 'sale_count']
+        partitions = self.managers['sales'].partitions
+        with partitions.tables(aggregate.start, aggregate.end) as (conn, tables):
+            available = {row[1] for row in conn.execute('PRAGMA main.table_xinfo(sales)')}
+            bounds = [conn.execute(f'SELECT MIN(sale_id), MAX(sale_id) FROM {table}').fetchone() for table in tables]
+        unknown = [column for column in [aggregate.group_by, *aggregate.measures]
+                   if column is not None and column not in available]
+        if unknown:
+            raise ValueError(f"Unknown sales columns: {', '.join(unknown)}")  # Column names can't be parameters
+        bounds = [bound for bound in bounds if bound[0] is not None]
+        rows = []
+        if bounds:
+            query, params = _aggregate_query(aggregate)
+            ranges = _ranges(min(low for low, high in bounds), max(high for low, high in bounds), self.processes,
+                             self.split_rows)
+            args = (self.db_path, query, params, aggregate.start, aggregate.end)
+            if len(ranges) == 1:
+                rows = _aggregate_range(*args, *ranges[0])  # Not worth starting a process for
+            else:
+                for partial in self.__process_pool().map(_aggregate_range, *zip(*(args + r for r in ranges))):
+                    rows.extend(partial)
+        if aggregate.group_by is None:
+            totals = [sum(values) for values in zip(*rows)] if rows else [0] * len(columns)
+            return pd.Series(totals, index=columns, name=aggregate.name)
+        frame = pd.DataFrame.from_records(rows, columns=[aggregate.group_by, *columns])
+        return frame.groupby(aggregate.group_by).sum()  # Adds up the groups that were split between ranges
+
+    # Returns the process pool, started on first use. Workers are spawned rather than forked so they never inherit
+    # the locks or connections held by the report threads running at the time
+    def __process_pool(self):
+        if self.__workers is None:
+            self.__workers = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self.__workers
+
+    # Waits for the running reports, stops the threads and processes and closes the read-only connections
+    def close(self):
+        self.__threads.shutdown(wait=True)
+        if self.__workers is not None:
+            self.__workers.shutdown(wait=True)
+        self.managers['sales'].close()
+        self.managers['customers'].partitions.close()
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the end-of-day report pack")
+    parser.add_argument('--db', default='shop.db', help="Database to report on")
+    parser.add_argument('--output', default='reports', help="Folder the charts are saved to as PNG files")
+    parser.add_argument('--processes', type=int, default=None, help="Processes aggregates are split across")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    with ReportRunner(args.db, processes=args.processes) as runner:
+        results = runner.run(END_OF_DAY_REPORTS)
+    for name, result in results.items():
+        if isinstance(result, bytes):
+            path = os.path.join(args.output, f'{name}.png')
+            with open(path, 'wb') as file:
+                file.write(result)  # Saves each chart for the report servers
+            print(f"{name}: saved to {path}")
+        else:
+            print(f"{name}:")
+            print(result)
@@ -0,0 +1,262 @@
+# Needed libraries
+import itertools
+import json
+import os
+import shutil
+
+from Charts import data_versions
+from Store import Product, Customer, SalesManager, DEFAULT_CHUNK_SIZE, pd, np
+
+'''
+Purpose: Copies the sales, products and customers of a database into a columnar snapshot on disk that analysts load
+         into dataframes without ever opening the database, so notebooks don't contend with the tills for it and
+         don't rebuild their dataframes from row tuples on every run. Each column is a flat binary file of its
+         values, read back memory-mapped so numbers and dates reach the dataframe without being copied. Sales are
+         only ever added, so each export appends the sales recorded since the last one, while products and customers
+         are rewritten whenever they changed
+
+Contract: SNAPSHOT_TABLES: The tables a snapshot holds and the key each one is exported in the order of
+          Snapshot(): A snapshot in a directory, exports a database into it and loads its tables as dataframes
+          Snapshot.export(): Appends the new sales and rewrites the changed products and customers, returning the
+                             rows written per table
+          Snapshot.load(): Returns a table of the snapshot as a dataframe over its memory-mapped column files
+          Snapshot.rows(): Returns the number of rows of a table in the snapshot
+'''
+
+SNAPSHOT_TABLES = {'sales': 'sale_id', 'products': 'product_id', 'customers': 'customer_id'}
+DATE_COLUMNS = {'date'}  # TEXT columns holding dates or timestamps, stored as datetime64[s] instead of strings
+
+_MANIFEST = 'manifest.json'
+# The NumPy type each kind of column is stored as, text columns are their UTF-8 bytes and the offset of each value
+_DTYPES = {'int': 'int64', 'real': 'float64', 'date': 'datetime64[s]', 'text': 'int64'}
+
+
+# Returns how a column of a declared SQLite type is stored, following SQLite's rules for a column's type affinity
+def _kind(name, declared):
+    declared = declared.upper()
+    if name in DATE_COLUMNS:
+        return 'date'
+    if 'INT' in declared:
+        return 'int'
+    if any(word in declared for word in ('REAL', 'FLOA', 'DOUB')):
+        return 'real'
+    return 'text'
+
+
+# Returns (name, kind) for every stored column of a table, generated columns such as line_total are left out
+def _columns(conn, table):
+    return [(row[1], _kind(row[1], row[2])) for row in conn.execute(f'PRAGMA main.table_info({table})')]
+
+
+# Returns the paths of the files holding a column, the values (offsets for text), the text bytes and the NULL flags
+def _files(folder, column):
+    return (os.path.join(folder, f'{column}.values'), os.path.join(folder, f'{column}.data'),
+            os.path.join(folder, f'{column}.nulls'))
+
+
+# Cuts a file back to size bytes, dropping whatever an export that failed part way through appended after it
+def _truncate(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+
+
+# Returns a read-only memory map of the first count items of a file, or an empty array when there are none
+def _map(path, dtype, count):
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+
+# Turns a column of values read from the database into the array it is stored as and its NULL flags, None when it
+# has no NULLs. Text comes back as the end offset of each value (start is the end of the one before) and its bytes
+def _encode(kind, values):
+    nulls = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+    if not nulls.any():
+        nulls = None
+    if kind == 'real':
+        return np.array(values, dtype='float64'), None, None  # NULL is NaN
+    if kind == 'date':
+        return np.array(values, dtype='datetime64[s]'), None, None  # NULL is NaT, times of day are kept
+    if kind == 'int':
+        ints = np.fromiter((0 if value is None else value for value in values), dtype='int64', count=len(values))
+        return ints, None, nulls
+    encoded = [b'' if value is None else str(value).encode() for value in values]
+    ends = np.cumsum(np.fromiter(map(len, encoded), dtype='int64', count=len(encoded)), dtype='int64')
+    return ends, b''.join(encoded), nulls
+
+
+# Appends rows to the column files of a table in folder and updates its entry in the manifest, the manifest is only
+# saved afterwards so a failed append is ignored by readers and cut off by the next export
+def _append(folder, entry, rows):
+    count = entry['rows']
+    for index, (column, kind) in enumerate(entry['columns']):
+        values, data, nulls = _encode(kind, [row[index] for row in rows])
+        values_path, data_path, nulls_path = _files(folder, column)
+        if kind == 'text':
+            size = entry['bytes'][column]
+            values += size  # Offsets carry on from the bytes already stored
+            entry['bytes'][column] = int(values[-1])
+            with open(data_path, 'ab') as file:
+                file.write(data)
+        with open(values_path, 'ab') as file:
+            file.write(values.tobytes())
+        if nulls is not None or column in entry['nullable']:
+            if column not in entry['nullable']:
+                np.zeros(count, dtype=bool).tofile(nulls_path)  # The rows before the first NULL had none
+                entry['nullable'].append(column)
+            with open(nulls_path, 'ab') as file:
+                file.write((nulls if nulls is not None else np.zeros(len(rows), dtype=bool)).tobytes())
+    entry['rows'] = count + len(rows)
+
+
+# Cuts the column files of a table back to the rows its manifest entry records
+def _repair(folder, entry):
+    for column, kind in entry['columns']:
+        values_path, data_path, nulls_path = _files(folder, column)
+        _truncate(values_path, entry['rows'] * np.dtype(_DTYPES[kind]).itemsize)
+        if kind == 'text':
+            _truncate(data_path, entry['bytes'][column])
+        _truncate(nulls_path, entry['rows'] if column in entry['nullable'] else 0)
+
+
+# Returns a new manifest entry for a table stored in folder with the given columns
+def _new_entry(folder, columns):
+    return {'folder': folder, 'columns': [list(column) for column in columns], 'rows': 0, 'last_id': None,
+            'version': None, 'nullable': [], 'bytes': {column: 0 for column, kind in columns if kind == 'text'}}
+
+
+class Snapshot:
+    # Initializes the snapshot kept in directory, which is created by the first export
+    def __init__(self, directory):
+        self.directory = directory  # Folder holding the manifest and a folder of column files per table
+
+    # Returns the manifest, the entry of each table exported so far
+    def __manifest(self):
+        path = os.path.join(self.directory, _MANIFEST)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+    # Saves the manifest in one step, readers see either the old one or the new one
+    def __save(self, manifest):
+        path = os.path.join(self.directory, _MANIFEST)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(path + '.tmp', path)
+
+    # Appends the sales recorded since the last export, rewrites products and customers if they changed since, and
+    # returns the number of rows written per table. Reads go through pooled connections chunk_size rows at a time so
+    # the tills are never held up for long, sales already in archived partitions are only exported while online
+    def export(self, db_path, pool=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self.__manifest()
+        written = {}
+        sales_manager = SalesManager(db_path, pool)
+        try:
+            for table, key in SNAPSHOT_TABLES.items():
+                if table == 'sales':
+                    written[table] = self.__append_sales(manifest, sales_manager, chunk_size)
+                else:
+                    manager = Product(db_path, pool) if table == 'products' else Customer(db_path, pool)
+                    written[table] = self.__rewrite(manifest, table, key, manager, chunk_size)
+        finally:
+            sales_manager.close()
+        return written
+
+    # Appends the sales after the last one exported to the sales column files
+    def __append_sales(self, manifest, sales_manager, chunk_size):
+        with sales_manager.pool.connection() as conn:
+            columns = _columns(conn, 'sales')
+        entry = manifest.get('sales')
+        if entry is not None and entry['columns'] != [list(column) for column in columns]:
+            raise ValueError("The sales columns changed since the last export, export into a new snapshot")
+        if entry is None:
+            entry = _new_entry('sales', columns)
+            os.makedirs(os.path.join(self.directory, 'sales'), exist_ok=True)
+        folder = os.path.join(self.directory, entry['folder'])
+        _repair(folder, entry)
+        rows = sales_manager.iter_sales(chunk_size, [column for column, kind in columns], entry['last_id'],
+                                        as_frame=False)
+        written = 0
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            _append(folder, entry, chunk)
+            entry['last_id'] = chunk[-1][0]
+            manifest['sales'] = entry
+            self.__save(manifest)  # Each chunk is kept even if a later one fails
+            written += len(chunk)
+        manifest['sales'] = entry
+        self.__save(manifest)
+        return written
+
+    # Writes every row of a table into a new folder when its version moved since the last export, then points the
+    # manifest at it and removes the old folder, returns the rows written, 0 when the table hadn't changed
+    def __rewrite(self, manifest, table, key, manager, chunk_size):
+        with manager.pool.connection() as conn:
+            columns = _columns(conn, table)
+            version = dict(data_versions(conn, (table,)))[table]
+        old = manifest.get(table)
+        if old is not None and old['version'] == version and old['columns'] == [list(column) for column in columns]:
+            return 0
+        entry = _new_entry(f'{table}.{version}', columns)
+        folder = os.path.join(self.directory, entry['folder'])
+        shutil.rmtree(folder, ignore_errors=True)  # Leftovers of a rewrite that failed part way through
+        os.makedirs(folder)
+        iterate = manager.iter_products if table == 'products' else manager.iter_customers
+        rows = iterate(chunk_size, [column for column, kind in columns], as_frame=False)
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            _append(folder, entry, chunk)
+            entry['last_id'] = chunk[-1][0]
+        entry['version'] = version
+        manifest[table] = entry
+        self.__save(manifest)
+        if old is not None and old['folder'] != entry['folder']:
+            shutil.rmtree(os.path.join(self.directory, old['folder']), ignore_errors=True)
+        return entry['rows']
+
+    # Returns the manifest entry of a table, raising an error if it hasn't been exported
+    def __entry(self, table):
+        entry = self.__manifest().get(table)
+        if entry is None:
+            raise ValueError(f"No {table} in the snapshot at {self.directory}")
+        return entry
+
+    # Returns the number of rows of a table in the snapshot
+    def rows(self, table):
+        return self.__entry(table)['rows']
+
+    # Returns a table as a dataframe, optionally only the given columns. Numbers and dates are memory-mapped and
+    # handed to the dataframe without a copy, so only the pages used are read, integer columns holding NULLs come
+    # back as nullable Int64 and text columns are decoded into strings
+    def load(self, table, columns=None):
+        entry = self.__entry(table)
+        folder = os.path.join(self.directory, entry['folder'])
+        kinds = dict(entry['columns'])
+        columns = list(kinds) if columns is None else list(columns)
+        unknown = [column for column in columns if column not in kinds]
+        if unknown:
+            raise ValueError(f"Unknown {table} columns: {', '.join(unknown)}")
+        count = entry['rows']
+        frame = {}
+        for column in columns:
+            kind = kinds[column]
+            values_path, data_path, nulls_path = _files(folder, column)
+            values = _map(values_path, _DTYPES[kind], count)
+            nulls = _map(nulls_path, bool, count) if column in entry['nullable'] else None
+            if kind == 'text':
+                frame[column] = self.__text(data_path, values, nulls, entry['bytes'][column])
+            elif nulls is not None and kind == 'int':
+                frame[column] = pd.arrays.IntegerArray(np.asarray(values), np.asarray(nulls))
+            else:
+                frame[column] = np.asarray(values)
+        return pd.DataFrame(frame, columns=columns, copy=False)
+
+    # Decodes a text column from the end offset of each value and the bytes they index into
+    @staticmethod
+    def __text(data_path, ends, nulls, size):
+        data = bytes(_map(data_path, 'uint8', size)) if size else b''
+        starts = itertools.chain((0,), ends[:-1].tolist())
+        strings = [data[start:end].decode() for start, end in zip(starts, ends.tolist())]
+        if nulls is not None:
+            strings = [None if null else string for string, null in zip(strings, nulls.tolist())]
+        return pd.array(strings, dtype='str')
@@ -1,125 +1,418 @@
 # Needed libraries
 import sqlite3
 import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
+import itertools
+import queue
+import threading
+import time
+import atexit
+import heapq
+import importlib
+import weakref
+from collections import namedtuple
+from concurrent.futures import Future
+from ConnectionPool import get_pool, apply_pragmas, retry_locked, HIGH_THROUGHPUT_PRAGMAS
+from ConnectionPool import DEFAULT_BUSY_TIMEOUT, DEFAULT_RETRY
+from CreateDatabase import migrate, rebuild_rollups, check_rollups, area_code_sql
+from Cache import get_cache
+from Charts import plot
+from Partitions import SalesPartitions
+
+DEFAULT_CHUNK_SIZE = 10000  # Number of rows the bulk insert methods send to executemany at a time
+DEFAULT_CACHE_SIZE = 4096  # Products or customers kept in the lookup cache of each database
+DEFAULT_CACHE_TTL = 60.0  # Seconds a cached row is trusted, bounds staleness from writes made by other processes
+LOOKUP_CHUNK_SIZE = 500  # IDs sent in each IN (...) query by the batch lookups, well under SQLite's variable limit
+
+
+# Stands in for a module that is only imported the first time one of its attributes is used, so processes that only
+# record and look up rows never pay for loading pandas
+class _LazyModule:
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attribute)
+
+
+pd = _LazyModule('pandas')  # Used like 'import pandas as pd', loaded by the first dataframe method called
+np = _LazyModule('numpy')  # Used like 'import numpy as np', loaded by the first time-series method called
+
+'''
+Purpose: Lightweight read-only records returned by every read method, plain tuples with named fields that can't be
+         changed, are shared safely between callers and the caches, and take no per-record __dict__
+
+Contract: ProductRecord: A product's product_id, name and price
+          CustomerRecord: A customer's customer_id, name and contact
+          SaleRecord: A recorded sale's sale_id, product_id, customer_id, quantity and date
+          PerishableRecord: A perishable product's product_id, name, price and expiry_date in Y-M-D format
+          BatchLookup: The records found by a batch lookup in the order the IDs were given, None where an ID wasn't
+                       found, along with the list of IDs that weren't found
+          SalesSeries: NumPy arrays of the start of each period as datetime64 with the quantity and number of sales
+                       in it
+          RollingSales: NumPy arrays of the periods, their quantities and the mean quantity of the window ending on
+                        each one, NaN until a full window is available
+          LotRecord: A lot of a perishable product's lot_id, product_id, quantity and expiry_date in Y-M-D format
+          ExpiryReport: NumPy arrays of the days each lot has left, whether it has expired and whether it expires
+                        within the warning window
+          Markdowns: NumPy arrays of the lots due a markdown with their product_id, days left, discount, and price
+                     after the discount
+          YearOverYear: NumPy arrays of the periods, their quantities, the quantity of the same period a year
+                        earlier and the change from it as a fraction, NaN where there is nothing to compare against
+          Ranking: A product's or customer's id, name, quantity and number of sales in a top or bottom list, the name
+                   is None in a Leaderboard and for IDs no longer in the database
+          Margin: The revenue and cost of the sales whose cost is known, the margin between them and the margin as a
+                  fraction of the revenue
+          VersionedRecord: A ProductRecord or CustomerRecord read straight from the database with the version it is
+                           at, handed back to an update so it is refused if the row changed in between
+          ConflictError: Raised by an update given a version the row has moved on from since it was read
+'''
+
+ProductRecord = namedtuple('ProductRecord', ['product_id', 'name', 'price'])
+CustomerRecord = namedtuple('CustomerRecord', ['customer_id', 'name', 'contact'])
+SaleRecord = namedtuple('SaleRecord', ['sale_id', 'product_id', 'customer_id', 'quantity', 'date'])
+PerishableRecord = namedtuple('PerishableRecord', ['product_id', 'name', 'price', 'expiry_date'])
+BatchLookup = namedtuple('BatchLookup', ['records', 'missing'])
+SalesSeries = namedtuple('SalesSeries', ['periods', 'quantity', 'sale_count'])
+RollingSales = namedtuple('RollingSales', ['periods', 'quantity', 'mean'])
+YearOverYear = namedtuple('YearOverYear', ['periods', 'quantity', 'previous', 'change'])
+LotRecord = namedtuple('LotRecord', ['lot_id', 'product_id', 'quantity', 'expiry_date'])
+ExpiryReport = namedtuple('ExpiryReport', ['days_left', 'expired', 'expiring'])
+Markdowns = namedtuple('Markdowns', ['lot_id', 'product_id', 'days_left', 'discount', 'price'])
+Ranking = namedtuple('Ranking', ['id', 'name', 'quantity', 'sale_count'])
+Margin = namedtuple('Margin', ['revenue', 'cost', 'margin', 'rate'])
+VersionedRecord = namedtuple('VersionedRecord', ['record', 'version'])
+
+
+# Raised when an update is given the version a row was read at and somebody else has updated or deleted it since,
+# read the row again and redo the change on top of theirs
+class ConflictError(Exception):
+    pass
+
+
+_FIRST_KEY = -2 ** 63  # Smallest key SQLite can store, so paging starts before every row
+
+_migrated_pools = weakref.WeakSet()  # Pools whose database has already been brought up to the latest schema
+_migrated_lock = threading.Lock()
+
+
+# Returns the pool a manager uses, the shared one unless it was given its own, bringing the database up to the
+# latest schema the first time the pool is used so existing databases are migrated in place
+def _prepare_pool(db_path, pool):
+    pool = pool if pool is not None else get_pool(db_path)
+    with _migrated_lock:
+        if pool not in _migrated_pools:
+            with pool.connection() as conn:
+                migrate(conn)
+            _migrated_pools.add(pool)
+    return pool
+
+
+# Inserts rows in chunks with executemany inside the write transaction of conn, from ConnectionPool.write(), and
+# returns the range of IDs they were given. The transaction holds the write lock from its start so no other writer
+# can take IDs in between, making the new IDs one unbroken run
+def _insert_many(conn, table, key, sql, rows, chunk_size):
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1")  # Raises an error if no rows could ever be sent
+    first_id = conn.execute(f'SELECT COALESCE(MAX({key}), 0) + 1 FROM {table}').fetchone()[0]
+    count = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))  # Pulls the next chunk without loading the rest
+        if not chunk:
+            break
+        conn.executemany(sql, chunk)
+        count += len(chunk)
+    return range(first_id, first_id + count)  # IDs of the inserted rows in the order they were given
+
+
+# Updates one row of a table with a version column in a write transaction, moving its version on, and returns the
+# new version, None when the row doesn't exist. Given the version the row was read at (expected), the row is only
+# updated if it is still at that version, otherwise the conflict is counted and a ConflictError raised
+def _update_versioned(pool, table, key, assignments, params, row_id, expected):
+    condition = f'{key} = ?' if expected is None else f'{key} = ? AND version = ?'
+    params = (*params, row_id) if expected is None else (*params, row_id, expected)
+    with pool.write() as conn:
+        row = conn.execute(f'UPDATE {table} SET {assignments}, version = version + 1 WHERE {condition} '
+                           'RETURNING version', params).fetchone()
+    if row is None and expected is not None:
+        pool.write_stats.add('conflicts')
+        raise ConflictError(f"{key} {row_id} in {table} was changed or deleted since version {expected} was read")
+    return row[0] if row is not None else None
+
 
 '''
 Purpose: Manages products in a database for a grocery store consisting of functions for CRUD operations on the products
          and functions to generate visual plots based on the product data stored in the database 
 
-Contact: add_product(): Adds a product to the database with it's name and price 
-         get_product(): Gets and returns the given product information such as name and price 
-         update_product(): Updates the products to whatever is given to it 
+Contact: add_product(): Adds a product to the database with it's name and price and returns its product_id
+         add_products(): Adds many (name, price) products in one transaction and returns their IDs
+         get_product(): Gets and returns the given product information such as name and price as a ProductRecord,
+                        served from a shared cache that update_product(), update_price() and delete_product()
+                        invalidate
+         get_products(): Gets many products at once in input order, reporting the IDs that weren't found
+         get_versioned_product(): Reads a product with its version for an update that mustn't overwrite another one
+         update_product(): Updates the product to the ProductRecord given to it and returns its new version, refused
+                           with a ConflictError when given a version the product has moved on from
          delete_product(): Removes a product from the database 
-         update_price(): Sets a new updated price for the product updating the database  
+         update_price(): Sets a new updated price for the product updating the database, checked against a version
+                         like update_product()
+         update_cost(): Sets what the store pays for the product, recorded on its sales from then on for margins
          load_products(): Gets all the products and returns them as a dataframe 
-         plot_product_prices(): Creates a bar chart of all products and their prices
-         plot_sales_by_product(): Creates a bar chart displaying total sales amount by product
+         iter_products(): Yields the products in chunks as dataframes or records, reading one chunk at a time
+         plot_product_prices(): Creates a bar chart of all products and their prices, shown or returned as PNG/SVG bytes
+         plot_sales_by_product(): Creates a bar chart displaying total sales amount by product, shown or returned
+                                  as PNG/SVG bytes
          
 '''
 
 
+# Yields the rows of a table in primary key order, reading chunk_size rows per query, as dataframes or as records
+# (plain row tuples when only some columns are asked for). Each query starts after the last key of the one before
+# (keyset pagination), so reading a chunk costs the same however far into the table it is, and a pooled connection
+# is only borrowed while one chunk is being read
+def _iter_table(connect, table, key, record, columns, chunk_size, after_id, as_frame):
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1")  # Raises an error if no rows could ever be read
+    with connect() as conn:
+        available = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    make_record = record._make if columns is None else None  # Full rows come back as records
+    columns = list(columns) if columns is not None else list(record._fields)
+    unknown = [column for column in columns if column not in available]
+    if unknown:
+        raise ValueError(f"Unknown {table} columns: {', '.join(unknown)}")  # Column names can't be parameters
+
+    selected = columns if key in columns else [key] + columns  # The key is always read to find the next chunk
+    key_index = selected.index(key)
+    query = f'SELECT {", ".join(selected)} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?'
+    last = _FIRST_KEY if after_id is None else after_id
+    while True:
+        with connect() as conn:
+            rows = conn.execute(query, (last, chunk_size)).fetchall()
+        if not rows:
+            return
+        last = rows[-1][key_index]  # Next chunk starts after the last key of this one
+        if key not in columns:
+            rows = [row[1:] for row in rows]  # Drops the key again when it wasn't asked for
+        if as_frame:
+            yield pd.DataFrame.from_records(rows, columns=columns)
+        elif make_record is not None:
+            yield from map(make_record, rows)
+        else:
+            yield from rows
+        if len(rows) < chunk_size:
+            return
+
+
+# Looks up many rows by ID through a cache, reading the IDs it doesn't hold in chunked IN (...) queries, and returns a
+# BatchLookup with one record per ID in the order given and the IDs that weren't found
+def _lookup_many(connect, cache, query, record, ids, chunk_size):
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1")  # Raises an error if no IDs could ever be sent
+    ids = list(ids)
+
+    # Reads the IDs missing from the cache, chunk_size per query, in one borrowed connection
+    def load_many(missing):
+        loaded = {}
+        with connect() as conn:
+            for start in range(0, len(missing), chunk_size):
+                chunk = missing[start:start + chunk_size]
+                placeholders = ', '.join('?' * len(chunk))
+                for row in conn.execute(query.format(placeholders=placeholders), chunk):
+                    loaded[row[0]] = record(*row)
+        return loaded
+
+    found = cache.get_or_load_many(ids, load_many)
+    records = [found.get(record_id) for record_id in ids]  # Keeps the order the IDs were given in
+    missing = [record_id for record_id in dict.fromkeys(ids) if record_id not in found]
+    return BatchLookup(records, missing)
+
+
+# Name and price of every product for the price chart
+PRODUCT_PRICES_QUERY = 'SELECT name, price FROM products'
+
+# Total quantity sold of each product, highest first, read from the daily product rollup instead of every sale
+SALES_BY_PRODUCT_QUERY = '''
+SELECT p.name, SUM(s.quantity) AS total_sold
+FROM products p JOIN sales_daily_product s ON p.product_id = s.product_id
+GROUP BY p.product_id
+ORDER BY total_sold DESC
+'''
+
+
 class Product:
-    # Initializes product class with path to the database
-    def __init__(self, db_path):
+    # Initializes product class with path to the database, the connection pool and the lookup cache shared by that
+    # database, pass LRUCache(maxsize=0) as the cache to turn caching off
+    def __init__(self, db_path, pool=None, cache=None):
         self.db_path = db_path  # Initializes database path
+        self.pool = _prepare_pool(db_path, pool)  # Initializes the shared connection pool
+        self.cache = cache if cache is not None else get_cache(
+            db_path, 'products', maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL)  # Initializes the lookup cache
+        # Details used by the write methods when they aren't given any, reads never change them
         self.product_id = None  # Initializes product_id
-        self.name = None  # Initializes product name being private
-        self.price = None  # Initializes product price being private
+        self.name = None  # Initializes product name
+        self.price = None  # Initializes product price
 
-    # Create a connection to the database
+    # Borrows a connection from the pool, it is committed and handed back when the with block ends
     def __connect(self):
-        return sqlite3.connect(self.db_path)  # Returns the connection
-
-    # Adds a product to the database
-    def add_product(self):
-        with self.__connect() as conn:
+        return self.pool.connection()  # Returns the pooled connection
+
+    # Borrows a connection in a write transaction, retried while another lane holds the database's write lock
+    def __write(self):
+        return self.pool.write()
+
+    # Adds a product to the database with the given name and price, or the ones set on the manager, and returns its
+    # new product_id
+    def add_product(self, name=None, price=None):
+        if name is None and price is None:
+            name, price = self.name, self.price  # Uses the details set on the manager
+        with self.__write() as conn:
             cursor = conn.cursor()  # Creates a cursor
             # Executes command to add the product to the database
-            cursor.execute('INSERT INTO products (name, price) VALUES (?, ?)', (self.name, self.price))
-            conn.commit()  # Commits the changes
-
-    # Gets a product based on the product_id from the database and updated the initialized variables
+            cursor.execute('INSERT INTO products (name, price) VALUES (?, ?)', (name, price))
+            return cursor.lastrowid  # Returns the product_id the database gave it
+
+    # Adds many (name, price) products in one transaction, sending them in chunks, and returns their new IDs
+    def add_products(self, products, chunk_size=DEFAULT_CHUNK_SIZE):
+        with self.__write() as conn:
+            rows = ((name, price) for name, price in products)
+            return _insert_many(conn, 'products', 'product_id', 'INSERT INTO products (name, price) VALUES (?, ?)',
+                                rows, chunk_size)
+
+    # Gets a product based on the product_id from the cache or the database as a ProductRecord, None if it doesn't
+    # exist
     def get_product(self, product_id):
+        return self.cache.get_or_load(product_id, self.__load_product)  # Only reads the database on a cache miss
+
+    # Reads a product row from the database for the cache
+    def __load_product(self, product_id):
         with self.__connect() as conn:
             cursor = conn.cursor()  # Creates a cursor
             # Gets the columns of product_id that matches
-            cursor.execute('SELECT * FROM products WHERE product_id = ?', (product_id,))
+            cursor.execute('SELECT product_id, name, price FROM products WHERE product_id = ?', (product_id,))
             row = cursor.fetchone()  # Gets the first row of the results after cursor execution
-            # Checks if any row exists/retrieved
-            if row:
-                self.product_id, self.__name, self.__price = row  # If row exists set the product data to self attributes
-                return self  # Returns the product data retrieved from the database
-            return None  # If product doesn't exist, return nothing
-
-    # Updates the details of a product in the database
-    def update_product(self):
-        with self.__connect() as conn:
-            cursor = conn.cursor()  # Creates a cursor
-            # Executes command to update a product details in the database
-            cursor.execute('UPDATE products SET name = ?, price = ? WHERE product_id = ?',
-                           (self.__name, self.__price, self.product_id))
-            conn.commit()  # Commits the changes to the database
-
-    # Deletes a product based on the product_id from the database
-    def delete_product(self):
+            return ProductRecord(*row) if row else None
+
+    # Gets many products by product_id in one query per chunk of IDs, returning a BatchLookup of ProductRecords in
+    # the order the IDs were given, None where an ID wasn't found, and the list of IDs that weren't found
+    def get_products(self, product_ids, chunk_size=LOOKUP_CHUNK_SIZE):
+        return _lookup_many(self.__connect, self.cache,
+                            'SELECT product_id, name, price FROM products WHERE product_id IN ({placeholders})',
+                            ProductRecord, product_ids, chunk_size)
+
+    # Reads a product and the version it is at straight from the database, bypassing the cache, as a VersionedRecord
+    # to pass the version of to an update, None if it doesn't exist
+    def get_versioned_product(self, product_id):
         with self.__connect() as conn:
+            row = conn.execute('SELECT product_id, name, price, version FROM products WHERE product_id = ?',
+                               (product_id,)).fetchone()
+        return VersionedRecord(ProductRecord(*row[:3]), row[3]) if row else None
+
+    # Updates the details of a product in the database from a ProductRecord, or from the details set on the manager,
+    # and returns its new version. Given the version the product was read at, the update is refused with a
+    # ConflictError if someone else changed it since, without one the last update wins
+    def update_product(self, product=None, version=None):
+        if product is None:
+            product = ProductRecord(self.product_id, self.name, self.price)  # Uses the details set on the manager
+        try:
+            return _update_versioned(self.pool, 'products', 'product_id', 'name = ?, price = ?',
+                                     (product.name, product.price), product.product_id, version)
+        finally:
+            self.cache.invalidate(product.product_id)  # Drops the old details, also when they turned out stale
+
+    # Deletes a product based on the product_id, or the one set on the manager, from the database
+    def delete_product(self, product_id=None):
+        if product_id is None:
+            product_id = self.product_id  # Uses the product_id set on the manager
+        with self.__write() as conn:
             cursor = conn.cursor()  # Creates a cursor
             # Executes command to delete the product from the database
-            cursor.execute('DELETE FROM products WHERE product_id = ?', (self.product_id,))
-            conn.commit()  # Commits the changes to the database
+            cursor.execute('DELETE FROM products WHERE product_id = ?', (product_id,))
+        self.cache.invalidate(product_id)  # Stops the deleted product being served from the cache
 
-    # Sets a new price for the product in the database
-    def update_price(self, new_price):
+    # Sets a new price for the product, or the one set on the manager, in the database and returns its new version,
+    # refused with a ConflictError when given a version the product has moved on from like update_product()
+    def update_price(self, new_price, product_id=None, version=None):
         # Ensures that the new_price is greater than 0 since price can't be negative
         if new_price > 0:
-            self.__price = new_price  # Sets the price to the new price
-            self.update_product()  # Updates the product with the new price
+            if product_id is None:
+                product_id = self.product_id  # Uses the product_id set on the manager
+            try:
+                # Only the price changes so the rest of the product never has to be read first
+                return _update_versioned(self.pool, 'products', 'product_id', 'price = ?', (new_price,), product_id,
+                                         version)
+            finally:
+                self.cache.invalidate(product_id)  # Drops the old price once the new one is committed
         else:
             raise ValueError("New price must be positive")  # Raises an error if the given price is negative
 
+    # Sets the unit cost of a product, the one set on the manager by default, sales recorded afterwards keep it for
+    # their margin, sales already recorded keep the cost they were made at. Returns the product's new version and
+    # checks a given version like update_product()
+    def update_cost(self, new_cost, product_id=None, version=None):
+        if new_cost < 0:
+            raise ValueError("New cost can't be negative")  # Raises an error if the given cost is negative
+        if product_id is None:
+            product_id = self.product_id  # Uses the product_id set on the manager
+        return _update_versioned(self.pool, 'products', 'product_id', 'cost = ?', (new_cost,), product_id, version)
+
     # Gets all the products from the database and returns them as a dataframe
     def load_products(self):
         with self.__connect() as conn:
             return pd.read_sql('SELECT * FROM products', conn)
 
-    # Plots a bar chart of the products with their prices
-    def plot_product_prices(self):
-        with self.__connect() as conn:
-            # Gets the products and creates a dataframe from them
-            df = pd.read_sql_query('SELECT name, price FROM products', conn)
-
-        plt.figure(figsize=(8, 5))  # Sets the figure size
-        plt.bar(df['name'], df['price'],
-                color='blue')  # Gets the name and price of the products to plot with color blue
-        plt.xlabel('Product')  # Sets the X axis to 'Product'
-        plt.ylabel('Price ($)')  # Sets the Y axis to 'Price ($)'
-        plt.title('Price Across Products')  # Sets the title of the chart to 'Price Across Products'
-        plt.xticks(rotation=90)  # Sets X axis labels rotated to 90º
-        plt.show()  # Displays the chart
-
-    # Plots a bar chart showing the total sales amount by product
-    def plot_sales_by_product(self):
-        with self.__connect() as conn:
-            # Gets the products and sum of the amount sold, joining the tables giving each product sum its own ID
-            # Ordering it from highest to lowest putting it in the dataframe to plot
-            query = '''
-            SELECT p.name, SUM(s.quantity) AS total_sold
-            FROM products p JOIN sales s ON p.product_id = s.product_id
-            GROUP BY p.product_id
-            ORDER BY total_sold DESC
-            '''
-            df = pd.read_sql_query(query, conn)
-
-        plt.figure(figsize=(10, 6))  # Sets the figure size
-        plt.bar(df['name'], df['total_sold'],
-                color='purple')  # Gets the name and total_sold from the dataframe plotting them purple
-        plt.xlabel('Product')  # Sets the X axis to 'Product'
-        plt.ylabel('Total Amount Sold')  # Sets the Y axis to 'Total Amount Sold'
-        plt.title('Total Sales by Products')  # Sets the title of the chart to 'Total Sales by Products'
-        plt.xticks(rotation=90)  # Sets X axis labels rotated to 90º
-        plt.show()  # Displays the chart
+    # Yields the products chunk_size at a time in product_id order, as dataframes or as ProductRecords with
+    # as_frame=False, optionally only the given columns and only products after after_id
+    def iter_products(self, chunk_size=DEFAULT_CHUNK_SIZE, columns=None, after_id=None, as_frame=True):
+        return _iter_table(self.__connect, 'products', 'product_id', ProductRecord, columns, chunk_size, after_id,
+                           as_frame)
+
+    # Plots a bar chart of the products with their prices, shown in a window or, given fmt='png' or 'svg', returned
+    # as image bytes that are cached until the products change
+    def plot_product_prices(self, fmt=None):
+        # Gets the products and creates a dataframe from them
+        def load(conn):
+            return pd.read_sql_query(PRODUCT_PRICES_QUERY, conn)
+
+        def draw(ax, df):
+            ax.bar(df['name'], df['price'],
+                   color='blue')  # Gets the name and price of the products to plot with color blue
+            ax.set_xlabel('Product')  # Sets the X axis to 'Product'
+            ax.set_ylabel('Price ($)')  # Sets the Y axis to 'Price ($)'
+            ax.set_title('Price Across Products')  # Sets the title of the chart to 'Price Across Products'
+            ax.tick_params(axis='x', labelrotation=90)  # Sets X axis labels rotated to 90º
+
+        return plot(self.db_path, self.__connect, 'product_prices', ('products',), load, draw, (8, 5), fmt)
+
+    # Plots a bar chart showing the total sales amount by product, shown in a window or returned as cached image bytes
+    # top=N only plots the N best sellers, read off the all-time totals index instead of sorting every product
+    def plot_sales_by_product(self, fmt=None, top=None):
+        # Gets the products and sum of the amount sold, joining the tables giving each product sum its own ID
+        # Ordering it from highest to lowest putting it in the dataframe to plot
+        def load(conn):
+            if top is None:
+                return pd.read_sql_query(SALES_BY_PRODUCT_QUERY, conn)
+            return _ranking_frame(_ranking(conn, 'product', top), 'Product', 'total_sold')
+
+        def draw(ax, df):
+            ax.bar(df['name'], df['total_sold'],
+                   color='purple')  # Gets the name and total_sold from the dataframe plotting them purple
+            ax.set_xlabel('Product')  # Sets the X axis to 'Product'
+            ax.set_ylabel('Total Amount Sold')  # Sets the Y axis to 'Total Amount Sold'
+            ax.set_title('Total Sales by Products')  # Sets the title of the chart to 'Total Sales by Products'
+            ax.tick_params(axis='x', labelrotation=90)  # Sets X axis labels rotated to 90º
+
+        name = 'sales_by_product' if top is None else f'sales_by_product_top_{top}'
+        return plot(self.db_path, self.__connect, name, ('products', 'sales'), load, draw, (10, 6), fmt)
+
+
+# Turns Rankings into the name and quantity dataframe the bar charts plot, IDs no longer in the database are labelled
+# with the kind of row and their ID
+def _ranking_frame(rankings, kind, column):
+    return pd.DataFrame({'name': [ranking.name or f'{kind} {ranking.id}' for ranking in rankings],
+                         column: [ranking.quantity for ranking in rankings]})
 
 
 '''
@@ -128,6 +421,8 @@ Purpose: Extends the Product class to manage perishable products separating from
          
 Contract: is_expired(): Returns True or False whether the product is expired or not 
           get_expiry_date(): Returns the expiration date in Y-M-D format 
+          to_record(): Returns the product's details as a PerishableRecord
+          save_lot(): Records a lot of the product with its expiration date in the database and returns its lot_id
 '''
 
 
@@ -149,212 +444,1096 @@ class PerishableProduct(Product):
     def get_expiry_date(self):
         return self.__expiry_date.strftime("%Y-%m-%d")  # Returns the expiration date
 
+    # Returns the product's details as a PerishableRecord
+    def to_record(self):
+        return PerishableRecord(self.product_id, self.name, self.price, self.get_expiry_date())
+
+    # Records a lot of quantity units of the product expiring on its expiration date and returns the lot_id
+    def save_lot(self, quantity):
+        return PerishableInventory(self.db_path, pool=self.pool).add_lot(self.product_id, quantity,
+                                                                         self.get_expiry_date())
+
+
+# Markdown schedule of (days left, discount) in order of days left, a lot gets the discount of the first entry its
+# days left are within
+DEFAULT_MARKDOWNS = ((1, 0.5), (3, 0.3), (7, 0.1))
+
+
+# Checks the expiry of a whole inventory at once, expiry_dates being 'YYYY-MM-DD' strings or datetime64 values, and
+# returns an ExpiryReport of NumPy arrays. Like is_expired(), a lot counts as expired from the start of its expiry
+# date, and it is expiring when it has at most warning_days days left
+def evaluate_expiry(expiry_dates, as_of=None, warning_days=0):
+    today = np.datetime64(_date_text(as_of or datetime.date.today()), 'D')
+    days_left = (np.asarray(expiry_dates, dtype='datetime64[D]') - today).astype(np.int64)
+    expired = days_left <= 0
+    return ExpiryReport(days_left, expired, ~expired & (days_left <= warning_days))
+
+
+'''
+Purpose: Keeps the stock of perishable products as lots in the database, each with a quantity and an expiry date, so
+         the markdown job can find what is expiring or expired through the expiry date index and price a whole
+         inventory at once with NumPy instead of checking one PerishableProduct at a time
+
+Contract: add_lot(): Records a lot of a product with its quantity and expiry date and returns its lot_id
+          add_lots(): Records many (product_id, quantity, expiry_date) lots in one transaction and returns their IDs
+          remove_lot(): Removes a lot that was sold through or thrown away
+          expiring_within(): Returns the lots that expire within a number of days as LotRecords, soonest first
+          expired(): Returns the lots that have expired as of a date as LotRecords, oldest first
+          load_lots(): Returns every lot's lot_id, product_id, quantity and expiry date as NumPy arrays
+          evaluate(): Returns the ExpiryReport of every lot
+          markdowns(): Returns the discount and discounted price of every lot due a markdown
+'''
+
+
+class PerishableInventory:
+    # Initializes the inventory with the path to the database and the connection pool shared by that database
+    def __init__(self, db_path, pool=None):
+        self.db_path = db_path  # Initializes database path
+        self.pool = _prepare_pool(db_path, pool)  # Initializes the shared connection pool
+
+    # Borrows a connection from the pool, it is committed and handed back when the with block ends
+    def __connect(self):
+        return self.pool.connection()
+
+    # Borrows a connection in a write transaction, retried while another lane holds the database's write lock
+    def __write(self):
+        return self.pool.write()
+
+    # Records a lot of quantity units of a product expiring on expiry_date and returns its lot_id
+    def add_lot(self, product_id, quantity, expiry_date):
+        with self.__write() as conn:
+            cursor = conn.execute('INSERT INTO product_lots (product_id, quantity, expiry_date) VALUES (?, ?, ?)',
+                                  (product_id, quantity, _date_text(expiry_date)))
+            return cursor.lastrowid
+
+    # Records many (product_id, quantity, expiry_date) lots in one transaction, sending them in chunks, and returns
+    # their new IDs
+    def add_lots(self, lots, chunk_size=DEFAULT_CHUNK_SIZE):
+        with self.__write() as conn:
+            rows = ((product_id, quantity, _date_text(expiry_date)) for product_id, quantity, expiry_date in lots)
+            return _insert_many(conn, 'product_lots', 'lot_id',
+                                'INSERT INTO product_lots (product_id, quantity, expiry_date) VALUES (?, ?, ?)',
+                                rows, chunk_size)
+
+    # Removes a lot that was sold through or thrown away
+    def remove_lot(self, lot_id):
+        with self.__write() as conn:
+            conn.execute('DELETE FROM product_lots WHERE lot_id = ?', (lot_id,))
+
+    # Returns the lots that haven't expired as of as_of (today by default) but will within days days, soonest first,
+    # read as a range of the expiry date index
+    def expiring_within(self, days, as_of=None):
+        today = _date_text(as_of or datetime.date.today())
+        with self.__connect() as conn:
+            rows = conn.execute('SELECT lot_id, product_id, quantity, expiry_date FROM product_lots '
+                                "WHERE expiry_date > ? AND expiry_date <= date(?, ?) ORDER BY expiry_date",
+                                (today, today, f'+{int(days)} days')).fetchall()
+        return list(map(LotRecord._make, rows))
+
+    # Returns the lots that have expired as of as_of (today by default), oldest first
+    def expired(self, as_of=None):
+        with self.__connect() as conn:
+            rows = conn.execute('SELECT lot_id, product_id, quantity, expiry_date FROM product_lots '
+                                'WHERE expiry_date <= ? ORDER BY expiry_date',
+                                (_date_text(as_of or datetime.date.today()),)).fetchall()
+        return list(map(LotRecord._make, rows))
+
+    # Returns (lot_id, product_id, quantity, expiry_date) of every lot as NumPy arrays, the dates as datetime64
+    def load_lots(self):
+        with self.__connect() as conn:
+            rows = conn.execute('SELECT lot_id, product_id, quantity, expiry_date FROM product_lots').fetchall()
+        return _lot_arrays(rows)
+
+    # Returns the ExpiryReport of every lot, in the order of load_lots()
+    def evaluate(self, as_of=None, warning_days=0):
+        return evaluate_expiry(self.load_lots()[3], as_of, warning_days)
+
+    # Returns the Markdowns of every lot due one under the schedule of (days left, discount) as of as_of, soonest
+    # first, reading only the lots inside the schedule through the expiry date index and pricing them all at once
+    def markdowns(self, as_of=None, schedule=DEFAULT_MARKDOWNS):
+        today = _date_text(as_of or datetime.date.today())
+        horizon = max(days for days, _ in schedule)
+        with self.__connect() as conn:
+            rows = conn.execute('SELECT l.lot_id, l.product_id, p.price, l.expiry_date FROM product_lots l '
+                                'JOIN products p ON p.product_id = l.product_id '
+                                'WHERE l.expiry_date > ? AND l.expiry_date <= date(?, ?) ORDER BY l.expiry_date',
+                                (today, today, f'+{int(horizon)} days')).fetchall()
+        lot_ids, product_ids, prices, expiry_dates = _lot_arrays(rows, price=True)
+        days_left = evaluate_expiry(expiry_dates, today).days_left
+        # The first entry of the schedule the days left are within sets the discount
+        discount = np.select([days_left <= days for days, _ in schedule], [rate for _, rate in schedule], 0.0)
+        return Markdowns(lot_ids, product_ids, days_left, discount, np.round(prices * (1 - discount), 2))
+
+
+# Turns (lot_id, product_id, quantity or price, expiry_date) rows into NumPy arrays
+def _lot_arrays(rows, price=False):
+    count = len(rows)
+    return (np.fromiter((row[0] for row in rows), dtype=np.int64, count=count),
+            np.fromiter((row[1] for row in rows), dtype=np.int64, count=count),
+            np.fromiter((row[2] for row in rows), dtype=np.float64 if price else np.int64, count=count),
+            np.array([row[3] for row in rows], dtype='datetime64[D]'))
+
 
 '''
 Purpose: Manages customers in the customer database consisting of functions to add, get, update, delete customer data
          from the database 
          
-Contract: add_customer(): Adds a new customer to the database with their name and contact information
-          get_customer(): Gets and returns customer info based on the customer_id 
-          update_customer(): Update's customer info in the database from the customer_id 
+Contract: add_customer(): Adds a new customer to the database with their name and contact information and returns
+                          their customer_id
+          add_customers(): Adds many (name, contact) customers in one transaction and returns their IDs
+          get_customer(): Gets and returns customer info based on the customer_id as a CustomerRecord, served from a
+                          shared cache that update_customer() and delete_customer() invalidate
+          get_customers(): Gets many customers at once in input order, reporting the IDs that weren't found
+          get_versioned_customer(): Reads a customer with their version for an update that mustn't overwrite another
+          update_customer(): Update's customer info in the database from the CustomerRecord given to it and returns
+                             their new version, refused with a ConflictError when given a version they moved on from
           delete_customer(): Deletes a customer from the database from the customer_id 
           load_customers(): Loads and returns all the customer's and their info from the database 
-          plot_customer_contact_distribution(): Creates a bar chart of customer's and their area code 
+          iter_customers(): Yields the customers in chunks as dataframes or records, reading one chunk at a time
+          area_code_distribution(): Counts the customers in each area code from the indexed area_code column
+          rfm(): Scores every customer who bought something on recency, frequency and monetary value and puts them in
+                 a segment, computed in SQL in one pass over the sales
+          segments(): Returns the number of customers and their average scores in each RFM segment
+          plot_customer_contact_distribution(): Creates a bar chart of customer's and their area code, shown or
+                                                returned as PNG/SVG bytes
+'''
+
+# Commands writing a customer, the area code is normalized from the contact in the same statement
+INSERT_CUSTOMER = f'INSERT INTO customers (name, contact, area_code) VALUES (?1, ?2, {area_code_sql("?2")})'
+UPDATE_CUSTOMER = f'name = ?1, contact = ?2, area_code = {area_code_sql("?2")}'  # The SET of an update
+
+# Number of customers in each area code, most customers first, counted from the area code index
+AREA_CODE_DISTRIBUTION_QUERY = '''
+SELECT area_code, COUNT(*) AS customers FROM customers
+WHERE area_code IS NOT NULL
+GROUP BY area_code
+ORDER BY customers DESC, area_code
+'''
+
+# Recency in days since the last sale up to :as_of, number of sales and amount spent at the prices paid of every
+# customer who bought something, each scored from 1 to 5 against the other customers (5 being the most recent,
+# frequent or valuable), with the segment the recency and frequency scores put them in
+RFM_QUERY = '''
+WITH activity AS (
+    SELECT customer_id, CAST(julianday(:as_of) - julianday(date(MAX(date))) AS INTEGER) AS recency,
+           COUNT(*) AS frequency, IFNULL(SUM(line_total), 0) AS monetary
+    FROM sales
+    WHERE customer_id IS NOT NULL AND date < date(:as_of, '+1 day')
+    GROUP BY customer_id
+), scores AS (
+    SELECT *, NTILE(5) OVER (ORDER BY recency DESC, customer_id) AS r,
+           NTILE(5) OVER (ORDER BY frequency, customer_id) AS f,
+           NTILE(5) OVER (ORDER BY monetary, customer_id) AS m
+    FROM activity
+)
+SELECT *, CASE
+    WHEN r >= 4 AND f >= 4 THEN 'champions'
+    WHEN r >= 3 AND f >= 3 THEN 'loyal'
+    WHEN r >= 4 THEN 'new'
+    WHEN f >= 3 THEN 'at_risk'
+    WHEN r <= 2 THEN 'lost'
+    ELSE 'needs_attention'
+END AS segment
+FROM scores
 '''
 
 
 class Customer:
-    # Initializes customer class with path to the database
-    def __init__(self, db_path):
+    # Initializes customer class with path to the database, the connection pool and the lookup cache shared by that
+    # database, pass LRUCache(maxsize=0) as the cache to turn caching off
+    def __init__(self, db_path, pool=None, cache=None):
         self.db_path = db_path  # Initializes database path
+        self.pool = _prepare_pool(db_path, pool)  # Initializes the shared connection pool
+        self.cache = cache if cache is not None else get_cache(
+            db_path, 'customers', maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL)  # Initializes the lookup cache
+        self.partitions = SalesPartitions(db_path, self.pool)  # Lets segmentation read partitioned sales
+        # Details used by the write methods when they aren't given any, reads never change them
         self.customer_id = None  # Initializes customer_id
         self.name = None  # Initializes customer name
         self.contact = None  # Initializes customer contact info
 
-    # Create a connection to the database
+    # Borrows a connection from the pool, it is committed and handed back when the with block ends
     def __connect(self):
-        return sqlite3.connect(self.db_path)
-
-    # Adds a customer to the database
-    def add_customer(self):
-        with self.__connect() as conn:
+        return self.pool.connection()  # Returns the pooled connection
+
+    # Borrows a connection in a write transaction, retried while another lane holds the database's write lock
+    def __write(self):
+        return self.pool.write()
+
+    # Adds a customer to the database with the given name and contact, or the ones set on the manager, and returns
+    # their new customer_id
+    def add_customer(self, name=None, contact=None):
+        if name is None and contact is None:
+            name, contact = self.name, self.contact  # Uses the details set on the manager
+        with self.__write() as conn:
             cursor = conn.cursor()  # Creates a cursor
             # Executes command to add a new customer to the database
-            cursor.execute('INSERT INTO customers (name, contact) VALUES (?, ?)', (self.name, self.contact))
-            conn.commit()  # Commits the changes to the database
+            cursor.execute(INSERT_CUSTOMER, (name, contact))
+            return cursor.lastrowid  # Returns the customer_id the database gave them
+
+    # Adds many (name, contact) customers in one transaction, sending them in chunks, and returns their new IDs
+    def add_customers(self, customers, chunk_size=DEFAULT_CHUNK_SIZE):
+        with self.__write() as conn:
+            rows = ((name, contact) for name, contact in customers)
+            return _insert_many(conn, 'customers', 'customer_id', INSERT_CUSTOMER, rows, chunk_size)
 
-    # Returns a customer from the database based on the customer_id
+    # Returns a customer from the cache or the database based on the customer_id as a CustomerRecord, None if they
+    # don't exist
     def get_customer(self, customer_id):
+        return self.cache.get_or_load(customer_id, self.__load_customer)  # Only reads the database on a cache miss
+
+    # Reads a customer row from the database for the cache
+    def __load_customer(self, customer_id):
         with self.__connect() as conn:
             cursor = conn.cursor()  # Creates a cursor
             # Executes command to return a customer by customer_id from the database
-            cursor.execute('SELECT * FROM customers WHERE customer_id = ?', (customer_id,))
+            cursor.execute('SELECT customer_id, name, contact FROM customers WHERE customer_id = ?', (customer_id,))
             row = cursor.fetchone()
-            if row:
-                self.customer_id, self.name, self.contact = row  # Sets the attributes to the customer data
-                return self  # Returns the customer with their data
-
-    # Updates a customer's information in the database
-    def update_customer(self):
-        with self.__connect() as conn:
-            cursor = conn.cursor()  # Creates a cursor
-            # Executes command to update a customer's information in the database
-            cursor.execute('UPDATE customers SET name = ?, contact = ? WHERE customer_id = ?',
-                           (self.name, self.contact, self.customer_id))
-            conn.commit()  # Commits the changes to the database
-
-    # Deletes a customer from the database based on the customer_id in the database
-    def delete_customer(self):
+            return CustomerRecord(*row) if row else None
+
+    # Gets many customers by customer_id in one query per chunk of IDs, returning a BatchLookup of CustomerRecords
+    # in the order the IDs were given, None where an ID wasn't found, and the list of IDs that weren't found
+    def get_customers(self, customer_ids, chunk_size=LOOKUP_CHUNK_SIZE):
+        return _lookup_many(self.__connect, self.cache,
+                            'SELECT customer_id, name, contact FROM customers WHERE customer_id IN ({placeholders})',
+                            CustomerRecord, customer_ids, chunk_size)
+
+    # Reads a customer and the version they are at straight from the database, bypassing the cache, as a
+    # VersionedRecord to pass the version of to an update, None if they don't exist
+    def get_versioned_customer(self, customer_id):
         with self.__connect() as conn:
+            row = conn.execute('SELECT customer_id, name, contact, version FROM customers WHERE customer_id = ?',
+                               (customer_id,)).fetchone()
+        return VersionedRecord(CustomerRecord(*row[:3]), row[3]) if row else None
+
+    # Updates a customer's information in the database from a CustomerRecord, or from the details set on the manager,
+    # and returns their new version. Given the version they were read at, the update is refused with a ConflictError
+    # if someone else changed them since, without one the last update wins
+    def update_customer(self, customer=None, version=None):
+        if customer is None:
+            customer = CustomerRecord(self.customer_id, self.name, self.contact)  # Uses the details set on the manager
+        try:
+            return _update_versioned(self.pool, 'customers', 'customer_id', UPDATE_CUSTOMER,
+                                     (customer.name, customer.contact), customer.customer_id, version)
+        finally:
+            self.cache.invalidate(customer.customer_id)  # Drops the old details, also when they turned out stale
+
+    # Deletes a customer from the database based on the customer_id, or the one set on the manager
+    def delete_customer(self, customer_id=None):
+        if customer_id is None:
+            customer_id = self.customer_id  # Uses the customer_id set on the manager
+        with self.__write() as conn:
             cursor = conn.cursor()  # Creates a cursor
             # Executes command to delete a customer from the database
-            cursor.execute('DELETE FROM customers WHERE customer_id = ?', (self.customer_id,))
-            conn.commit()  # Commits the changes to the database
+            cursor.execute('DELETE FROM customers WHERE customer_id = ?', (customer_id,))
+        self.cache.invalidate(customer_id)  # Stops the deleted customer being served from the cache
 
     # Loads and returns all the customer and their data from the database
     def load_customers(self):
         with self.__connect() as conn:
             return pd.read_sql('SELECT * FROM customers', conn)  # Returns a dataframe with all the customers
 
-    # Plots a distribution of customers by area code from their phone numbers
-    def plot_customer_contact_distribution(self):
-        with self.__connect() as conn:
-            df = pd.read_sql_query('SELECT contact FROM customers', conn)  # Loads phone number data into a dataframe
-
-            # Gets the area code from the contact, put it into a new column
-            df['contact_region'] = df['contact'].apply(lambda x: x[:3])
-
-        # Counts the occurrences of each area code from the customers
-        contact_counts = df['contact_region'].value_counts()
+    # Yields the customers chunk_size at a time in customer_id order, as dataframes or as CustomerRecords with
+    # as_frame=False, optionally only the given columns and only customers after after_id
+    def iter_customers(self, chunk_size=DEFAULT_CHUNK_SIZE, columns=None, after_id=None, as_frame=True):
+        return _iter_table(self.__connect, 'customers', 'customer_id', CustomerRecord, columns, chunk_size, after_id,
+                           as_frame)
 
-        plt.figure(figsize=(8, 5))  # Sets the figure size
-        contact_counts.plot(kind='bar')  # Creates a bar chart of the area code counts
-        plt.xlabel('Area Code')  # Sets the X axis to 'Area Code'
-        plt.ylabel('Frequency')  # Sets the Y axis to 'Frequency'
-        plt.title('Customer Area Code Distribution')  # Sets the title of the chart to 'Customer Area Code Distribution'
-        plt.show()  # Displays the chart
+    # Returns the number of customers in each area code as a series indexed by area code, most customers first,
+    # customers whose contact isn't a valid phone number are left out
+    def area_code_distribution(self):
+        with self.__connect() as conn:
+            return _area_code_counts(conn)
+
+    # Returns a dataframe indexed by customer_id of every customer with sales up to as_of (today by default): the days
+    # since their last sale, their number of sales and amount spent, their 1 to 5 r, f and m scores and segment
+    def rfm(self, as_of=None):
+        with self.partitions.connection(end=as_of) as conn:
+            return pd.read_sql_query(f'{RFM_QUERY} ORDER BY customer_id', conn, index_col='customer_id',
+                                     params={'as_of': _date_text(as_of or datetime.date.today())})
+
+    # Returns a dataframe indexed by RFM segment of the number of customers in it, their average recency and
+    # frequency and the total they spent, largest segment first
+    def segments(self, as_of=None):
+        with self.partitions.connection(end=as_of) as conn:
+            return pd.read_sql_query(f'''
+                SELECT segment, COUNT(*) AS customers, AVG(recency) AS recency, AVG(frequency) AS frequency,
+                       SUM(monetary) AS monetary
+                FROM ({RFM_QUERY}) GROUP BY segment ORDER BY customers DESC, segment''', conn, index_col='segment',
+                params={'as_of': _date_text(as_of or datetime.date.today())})
+
+    # Plots a distribution of customers by area code from their phone numbers, shown in a window or returned as
+    # cached image bytes
+    def plot_customer_contact_distribution(self, fmt=None):
+        def load(conn):
+            return _area_code_counts(conn)  # Counts the customers of each area code in the database
+
+        def draw(ax, contact_counts):
+            contact_counts.plot(kind='bar', ax=ax)  # Creates a bar chart of the area code counts
+            ax.set_xlabel('Area Code')  # Sets the X axis to 'Area Code'
+            ax.set_ylabel('Frequency')  # Sets the Y axis to 'Frequency'
+            ax.set_title('Customer Area Code Distribution')  # Sets the title of the chart
+
+        return plot(self.db_path, self.__connect, 'customer_contact_distribution', ('customers',), load, draw,
+                    (8, 5), fmt)
+
+
+# Returns the number of customers in each area code as a series indexed by area code
+def _area_code_counts(conn):
+    return pd.read_sql_query(AREA_CODE_DISTRIBUTION_QUERY, conn, index_col='area_code')['customers']
 
 
 '''
 Purpose: Manages sales and transactions in the database for the store consisting of functions to save, get, analyze sales
          data visualization, etc. 
          
-Contract: add_sale(): Records and saves a transaction to the database 
+Contract: add_sale(): Records and saves a transaction to the database and returns its sale_id, or queues it for the
+                      background writer in high-throughput mode and returns a future of its sale_id
+          add_sales(): Records many transactions in one database transaction and returns their IDs
           load_sales(): Loads and returns all the sales from the database 
-          calculate_total_sales(): Adds and returns the total amount sold across all the transactions 
-          sales_per_product(): Adds and returns the total sales organized by product 
-          plot_sales_over_time(): Creates a line graph based on all the sales overtime 
-          plot_sales_by_customer(): Creates a bar chart of sales organized by customer 
+          iter_sales(): Yields the sales in chunks as dataframes or records, reading one chunk at a time
+          calculate_total_sales(): Adds and returns the total amount sold, optionally filtered by date range, product
+                                   and customer
+          sales_per_product(): Adds and returns the total sales organized by product, with the same filters
+          calculate_revenue(): Adds and returns the revenue at the prices the sales were made at, with the same filters
+          revenue_per_day(): Returns the revenue of each day with sales, with the same filters
+          calculate_margin(): Returns the revenue, cost and margin of the sales whose cost is known
+          average_basket_value(): Returns the average amount a customer spends on a day they shop
+          sales_series(): Returns the quantity sold per hour, day, week or month as NumPy arrays, with the same filters
+          rolling_sales(): Returns a sales series with the moving average over a window of periods
+          year_over_year(): Returns a sales series with the same periods a year earlier and the change from them
+          top_products(), bottom_products(): Return the K best or worst selling products, optionally within dates
+          top_customers(), bottom_customers(): Return the K customers who bought the most or least, the same way
+          leaderboard(): Returns an in-memory board of the day's best sellers or buyers that this manager's sales
+                         keep up to date
+          plot_sales_over_time(): Creates a line graph based on all the sales overtime, shown or returned as
+                                  PNG/SVG bytes
+          plot_sales_by_customer(): Creates a bar chart of sales organized by customer, shown or returned as
+                                    PNG/SVG bytes
+          rebuild_rollups(): Recomputes the daily and overall sales rollup tables from the sales table
+          check_rollups(): Returns the rollup rows that don't match the sales table, empty when they are consistent
+          split_partitions(): Moves the sales of past months, quarters or years out of the sales table into a
+                              partition table each, which every read method then reads only when its dates overlap
+          list_partitions(): Returns the sales partitions with the dates they cover and where they are archived
+          archive_partition(): Moves a partition out of the database into a compressed file
+          restore_partition(): Brings an archived partition back into the database
+          flush(): Waits until every queued sale has been committed in high-throughput mode
+          close(): Commits the queued sales and stops the background writer in high-throughput mode
+'''
+
+# Command used by every path that records a sale, the product's current price (unless the sale has its own) and cost
+# are copied onto the sale so its revenue and margin never need the products table again
+INSERT_SALE = ('INSERT INTO sales (product_id, customer_id, quantity, date, unit_price, unit_cost) '
+               'VALUES (?1, ?2, ?3, ?4, COALESCE(?5, (SELECT price FROM products WHERE product_id = ?1)), '
+               '(SELECT cost FROM products WHERE product_id = ?1))')
+
+# Total quantity sold on each date, read from the daily product rollup in date order
+SALES_OVER_TIME_QUERY = 'SELECT date, sum(quantity) as total_quantity FROM sales_daily_product GROUP BY date'
+
+# Total quantity bought by each customer, highest first, read from the daily customer rollup instead of every sale
+SALES_BY_CUSTOMER_QUERY = '''
+SELECT c.name, SUM(s.quantity) AS total_purchased
+FROM sales_daily_customer s JOIN customers c ON s.customer_id = c.customer_id
+GROUP BY s.customer_id
+ORDER BY total_purchased DESC
 '''
 
 
 class Sale:
+    __slots__ = ('product_id', 'customer_id', 'quantity', 'date', 'unit_price')  # Fixed fields, no per-sale __dict__
+
     # Initializes Sale class with the following details:
-    def __init__(self, product_id, customer_id, quantity, date):
+    def __init__(self, product_id, customer_id, quantity, date, unit_price=None):
         self.product_id = product_id  # Product ID with the sale
         self.customer_id = customer_id  # Customer ID with the sale
         self.quantity = quantity  # Quantity of the products sold
         self.date = date  # Date of the transaction
+        self.unit_price = unit_price  # Price charged per unit, the product's price when it is recorded if None
+
+
+# Turns a date, datetime or 'YYYY-MM-DD' string into the 'YYYY-MM-DD' text the sales table stores
+def _date_text(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
+# Builds the WHERE clause and its parameters for the optional sales filters, start and end dates are both inclusive
+def _sales_filter(start=None, end=None, product_id=None, customer_id=None):
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('date >= ?')
+        params.append(_date_text(start))
+    if end is not None:
+        conditions.append("date < date(?, '+1 day')")  # Includes every sale made on the end date
+        params.append(_date_text(end))
+    if product_id is not None:
+        conditions.append('product_id = ?')
+        params.append(product_id)
+    if customer_id is not None:
+        conditions.append('customer_id = ?')
+        params.append(customer_id)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    return where, params
+
+
+# Returns the SQL running per_table, a query over the sales with {sales} standing for their table, on each of the
+# tables and combine over all their rows stacked as {partials}, with the parameters repeated for every table
+def _per_table(tables, per_table, combine, params):
+    partials = ' UNION ALL '.join(per_table.format(sales=table) for table in tables)
+    return combine.format(partials=partials), params * len(tables)
+
+
+# Picks the smallest table that can answer a sales aggregate with these filters, the daily rollups hold one row per
+# day and product or customer, only a filter on both product and customer needs the sales themselves
+def _sales_source(product_id=None, customer_id=None):
+    if customer_id is None:
+        return 'sales_daily_product'
+    if product_id is None:
+        return 'sales_daily_customer'
+    return 'sales'
+
+
+# How each series frequency groups the stored dates in SQL, the datetime64 unit of its periods and how many of those
+# units a period spans, weeks start on Monday
+SERIES_FREQUENCIES = {
+    'hour': ("strftime('%Y-%m-%dT%H', date)", 'h', 1),
+    'day': ('date(date)', 'D', 1),
+    'week': ("date(date, 'weekday 0', '-6 days')", 'D', 7),
+    'month': ('substr(date, 1, 7)', 'M', 1),
+}
+
+# Periods back to the same period a year earlier, 52 weeks for hours, days and weeks so weekdays line up
+YEAR_LAGS = {'hour': 364 * 24, 'day': 364, 'week': 52, 'month': 12}
+
+
+# Returns the SQL grouping, datetime64 unit and step of a series frequency
+def _frequency(freq):
+    if freq not in SERIES_FREQUENCIES:
+        raise ValueError(f"Frequency must be one of {', '.join(SERIES_FREQUENCIES)}")  # Raises an error for others
+    bucket, unit, width = SERIES_FREQUENCIES[freq]
+    return bucket, unit, np.timedelta64(width, unit)
+
+
+# Returns the start of the period a date falls in as a datetime64, last=True gives the last period of the date
+# instead of the first, which only differs for hours
+def _period_of(value, freq, last=False):
+    day = np.datetime64(_date_text(value), 'D')
+    if freq == 'hour':
+        return (day + 1).astype('datetime64[h]') - 1 if last else day.astype('datetime64[h]')
+    if freq == 'week':
+        return day - (day.astype('int64') + 3) % 7  # 1970-01-01 was a Thursday, this steps back to Monday
+    return day.astype(f'datetime64[{SERIES_FREQUENCIES[freq][1]}]')
+
+
+# Returns which periods of a series are on or after the period start falls in, all of them when there is no start
+def _from_start(periods, start, freq):
+    if start is None:
+        return np.ones(len(periods), dtype=bool)
+    return periods >= _period_of(start, freq)
+
+
+# Reads a sales series grouped in SQL, with lead extra periods before start, and fills in the periods without sales
+# when fill is True
+def _sales_series(conn, freq, start, end, product_id, customer_id, fill, lead=0):
+    bucket, unit, step = _frequency(freq)
+    first = None if start is None else _period_of(start, freq) - lead * step
+    last = None if end is None else _period_of(end, freq, last=True)
+    query_start = None if first is None else np.datetime_as_string(first.astype('datetime64[D]'))
+    source = _sales_source(product_id, customer_id)
+    count = 'COUNT(*)' if source == 'sales' else 'SUM(sale_count)'  # The rollups already count their sales
+    where, params = _sales_filter(query_start, end, product_id, customer_id)
+    rows = conn.execute(f'SELECT {bucket} AS period, SUM(quantity), {count} FROM {source}{where} '
+                        'GROUP BY period ORDER BY period', params).fetchall()
+    rows = [row for row in rows if row[0] is not None]  # Sales without a date can't be placed in a period
+    periods = np.array([row[0] for row in rows], dtype=f'datetime64[{unit}]')
+    quantity = np.fromiter((row[1] or 0 for row in rows), dtype=np.int64, count=len(rows))
+    sale_count = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+    if not fill or (not rows and (first is None or last is None)):
+        return SalesSeries(periods, quantity, sale_count)
+
+    # Spreads the periods that had sales over every period from the first to the last
+    first = periods[0] if first is None else first
+    last = periods[-1] if last is None else last
+    all_periods = np.arange(first, last + step, step)
+    inside = (periods >= first) & (periods <= last)
+    positions = ((periods[inside] - first) // step).astype(np.int64)
+    filled_quantity = np.zeros(len(all_periods), dtype=np.int64)
+    filled_count = np.zeros(len(all_periods), dtype=np.int64)
+    filled_quantity[positions] = quantity[inside]
+    filled_count[positions] = sale_count[inside]
+    return SalesSeries(all_periods, filled_quantity, filled_count)
+
+
+# What each ranking is of: the table holding the names, its key, the daily rollup answering date windows and the
+# all-time totals whose index answers rankings without a window
+RANKINGS = {
+    'product': ('products', 'product_id', 'sales_daily_product', 'sales_product_totals'),
+    'customer': ('customers', 'customer_id', 'sales_daily_customer', 'sales_customer_totals'),
+}
+
+
+# Returns the names, key, daily rollup and all-time totals of a ranking
+def _ranking_source(by):
+    if by not in RANKINGS:
+        raise ValueError(f"Rankings must be by one of {', '.join(RANKINGS)}")  # Raises an error for others
+    return RANKINGS[by]
+
+
+# Returns the k products or customers with the highest quantity between start and end as Rankings, ties going to the
+# lower ID, or with bottom=True the k lowest that had sales, the same order read from the other end. Without dates
+# the top of the all-time totals index is read, otherwise only the window's daily rollup rows are summed and SQLite
+# keeps just k of them while sorting, names are looked up for those k alone
+def _ranking(conn, by, k, start=None, end=None, bottom=False):
+    if k < 1:
+        raise ValueError("k must be at least 1")  # Raises an error for a ranking holding nothing
+    table, key, daily, totals = _ranking_source(by)
+    order = 'total, id DESC' if bottom else 'total DESC, id'
+    if start is None and end is None:
+        source = f'SELECT {key} AS id, quantity AS total, sale_count AS sales FROM {totals}'
+        params = []
+    else:
+        where, params = _sales_filter(start, end)
+        source = (f'SELECT {key} AS id, SUM(quantity) AS total, SUM(sale_count) AS sales FROM {daily}{where} '
+                  f'GROUP BY {key}')
+    rows = conn.execute(f'SELECT r.id, n.name, r.total, r.sales FROM ({source} ORDER BY {order} LIMIT ?) r '
+                        f'LEFT JOIN {table} n ON n.{key} = r.id ORDER BY {order}', [*params, k]).fetchall()
+    return [Ranking._make(row) for row in rows]
 
 
-class SalesManager:
+'''
+Purpose: Keeps the best selling products or best buying customers of one day in memory, fed by SalesManager as it
+         records sales, so a "best sellers today" board is read in O(K) without going back to the database
+
+Contract: add(): Adds a quantity sold to a product or customer, moving the board on to a later day when one is given
+          add_sale(): Adds a sale to the product or customer it was made for or by
+          top(): Returns the board's current top K as Rankings, highest quantity first
+          reset(): Empties the board and starts it again on the given day
+'''
+
 
-    # Initializes SalesManager class with path to the database
-    def __init__(self, db_path):
+class Leaderboard:
+    # Initializes a board of the k highest quantities per field ('product_id' or 'customer_id') sold on date, today
+    # by default
+    def __init__(self, k=10, field='product_id', date=None):
+        if k < 1:
+            raise ValueError("k must be at least 1")  # Raises an error for a board holding nothing
+        self.k = k  # Number of entries on the board
+        self.field = field  # Sale attribute the quantities are added up by
+        self.__lock = threading.Lock()  # Checkout lanes can record sales from several threads
+        self.reset(date)
+
+    # Empties the board and starts it again on date, today by default
+    def reset(self, date=None):
+        with self.__lock:
+            self.__start(date)
+
+    # Adds quantity and sale_count sales to key on date, the board's day by default. A later date moves the board on
+    # to that day and earlier dates are ignored, returns whether the quantity was counted
+    def add(self, key, quantity, date=None, sale_count=1):
+        day = self.date if date is None else _date_text(date)[:10]  # Sales may be stored with a time of day
+        with self.__lock:
+            if day != self.date:
+                if day < self.date:
+                    return False
+                self.__start(day)
+            totals = self.__totals.setdefault(key, [0, 0])
+            totals[0] += quantity
+            totals[1] += sale_count
+            if quantity < 0:
+                self.__rebuild()  # A returned sale can drop an entry below ones outside the board
+            elif quantity > 0:
+                self.__promote(key, totals[0])
+        return True
+
+    # Adds a sale to the product or customer it was made for or by, sales missing either or a date are skipped
+    def add_sale(self, sale):
+        key = getattr(sale, self.field)
+        if key is None or sale.date is None:
+            return False
+        return self.add(key, sale.quantity or 0, sale.date)
+
+    # Returns the board's entries as Rankings, highest quantity first with ties going to the lower ID
+    def top(self):
+        with self.__lock:
+            entries = sorted(self.__board.items(), key=lambda entry: (-entry[1], entry[0]))
+            return [Ranking(key, None, quantity, self.__totals[key][1]) for key, quantity in entries]
+
+    # Starts the board on a day without any sales
+    def __start(self, date):
+        self.date = _date_text(date or datetime.date.today())[:10]  # Day the board counts sales of
+        self.__totals = {}  # [quantity, sale_count] of every key sold on the day
+        self.__board = {}  # Quantity of each key on the board
+        self.__heap = []  # (quantity, -key) of the board's entries, lowest first, entries that moved up are stale
+
+    # Puts a key whose quantity went up on the board if it is already on it, the board has room, or it beats the
+    # lowest entry, which it then replaces
+    def __promote(self, key, quantity):
+        if key not in self.__board and len(self.__board) >= self.k:
+            lowest, lowest_key = self.__lowest()
+            if (quantity, -key) <= (lowest, lowest_key):
+                return
+            heapq.heappop(self.__heap)
+            del self.__board[-lowest_key]
+        self.__board[key] = quantity
+        heapq.heappush(self.__heap, (quantity, -key))
+        if len(self.__heap) > 4 * self.k:
+            self.__heap = [(quantity, -key) for key, quantity in self.__board.items()]  # Drops the stale entries
+            heapq.heapify(self.__heap)
+
+    # Returns the lowest entry still on the board, discarding the stale ones above it
+    def __lowest(self):
+        while self.__board.get(-self.__heap[0][1]) != self.__heap[0][0]:
+            heapq.heappop(self.__heap)
+        return self.__heap[0]
+
+    # Picks the board again from every key's quantity, only needed when a quantity goes down
+    def __rebuild(self):
+        sold = ((key, totals) for key, totals in self.__totals.items() if totals[0] > 0)
+        best = heapq.nlargest(self.k, sold, key=lambda item: (item[1][0], -item[0]))
+        self.__board = {key: totals[0] for key, totals in best}
+        self.__heap = [(quantity, -key) for key, quantity in self.__board.items()]
+        heapq.heapify(self.__heap)
+
+
+# Turns a sale into the row of values INSERT_SALE expects
+def _sale_row(sale):
+    return sale.product_id, sale.customer_id, sale.quantity, sale.date, sale.unit_price
+
+
+'''
+Purpose: Writes sales on a background thread, grouping the sales that arrive close together into one commit so many
+         checkout lanes share each sync to disk instead of every sale waiting for its own
+
+Contract: submit(): Queues a sale and returns a future that resolves to its sale_id once it has been committed
+          flush(): Waits until every sale queued so far has been committed
+          close(): Commits the queued sales and stops the background thread
+'''
+
+
+class SalesWriter:
+    _FLUSH = object()  # Marks a flush request in the queue
+    _STOP = object()  # Tells the background thread to finish
+
+    # Initializes the writer with the database path, the largest group of sales per commit and how long the first
+    # sale of a group waits for others to join it. With the default of no wait, each group is whatever queued up
+    # while the previous commit was running, which keeps single sales fast and still groups them under load
+    # instrumentation times the writer's statements and commits like those of an instrumented pool
+    # A group finding the database locked for longer than busy_timeout is tried again as the retry policy says, the
+    # retries and failures are counted in stats, the WriteStats of the pool when created by a SalesManager
+    def __init__(self, db_path, batch_size=500, max_delay=0.0, pragmas=None, instrumentation=None,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT, retry=DEFAULT_RETRY, stats=None):
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1")  # Raises an error if no sale could ever be written
+        if max_delay < 0:
+            raise ValueError("Max delay can't be negative")  # Raises an error for a delay that can't be waited
         self.db_path = db_path  # Initializes database path
+        self.batch_size = batch_size  # Largest number of sales committed together
+        self.max_delay = max_delay  # Seconds a sale waits for others before being committed
+        self.pragmas = dict(HIGH_THROUGHPUT_PRAGMAS if pragmas is None else pragmas)  # PRAGMAs of the writer
+        self.instrumentation = instrumentation  # Times the writer's connection when set
+        self.busy_timeout = busy_timeout  # Seconds a commit waits for another connection's lock
+        self.retry = retry  # How a group that found the database locked is tried again
+        self.stats = stats  # Counts the retries and failures of the groups
+        self.__queue = queue.Queue()  # Sales waiting to be written with their futures
+        self.__lock = threading.Lock()  # Stops sales being queued after the writer has closed
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__run, name=f'SalesWriter({db_path})', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)  # Commits whatever is still queued when the program exits
+
+    # Queues a sale and returns a future that resolves to its sale_id once it has been committed
+    def submit(self, sale):
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("Cannot add a sale to a closed sales writer")
+            self.__queue.put((_sale_row(sale), future))
+        return future
+
+    # Waits until every sale queued so far has been committed
+    def flush(self, timeout=None):
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__queue.put((self._FLUSH, future))
+        future.result(timeout)
+
+    # Commits the queued sales and stops the background thread
+    def close(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__queue.put((self._STOP, None))
+        self.__thread.join()
+        atexit.unregister(self.close)
+
+    # Background loop taking groups of sales off the queue and committing each group at once
+    def __run(self):
+        connect = sqlite3.connect if self.instrumentation is None else self.instrumentation.connect
+        conn = connect(self.db_path, timeout=self.busy_timeout)  # Dedicated connection only used by this thread
+        apply_pragmas(conn, self.pragmas)
+        running = True
+        while running:
+            group = [self.__queue.get()]  # Waits for the first sale of the next group
+            deadline = time.monotonic() + self.max_delay
+            while len(group) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    group.append(self.__queue.get(timeout=remaining) if remaining > 0 else self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            sales = []
+            flushes = []
+            for row, future in group:
+                if row is self._STOP:
+                    running = False
+                elif row is self._FLUSH:
+                    flushes.append(future)
+                elif future.set_running_or_notify_cancel():  # Skips sales whose callers cancelled them
+                    sales.append((row, future))
+            if sales:
+                self.__write(conn, sales)
+            for future in flushes:
+                future.set_result(None)  # Everything queued before the flush has now been committed
+        conn.close()
+
+    # Commits a group of sales in one transaction, falling back to one at a time so a bad sale only fails itself
+    def __write(self, conn, sales):
+        try:
+            ids = retry_locked(lambda: self.__insert(conn, sales), self.retry, self.stats)
+        except Exception as error:
+            if len(sales) == 1:
+                sales[0][1].set_exception(error)
+            else:
+                for sale in sales:
+                    self.__write(conn, [sale])
+            return
+        for (_, future), sale_id in zip(sales, ids):
+            future.set_result(sale_id)
+
+    # Inserts a group of sales holding the write lock from the start and returns their IDs, committing the whole
+    # group or rolling all of it back so it can be tried again
+    @staticmethod
+    def __insert(conn, sales):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [conn.execute(INSERT_SALE, row).lastrowid for row, _ in sales]
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return ids
 
-    # Creates a connection to the database
-    def __connect(self):
-        return sqlite3.connect(self.db_path)  # Returns the connection
+
+class SalesManager:
+
+    # Initializes SalesManager class with path to the database and the connection pool shared by that database
+    # high_throughput=True switches the database to write-ahead logging with tuned PRAGMAs and sends add_sale through
+    # a background SalesWriter that commits up to batch_size sales at a time, waiting at most max_delay seconds
+    # partition_by is the 'month', 'quarter' or 'year' each partition created by split_partitions() covers
+    def __init__(self, db_path, pool=None, high_throughput=False, batch_size=500, max_delay=0.0, pragmas=None,
+                 partition_by='month'):
+        self.db_path = db_path  # Initializes database path
+        self.pool = _prepare_pool(db_path, pool)  # Initializes the shared connection pool
+        self.partitions = SalesPartitions(db_path, self.pool, partition_by)  # Older sales split out by date
+        self.writer = None  # Background writer, only used in high-throughput mode
+        self.leaderboards = []  # Boards fed every sale this manager records
+        if high_throughput:
+            pragmas = dict(HIGH_THROUGHPUT_PRAGMAS if pragmas is None else pragmas)
+            self.pool.configure(pragmas)  # Readers get the larger cache and memory-mapped I/O too
+            self.writer = SalesWriter(db_path, batch_size=batch_size, max_delay=max_delay, pragmas=pragmas,
+                                      instrumentation=self.pool.instrumentation, busy_timeout=self.pool.busy_timeout,
+                                      retry=self.pool.retry, stats=self.pool.write_stats)
+
+    # Borrows a connection for reading sales, it is committed and handed back when the with block ends. Once the
+    # database has partitions, sales on it reads the partitions overlapping start to end along with the sales table
+    def __connect(self, start=None, end=None):
+        return self.partitions.connection(start, end)  # Returns the pooled connection
 
     # Records a new sale in the database with details from the sale instance
     def add_sale(self, sale):
-        with self.__connect() as conn:
+        # In high-throughput mode the sale is committed with others and the caller gets a future of its sale_id
+        if self.writer is not None:
+            future = self.writer.submit(sale)
+            if self.leaderboards:
+                # The boards only count the sale once it has been committed
+                future.add_done_callback(lambda done: done.cancelled() or done.exception() or self.__rank([sale]))
+            return future
+
+        with self.pool.write() as conn:  # Sales are always written to the sales table
             cursor = conn.cursor()  # Creates a cursor
             # Executes command to add the sale data to the database
-            cursor.execute('INSERT INTO sales (product_id, customer_id, quantity, date) VALUES (?, ?, ?, ?)',
-                           (sale.product_id, sale.customer_id, sale.quantity, sale.date))
-            conn.commit()  # Commits the changes
+            cursor.execute(INSERT_SALE, _sale_row(sale))
+        self.__rank([sale])
+        return cursor.lastrowid  # Returns the sale_id the database gave it
+
+    # Records many sales in one database transaction, sending them in chunks, and returns their new IDs
+    def add_sales(self, sales, chunk_size=DEFAULT_CHUNK_SIZE):
+        if self.leaderboards:
+            sales = list(sales)  # Read again for the boards once they have been committed
+        with self.pool.write() as conn:
+            sale_ids = _insert_many(conn, 'sales', 'sale_id', INSERT_SALE, map(_sale_row, sales), chunk_size)
+        self.__rank(sales)
+        return sale_ids
+
+    # Adds committed sales to the leaderboards
+    def __rank(self, sales):
+        for board in self.leaderboards:
+            for sale in sales:
+                board.add_sale(sale)
 
     # Loads and returns all the sale data from the database
     def load_sales(self):
         with self.__connect() as conn:
-            return pd.read_sql('SELECT * FROM sales', conn)  # Returns a dataframe with all the sales
+            # Returns a dataframe with all the sales, in sale_id order across the partitions
+            return pd.read_sql('SELECT * FROM sales ORDER BY sale_id', conn)
+
+    # Yields the sales chunk_size at a time in sale_id order, as dataframes or as SaleRecords with as_frame=False,
+    # optionally only the given columns and only sales after after_id, so exports run in bounded memory
+    def iter_sales(self, chunk_size=DEFAULT_CHUNK_SIZE, columns=None, after_id=None, as_frame=True):
+        return _iter_table(self.__connect, 'sales', 'sale_id', SaleRecord, columns, chunk_size, after_id, as_frame)
 
     # Adds and returns the total quantity sold across all the transactions
-    def calculate_total_sales(self):
-        df = self.load_sales()  # Loads the sale data into a dataframe
-        return df['quantity'].sum()  # Sums up the quantity column
+    # The sum is done by the database from the rollup tables so only the total comes back, never the sales themselves
+    def calculate_total_sales(self, start=None, end=None, product_id=None, customer_id=None):
+        with self.__connect(start, end) as conn:
+            if start is None and end is None and product_id is None and customer_id is None:
+                return conn.execute('SELECT quantity FROM sales_totals WHERE id = 1').fetchone()[0]
+            where, params = _sales_filter(start, end, product_id, customer_id)
+            # Sums up the quantity column of the matching rows, 0 when nothing matches
+            return conn.execute(f'SELECT COALESCE(SUM(quantity), 0) FROM {_sales_source(product_id, customer_id)}'
+                                f'{where}', params).fetchone()[0]
+
+    # Adds and returns total sales amount organized by product, as a series of quantities indexed by product_id
+    def sales_per_product(self, start=None, end=None, product_id=None, customer_id=None):
+        where, params = _sales_filter(start, end, product_id, customer_id)
+        with self.__connect(start, end) as conn:
+            # Groups by ID and sums quantities by the product in the database, one row per product comes back
+            source = 'sales_daily_product' if customer_id is None else 'sales'
+            df = pd.read_sql_query(f'SELECT product_id, SUM(quantity) AS quantity FROM {source}{where} '
+                                   'GROUP BY product_id ORDER BY product_id', conn, params=params,
+                                   index_col='product_id')
+        return df['quantity']
+
+    # Adds and returns the revenue of the sales at the price each was made at, optionally filtered like
+    # calculate_total_sales, read from the sales alone without looking up any product's current price
+    def calculate_revenue(self, start=None, end=None, product_id=None, customer_id=None):
+        where, params = _sales_filter(start, end, product_id, customer_id)
+        with self.partitions.tables(start, end) as (conn, tables):
+            sql, params = _per_table(tables, f'SELECT SUM(line_total) AS revenue FROM {{sales}}{where}',
+                                     'SELECT COALESCE(SUM(revenue), 0) FROM ({partials})', params)
+            return conn.execute(sql, params).fetchone()[0]
+
+    # Returns the revenue of each day with sales as a series indexed by date, with the same filters, summed from the
+    # date index of sales
+    def revenue_per_day(self, start=None, end=None, product_id=None, customer_id=None):
+        where, params = _sales_filter(start, end, product_id, customer_id)
+        with self.partitions.tables(start, end) as (conn, tables):
+            sql, params = _per_table(
+                tables, f'SELECT date, SUM(line_total) AS revenue FROM {{sales}}{where} GROUP BY date',
+                'SELECT date, SUM(revenue) AS revenue FROM ({partials}) GROUP BY date ORDER BY date', params)
+            df = pd.read_sql_query(sql, conn, params=params, index_col='date')
+        return df['revenue']
+
+    # Returns a Margin of the sales with a known cost, with the same filters, sales recorded before their product had
+    # a cost are left out of both the revenue and the cost
+    def calculate_margin(self, start=None, end=None, product_id=None, customer_id=None):
+        where, params = _sales_filter(start, end, product_id, customer_id)
+        with self.partitions.tables(start, end) as (conn, tables):
+            sql, params = _per_table(
+                tables, 'SELECT SUM(CASE WHEN unit_cost IS NOT NULL THEN line_total END) AS revenue, '
+                f'SUM(quantity * unit_cost) AS cost FROM {{sales}}{where}',
+                'SELECT COALESCE(SUM(revenue), 0), COALESCE(SUM(cost), 0) FROM ({partials})', params)
+            revenue, cost = conn.execute(sql, params).fetchone()
+        return Margin(revenue, cost, revenue - cost, (revenue - cost) / revenue if revenue else None)
+
+    # Returns the average amount spent per basket, a basket being everything one customer bought on one day, between
+    # start and end and optionally for one customer, 0 when there are no baskets
+    def average_basket_value(self, start=None, end=None, customer_id=None):
+        where, params = _sales_filter(start, end, customer_id=customer_id)
+        with self.partitions.tables(start, end) as (conn, tables):
+            # Only the columns needed are stacked, a basket can have sales in both the sales table and a partition
+            sql, params = _per_table(tables, f'SELECT date, customer_id, line_total FROM {{sales}}{where}',
+                                     'SELECT AVG(total) FROM (SELECT SUM(line_total) AS total FROM ({partials}) '
+                                     'GROUP BY date, customer_id)', params)
+            value = conn.execute(sql, params).fetchone()[0]
+        return value or 0
+
+    # Returns the quantity and number of sales per hour, day, week or month as a SalesSeries of NumPy arrays, grouped
+    # in SQL over the daily rollups, optionally filtered like calculate_total_sales. With fill=True every period from
+    # start (or the first sale) to end (or the last sale) is included, periods without sales as zeros
+    def sales_series(self, freq='day', start=None, end=None, product_id=None, customer_id=None, fill=True):
+        with self.__connect(start, end) as conn:
+            return _sales_series(conn, freq, start, end, product_id, customer_id, fill)
+
+    # Returns a RollingSales with the mean quantity of the window periods ending on each period, the periods before
+    # start are read too so the first windows are full
+    def rolling_sales(self, window, freq='day', start=None, end=None, product_id=None, customer_id=None):
+        if window < 1:
+            raise ValueError("Window must be at least 1 period")  # Raises an error for a window holding nothing
+        with self.__connect(end=end) as conn:  # The periods before start are read too
+            series = _sales_series(conn, freq, start, end, product_id, customer_id, True, lead=window - 1)
+        totals = np.concatenate(([0], np.cumsum(series.quantity)))
+        mean = np.full(len(series.quantity), np.nan)
+        mean[window - 1:] = (totals[window:] - totals[:-window]) / window
+        keep = _from_start(series.periods, start, freq)
+        return RollingSales(series.periods[keep], series.quantity[keep], mean[keep])
+
+    # Returns a YearOverYear comparing each period with the same period a year earlier, 52 weeks earlier for hourly,
+    # daily and weekly series so weekdays line up and 12 months earlier for monthly ones
+    def year_over_year(self, freq='month', start=None, end=None, product_id=None, customer_id=None):
+        _frequency(freq)  # Raises an error for an unknown frequency
+        lag = YEAR_LAGS[freq]
+        with self.__connect(end=end) as conn:  # The periods before start are read too
+            series = _sales_series(conn, freq, start, end, product_id, customer_id, True, lead=lag)
+        previous = np.full(len(series.quantity), np.nan)
+        previous[lag:] = series.quantity[:max(len(series.quantity) - lag, 0)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.where(previous > 0, series.quantity / previous - 1, np.nan)
+        keep = _from_start(series.periods, start, freq)
+        return YearOverYear(series.periods[keep], series.quantity[keep], previous[keep], change[keep])
+
+    # Returns the k best selling products between start and end as Rankings, all-time when no dates are given
+    def top_products(self, k=10, start=None, end=None):
+        with self.__connect() as conn:
+            return _ranking(conn, 'product', k, start, end)
 
-    # Adds and returns total sales amount organized by product
-    def sales_per_product(self):
-        df = self.load_sales()  # Loads the sale data into a dataframe
-        return df.groupby('product_id')['quantity'].sum()  # Groups by ID and sums quantities by the product
+    # Returns the k worst selling products that had sales between start and end, lowest first
+    def bottom_products(self, k=10, start=None, end=None):
+        with self.__connect() as conn:
+            return _ranking(conn, 'product', k, start, end, bottom=True)
 
-    # Plots a linechart of the sales amount over time
-    def plot_sales_over_time(self):
+    # Returns the k customers who bought the most between start and end as Rankings, all-time when no dates are given
+    def top_customers(self, k=10, start=None, end=None):
+        with self.__connect() as conn:
+            return _ranking(conn, 'customer', k, start, end)
+
+    # Returns the k customers who bought the least between start and end among those who bought, lowest first
+    def bottom_customers(self, k=10, start=None, end=None):
+        with self.__connect() as conn:
+            return _ranking(conn, 'customer', k, start, end, bottom=True)
+
+    # Returns a Leaderboard of the k best selling products, or buying customers with by='customer', on date (today by
+    # default), filled from the day's rollup and then kept up to date by every sale this manager records
+    def leaderboard(self, k=10, by='product', date=None):
+        _, key, daily, _ = _ranking_source(by)
+        board = Leaderboard(k, key, date)
+        where, params = _sales_filter(board.date, board.date)
         with self.__connect() as conn:
-            # Loads the sale data into a dataframe
-            df = pd.read_sql_query('SELECT date, sum(quantity) as total_quantity FROM sales GROUP BY date', conn)
-            df['date'] = pd.to_datetime(df['date'])  # Converts date column to datetime format
-
-        plt.figure(figsize=(10, 6))  # Sets the figure size
-        plt.plot(df['date'], df['total_quantity'], color='green')  # Creates a green line chart of sales over date
-        plt.xlabel('Date')  # Sets the X axis to 'Date'
-        plt.ylabel('Total Amount Sold')  # Sets the Y axis to 'Total Amount Sold'
-        plt.title('Total Sales Over Time')  # Sets the title of the chart to 'Total Sales Over Time'
-        plt.show()  # Displays the chart
-
-    # Plots a bar chart of sales amount organized by customer
-    def plot_sales_by_customer(self):
+            rows = conn.execute(f'SELECT {key}, SUM(quantity), SUM(sale_count) FROM {daily}{where} GROUP BY {key}',
+                                params).fetchall()
+        for key_id, quantity, sale_count in rows:
+            board.add(key_id, quantity, sale_count=sale_count)
+        self.leaderboards.append(board)
+        return board
+
+    # Plots a linechart of the sales amount over time, shown in a window or returned as cached image bytes
+    def plot_sales_over_time(self, fmt=None):
+        def load(conn):
+            # Loads the quantity sold on each date with sales as datetime64 and integer arrays
+            return _sales_series(conn, 'day', None, None, None, None, fill=False)
+
+        def draw(ax, series):
+            ax.plot(series.periods, series.quantity, color='green')  # Creates a green line chart of sales over date
+            ax.set_xlabel('Date')  # Sets the X axis to 'Date'
+            ax.set_ylabel('Total Amount Sold')  # Sets the Y axis to 'Total Amount Sold'
+            ax.set_title('Total Sales Over Time')  # Sets the title of the chart to 'Total Sales Over Time'
+
+        return plot(self.db_path, self.__connect, 'sales_over_time', ('sales',), load, draw, (10, 6), fmt)
+
+    # Plots a bar chart of sales amount organized by customer, shown in a window or returned as cached image bytes
+    # top=N only plots the N customers who bought the most
+    def plot_sales_by_customer(self, fmt=None, top=None):
+        # Gets customer names and sum of the products purchased by each one
+        def load(conn):
+            if top is None:
+                return pd.read_sql_query(SALES_BY_CUSTOMER_QUERY, conn)  # Sets the filtered data to a dataframe
+            return _ranking_frame(_ranking(conn, 'customer', top), 'Customer', 'total_purchased')
+
+        def draw(ax, df):
+            ax.bar(df['name'], df['total_purchased'],
+                   color='cyan')  # Creates a cyan bar chart of name over total_purchased
+            ax.set_xlabel('Customer Name')  # Sets the X axis to 'Customer Name'
+            ax.set_ylabel('Total Amount Purchased')  # Sets the Y axis to 'Total Amount Purchased'
+            ax.set_title('Total Sales by Customer')  # Sets the title of the chart to 'Total Sales by Customers'
+            ax.tick_params(axis='x', labelrotation=90)  # Sets X axis labels rotated to 90º
+
+        name = 'sales_by_customer' if top is None else f'sales_by_customer_top_{top}'
+        return plot(self.db_path, self.__connect, name, ('customers', 'sales'), load, draw, (10, 6), fmt)
+
+    # Recomputes the daily and overall sales rollup tables from the sales table, repairing them if they drifted
+    def rebuild_rollups(self):
         with self.__connect() as conn:
-            # Gets customer names and sum of the products purchased by each one
-            query = '''
-            SELECT c.name, SUM(s.quantity) AS total_purchased
-            FROM sales s JOIN customers c ON s.customer_id = c.customer_id
-            GROUP BY s.customer_id
-            ORDER BY total_purchased DESC
-            '''
-            df = pd.read_sql_query(query, conn)  # Sets the filtered data to a dataframe
-
-        plt.figure(figsize=(10, 6))  # Sets the figure size
-        plt.bar(df['name'], df['total_purchased'],
-                color='cyan')  # Creates a cyan bar chart of name over total_purchased
-        plt.xlabel('Customer Name')  # Sets the X axis to 'Customer Name'
-        plt.ylabel('Total Amount Purchased')  # Sets the Y axis to 'Total Amount Purchased'
-        plt.title('Total Sales by Customer')  # Sets the title of the chart to 'Total Sales by Customers'
-        plt.xticks(rotation=90)  # Sets X axis labels rotated to 90º
-        plt.show()  # Displays the chart
+            rebuild_rollups(conn)
 
+    # Returns (table, row) for every rollup row that doesn't match the sales table, an empty list when consistent
+    def check_rollups(self):
+        with self.__connect() as conn:
+            return check_rollups(conn)
 
-if __name__ == "__main__":
-    db_path = 'shop.db'  # Define the path to the database
+    # Moves the sales dated before `before` (the start of the current period by default) into a partition per
+    # month, quarter or year and returns how many were moved, new sales are still written to the sales table
+    def split_partitions(self, before=None):
+        return self.partitions.split(before)
 
-    # Initialize instances of each class with the database path
-    product_manager = Product(db_path)
-    customer_manager = Customer(db_path)
-    sales_manager = SalesManager(db_path)
+    # Returns every sales partition as a Partition, archived ones included
+    def list_partitions(self):
+        return self.partitions.list()
 
-    # Puts products into a dataframe
-    products_df = product_manager.load_products()
-    print(products_df)  # Prints the products dataframe for visual confirmation
+    # Moves a partition into a compressed file in directory ('<database>.archive' by default) and returns its path,
+    # its sales are left out of every read method, total and chart until it is restored
+    def archive_partition(self, name, directory=None):
+        return self.partitions.archive(name, directory)
 
-    # Puts customers into a dataframe
-    customers_df = customer_manager.load_customers()
-    print(customers_df)  # Prints the customers dataframe for visual confirmation
+    # Brings an archived partition back into the database and returns how many sales it held
+    def restore_partition(self, name):
+        return self.partitions.restore(name)
 
-    # Puts sales into a dataframe
-    sales_df = sales_manager.load_sales()
-    print(sales_df)  # Prints he sales dataframe for visual confirmation
+    # Waits until every queued sale has been committed in high-throughput mode
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
 
-    # Calculates total sales using the calculate_total_sales method in SalesManager
-    total_sales = sales_manager.calculate_total_sales()
-    print(f"Total sales volume: {total_sales}")  # Prints the result
+    # Commits the queued sales and stops the background writer in high-throughput mode
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.partitions.close()
 
-    # Calculates sales per product using sales_per_product method in SalesManager
-    sales_per_product = sales_manager.sales_per_product()
+
+if __name__ == "__main__":
+    from Reports import ReportRunner, Report  # Imported here since Reports itself is built on this module
+
+    db_path = 'shop.db'  # Define the path to the database
+
+    # Runs the independent reports at the same time on read-only connections instead of one after another
+    reports = [
+        Report('products', 'products', 'load_products'),
+        Report('customers', 'customers', 'load_customers'),
+        Report('sales', 'sales', 'load_sales'),
+        Report('total_sales', 'sales', 'calculate_total_sales'),
+        Report('sales_per_product', 'sales', 'sales_per_product'),
+    ]
+    with ReportRunner(db_path) as runner:
+        results = runner.run(reports)
+
+    print(results['products'])  # Prints the products dataframe for visual confirmation
+    print(results['customers'])  # Prints the customers dataframe for visual confirmation
+    print(results['sales'])  # Prints the sales dataframe for visual confirmation
+    print(f"Total sales volume: {results['total_sales']}")  # Prints the total quantity sold
     print("Sales per product:")
-    print(sales_per_product)  # Prints the result
+    print(results['sales_per_product'])  # Prints the quantity sold of each product
+
+    # Initialize instances of each class with the database path for the charts, which are shown in windows so they
+    # stay on the main thread, the full pack rendering them to files runs with 'python Reports.py'
+    product_manager = Product(db_path)
+    customer_manager = Customer(db_path)
+    sales_manager = SalesManager(db_path)
 
     # Plots all the methods for visualizations using the shop.db database
     # Product plots
@@ -367,6 +1546,3 @@ if __name__ == "__main__":
     # Sales plots
     sales_manager.plot_sales_over_time()
     sales_manager.plot_sales_by_customer()
-
-
-
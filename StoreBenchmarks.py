@@ -0,0 +1,610 @@
+# Needed libraries
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from Store import *
+from ConnectionPool import ConnectionPool, get_pool
+from AsyncStore import AsyncStore
+from Cache import LRUCache, get_cache
+from Instrumentation import Instrumentation, MemorySink
+from FillDatabase import generate_database
+from Snapshots import Snapshot
+from Reports import ReportRunner, END_OF_DAY_REPORTS
+
+'''
+Purpose: Measures how fast the hot paths in Store.py run so changes to them can be compared against each other,
+         run as a script it times every hot path against a generated dataset of a chosen size, saves the results as
+         JSON and flags regressions against a saved baseline
+
+Contract: make_database(): Copies the test database into a temporary folder to benchmark against
+          time_case(): Times a function over warmup and repeat runs and returns the statistics of the runs
+          hot_path_cases(): Returns the named hot paths of Store.py to time against a database
+          run_suite(): Generates a dataset, times every hot path on it and returns the results
+          compare(): Returns the hot paths that got slower than a saved baseline by more than a threshold
+          ops_per_second(): Runs a function a number of times and returns how many calls it managed per second
+          bench_connection_pool(): Compares opening a connection per call against borrowing one from the pool
+          bench_high_throughput(): Compares add_sale from several checkout lanes with and without high-throughput mode
+          bench_async_checkouts(): Runs thousands of concurrent simulated checkouts through the async API
+          bench_instrumentation(): Compares uncached lookups and sales with instrumentation off and on
+          bench_perishables(): Compares checking lots one PerishableProduct at a time against the batch evaluator
+          bench_revenue(): Compares daily revenue joined to the current product prices against the price snapshots
+          bench_partitions(): Compares revenue over a month and a year and vacuuming the database before and after
+                              the sales are split into monthly partitions and all but the last three are archived
+          bench_snapshots(): Compares loading the sales from the database against loading them from a snapshot, and
+                             times the first export into the snapshot against one appending a day of new sales
+          bench_contention(): Runs lanes that each raise a price by read, check and retry and record a sale, reporting
+                              the updates per second with the retries and conflicts it took for 1, 4 and 16 lanes
+          bench_reports(): Compares the end-of-day reports run one after another on one core against the ReportRunner
+          bench_record_memory(): Compares the bytes each in-memory sale takes as a record against the old objects
+          measure_startup(): Imports Store in a fresh process, records a sale and reports the time, memory and modules
+          bench_startup(): Compares the lean start of a worker against one that loads pandas and pyplot up front
+'''
+
+
+# Copies the test database into a temporary folder so benchmarks never change the real databases
+def make_database(source='TESTshop.db'):
+    folder = tempfile.mkdtemp(prefix='store-bench-')
+    db_path = os.path.join(folder, 'bench.db')
+    shutil.copy(source, db_path)
+    return db_path
+
+
+# Runs a function a number of times and returns how many calls it managed per second
+def ops_per_second(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return repeat / (time.perf_counter() - start)
+
+
+# Compares the old connect-per-call path with the pooled connections for reads and writes
+def bench_connection_pool(repeat=2000):
+    db_path = make_database()
+
+    # Same work as the old Store.py methods did, opening a brand-new connection for every call
+    def per_call_read():
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('SELECT * FROM products WHERE product_id = ?', (1,)).fetchone()
+
+    def per_call_write():
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('INSERT INTO sales (product_id, customer_id, quantity, date) VALUES (?, ?, ?, ?)',
+                         (1, 1, 1, '2024-04-20'))
+            conn.commit()
+
+    pool = ConnectionPool(db_path, size=1)
+    product_manager = Product(db_path, pool=pool, cache=LRUCache(maxsize=0))  # Every read goes to the database
+    sales_manager = SalesManager(db_path, pool=pool)
+    sale = Sale(1, 1, 1, '2024-04-20')
+
+    results = {
+        'per_call_read': ops_per_second(per_call_read, repeat),
+        'pooled_read': ops_per_second(lambda: product_manager.get_product(1), repeat),
+        'per_call_write': ops_per_second(per_call_write, repeat // 10),
+        'pooled_write': ops_per_second(lambda: sales_manager.add_sale(sale), repeat // 10),
+    }
+    pool.close()
+    shutil.rmtree(os.path.dirname(db_path))
+    return results
+
+
+# Records sales from several threads at once, like checkout lanes, and returns sales committed per second
+def _concurrent_sales(manager, lanes, sales_per_lane):
+    def lane():
+        for _ in range(sales_per_lane):
+            result = manager.add_sale(Sale(1, 1, 1, '2024-04-20'))
+            if result is not None:
+                result.result()  # Waits until the sale is committed like a till waiting for its receipt
+
+    threads = [threading.Thread(target=lane) for _ in range(lanes)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return lanes * sales_per_lane / (time.perf_counter() - start)
+
+
+# Compares add_sale from several checkout lanes in the default mode and in high-throughput mode
+def bench_high_throughput(lanes=32, sales_per_lane=100):
+    results = {}
+    for name, high_throughput in (('default_add_sale', False), ('high_throughput_add_sale', True)):
+        db_path = make_database()
+        pool = ConnectionPool(db_path, size=lanes)
+        manager = SalesManager(db_path, pool=pool, high_throughput=high_throughput)
+        results[name] = _concurrent_sales(manager, lanes, sales_per_lane)
+        manager.close()
+        pool.close()
+        shutil.rmtree(os.path.dirname(db_path))
+    return results
+
+
+# Runs concurrent simulated checkouts through AsyncStore, each pricing a basket and recording a sale per line,
+# and returns checkouts per second with and without high-throughput mode, with the basket recorded by one add_sales
+# and with one add_sale per line, which high-throughput mode sends through the group commit
+def bench_async_checkouts(checkouts=2000, basket_size=5):
+    async def run(store, per_sale):
+        async def checkout(number):
+            product_ids = [(number + line) % 5 + 1 for line in range(basket_size)]
+            basket = await store.products.get_products(product_ids)
+            sales = [Sale(record.product_id, number % 5 + 1, 1, '2024-04-20')
+                     for record in basket.records if record is not None]
+            if per_sale:
+                await asyncio.gather(*(store.sales.add_sale(sale) for sale in sales))
+            else:
+                await store.sales.add_sales(sales)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(checkout(number) for number in range(checkouts)))
+        elapsed = time.perf_counter() - start
+        await store.close()
+        return checkouts / elapsed
+
+    results = {}
+    for name, high_throughput, per_sale in (('async_checkouts', False, False),
+                                            ('async_checkouts_high_throughput', True, False),
+                                            ('async_checkouts_add_sale', False, True),
+                                            ('async_checkouts_add_sale_high_throughput', True, True)):
+        db_path = make_database()
+        results[name] = asyncio.run(run(AsyncStore(db_path, high_throughput=high_throughput), per_sale))
+        shutil.rmtree(os.path.dirname(db_path))
+    return results
+
+
+# Compares uncached get_product and add_sale on a pool with instrumentation off, which is the normal path, and on
+def bench_instrumentation(repeat=2000):
+    db_path = make_database()
+    pool = ConnectionPool(db_path, size=1)
+    product_manager = Product(db_path, pool=pool, cache=LRUCache(maxsize=0))
+    sales_manager = SalesManager(db_path, pool=pool)
+    sale = Sale(1, 1, 1, '2024-04-20')
+    results = {}
+    for name, instrumentation in (('plain', None), ('instrumented', Instrumentation([MemorySink()]))):
+        pool.instrument(instrumentation)
+        results[f'{name}_read'] = ops_per_second(lambda: product_manager.get_product(1), repeat)
+        results[f'{name}_write'] = ops_per_second(lambda: sales_manager.add_sale(sale), repeat // 10)
+    pool.close()
+    shutil.rmtree(os.path.dirname(db_path))
+    return results
+
+
+# Checks the expiry of an inventory of lots lots the old way, building a PerishableProduct for each row and calling
+# is_expired() on it, against the batch evaluator and the markdown job, returning lots of the inventory per second
+def bench_perishables(lots=50000):
+    db_path = make_database()
+    inventory = PerishableInventory(db_path)
+    dates = [f'2024-{month:02d}-{day:02d}' for month in range(1, 13) for day in range(1, 29)]
+    inventory.add_lots((lot % 5 + 1, 10, dates[lot % len(dates)]) for lot in range(lots))
+
+    def per_object():
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute('SELECT product_id, expiry_date FROM product_lots').fetchall()
+        conn.close()
+        return [PerishableProduct(db_path, product_id, 'Milk', 2.5, expiry_date).is_expired()
+                for product_id, expiry_date in rows]
+
+    results = {
+        'per_object_is_expired': lots / _seconds(per_object),
+        'batch_evaluate': lots / _seconds(lambda: inventory.evaluate(as_of='2024-06-15', warning_days=3)),
+        'markdown_job': lots / _seconds(lambda: inventory.markdowns(as_of='2024-06-15')),
+    }
+    shutil.rmtree(os.path.dirname(db_path))
+    return results
+
+
+# Computes the revenue of every day of a generated dataset of sales sales the old way, joining every sale to the
+# current price of its product, against summing the price snapshots on the sales, returning sales summed per second
+def bench_revenue(sales=10000000):
+    folder = tempfile.mkdtemp(prefix='store-bench-')
+    db_path = os.path.join(folder, 'bench.db')
+    generate_database(db_path, products=10000, customers=100000, sales=sales)
+    conn = sqlite3.connect(db_path)
+    joined = ('SELECT s.date, SUM(s.quantity * p.price) FROM sales s JOIN products p ON p.product_id = s.product_id '
+              'GROUP BY s.date')
+    snapshot = 'SELECT date, SUM(line_total) FROM sales GROUP BY date'
+    results = {
+        'revenue_per_day_join': sales / _seconds(lambda: conn.execute(joined).fetchall()),
+        'revenue_per_day_snapshot': sales / _seconds(lambda: conn.execute(snapshot).fetchall()),
+    }
+    conn.close()
+    shutil.rmtree(folder)
+    return results
+
+
+# Splits sales sales over two years into monthly partitions, comparing the revenue of a month and of a year read
+# from the single sales table and from the partitions, then archives every partition but the last three and
+# compares the size of the database and the time to vacuum it before and after
+def bench_partitions(sales=2000000):
+    folder = tempfile.mkdtemp(prefix='store-bench-')
+    db_path = os.path.join(folder, 'bench.db')
+    generate_database(db_path, products=10000, customers=100000, sales=sales)
+    manager = SalesManager(db_path, pool=ConnectionPool(db_path))
+    month_revenue = functools.partial(manager.calculate_revenue, '2024-06-01', '2024-06-30')
+    year_revenue = functools.partial(manager.calculate_revenue, '2024-01-01', '2024-12-31')
+
+    def vacuum():
+        with manager.pool.connection() as conn:
+            conn.execute('VACUUM')
+
+    results = {
+        'month_revenue_single_table': ops_per_second(month_revenue, 20),
+        'year_revenue_single_table': ops_per_second(year_revenue, 5),
+        'vacuum_seconds_single_table': _seconds(vacuum),
+        'database_mb_single_table': os.path.getsize(db_path) / 1e6,
+        'split_seconds': _seconds(lambda: manager.split_partitions('2025-01-01')),
+        'month_revenue_partitioned': ops_per_second(month_revenue, 20),
+        'year_revenue_partitioned': ops_per_second(year_revenue, 5),
+    }
+    archive = os.path.join(folder, 'archive')
+    partitions = manager.list_partitions()[:-3]
+    results['archive_seconds_per_partition'] = _seconds(
+        lambda: [manager.archive_partition(partition.name, archive) for partition in partitions]) / len(partitions)
+    results['vacuum_seconds_archived'] = _seconds(vacuum)
+    results['database_mb_archived'] = os.path.getsize(db_path) / 1e6
+    results['archive_mb'] = sum(os.path.getsize(os.path.join(archive, name)) for name in os.listdir(archive)) / 1e6
+    manager.close()
+    manager.pool.close()
+    shutil.rmtree(folder)
+    return results
+
+
+# Times loading every sale into a dataframe from the database and from a snapshot of it, then the full first export
+# against an incremental one that only appends the sales recorded since, results are in seconds
+def bench_snapshots(sales=2000000, new_sales=10000):
+    folder = tempfile.mkdtemp(prefix='store-bench-')
+    db_path = os.path.join(folder, 'bench.db')
+    generate_database(db_path, products=10000, customers=100000, sales=sales)
+    manager = SalesManager(db_path, pool=ConnectionPool(db_path))
+    snapshot = Snapshot(os.path.join(folder, 'snapshot'))
+    results = {
+        'load_sales_seconds_database': _seconds(manager.load_sales),
+        'export_seconds_full': _seconds(lambda: snapshot.export(db_path, manager.pool)),
+        'load_sales_seconds_snapshot': _seconds(lambda: snapshot.load('sales')),
+        'sum_quantity_seconds_snapshot': _seconds(lambda: snapshot.load('sales', ['quantity'])['quantity'].sum()),
+    }
+    manager.add_sales([Sale(i % 10000 + 1, i % 100000 + 1, 1, '2025-01-01') for i in range(new_sales)])
+    results['export_seconds_incremental'] = _seconds(lambda: snapshot.export(db_path, manager.pool))
+    manager.close()
+    manager.pool.close()
+    shutil.rmtree(folder)
+    return results
+
+
+# Runs lanes, each with a connection of its own, that raise one product's price by 1 rounds times, reading it with
+# its version and going again on a ConflictError, and record a sale after each raise. Returns the price updates per
+# second for each number of lanes with the retries, conflicts and lock failures per update, and checks that no
+# raise was lost. The database uses write-ahead logging as lanes in high-throughput mode do
+def bench_contention(lane_counts=(1, 4, 16), rounds=200):
+    results = {}
+    for lanes in lane_counts:
+        db_path = make_database()
+        pools = [ConnectionPool(db_path, size=1, pragmas={'journal_mode': 'WAL'}) for _ in range(lanes)]
+        Product(db_path, pool=pools[0]).update_price(1.0, 1)
+
+        def lane(pool):
+            product, sales = Product(db_path, pool=pool), SalesManager(db_path, pool=pool)
+            for _ in range(rounds):
+                while True:
+                    record, version = product.get_versioned_product(1)
+                    try:
+                        product.update_price(record.price + 1, 1, version=version)
+                        break
+                    except ConflictError:
+                        continue
+                sales.add_sale(Sale(1, 1, 1, '2024-06-01'))
+
+        threads = [threading.Thread(target=lane, args=(pool,)) for pool in pools]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        updates = lanes * rounds
+        if Product(db_path, pool=pools[0]).get_versioned_product(1).record.price != 1.0 + updates:
+            raise AssertionError(f"Price raises were lost with {lanes} lanes")
+        counters = [pool.write_stats.stats() for pool in pools]
+        results[f'updates_per_sec_{lanes}_lanes'] = updates / elapsed
+        for counter in ('retries', 'conflicts', 'lock_failures'):
+            results[f'{counter}_per_update_{lanes}_lanes'] = sum(stats[counter] for stats in counters) / updates
+        for pool in pools:
+            pool.close()
+        shutil.rmtree(os.path.dirname(db_path))
+    return results
+
+
+# Times the end-of-day reports without the charts, which come from a cache once drawn, first one at a time with
+# aggregates summed on a single process and then with reports run side by side and aggregates split across cores
+def bench_reports(sales=2000000):
+    folder = tempfile.mkdtemp(prefix='store-bench-')
+    db_path = os.path.join(folder, 'bench.db')
+    generate_database(db_path, products=10000, customers=100000, sales=sales)
+    reports = [report for report in END_OF_DAY_REPORTS if 'chart' not in report.name]
+    with ReportRunner(db_path, max_workers=1, processes=1, split_rows=sales * 2) as runner:
+        sequential = _seconds(lambda: [runner.run([report]) for report in reports])
+    with ReportRunner(db_path) as runner:
+        runner.run(reports)  # Starts the worker processes so their start-up isn't timed
+        parallel = _seconds(lambda: runner.run(reports))
+    shutil.rmtree(folder)
+    return {'report_pack_seconds_sequential': sequential, 'report_pack_seconds_runner': parallel,
+            'cores': os.cpu_count()}
+
+
+# Returns the seconds one call of a function takes
+def _seconds(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+# The Sale class as it was before it had __slots__, every instance carrying its own __dict__
+class _DictSale:
+    def __init__(self, product_id, customer_id, quantity, date):
+        self.product_id = product_id
+        self.customer_id = customer_id
+        self.quantity = quantity
+        self.date = date
+
+
+# Measures the bytes per sale of holding count sales in memory as each kind of object, the dates are shared
+# strings as they would be when read from the database so only the objects themselves are compared
+# SaleRecord also carries the sale_id the other two don't have, an extra int object for every sale
+def bench_record_memory(count=1000000):
+    dates = [f'2024-04-{day:02d}' for day in range(1, 31)]
+    kinds = {
+        'dict_sale_bytes': lambda i: _DictSale(i % 26, i % 21, i % 15, dates[i % 30]),
+        'slots_sale_bytes': lambda i: Sale(i % 26, i % 21, i % 15, dates[i % 30]),
+        'sale_record_bytes': lambda i: SaleRecord(i, i % 26, i % 21, i % 15, dates[i % 30]),
+    }
+    results = {}
+    for name, make in kinds.items():
+        tracemalloc.start()
+        records = [make(i) for i in range(count)]
+        results[name] = tracemalloc.get_traced_memory()[0] / count
+        tracemalloc.stop()
+        del records
+    return results
+
+
+# Times function, calling it number times per run, over warmup runs that are thrown away and repeat runs that are
+# kept, and returns the seconds per call of the fastest, median and mean runs with their spread
+def time_case(function, warmup=1, repeat=5, number=1):
+    runs = []
+    for run in range(warmup + repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        if run >= warmup:
+            runs.append((time.perf_counter() - start) / number)
+    median = statistics.median(runs)
+    return {
+        'min': min(runs),
+        'median': median,
+        'mean': statistics.fmean(runs),
+        'stdev': statistics.stdev(runs) if len(runs) > 1 else 0.0,
+        'ops_per_sec': 1 / median if median else float('inf'),
+        'repeat': repeat,
+        'number': number,
+    }
+
+
+# Returns (name, function, number) for every hot path of Store.py against a database, reads first so the writes at
+# the end don't change what they read. Lookups run without a cache so they time the database, the cached lookups and
+# charts are timed separately
+def hot_path_cases(db_path, products, customers):
+    product = Product(db_path, cache=LRUCache(maxsize=0))
+    customer = Customer(db_path, cache=LRUCache(maxsize=0))
+    cached_product = Product(db_path)
+    sales = SalesManager(db_path)
+    pool = get_pool(db_path)
+    ids = itertools.cycle(range(1, min(products, customers) + 1))
+
+    def query(sql):
+        def run():
+            with pool.connection() as conn:
+                conn.execute(sql).fetchall()
+        return run
+
+    def render(plot):
+        def run():
+            get_cache(db_path, 'charts').clear()  # Times the query and the render, not the chart cache
+            plot(fmt='png')
+        return run
+
+    sale = Sale(1, 1, 1, '2024-04-20')
+    return [
+        ('get_product', lambda: product.get_product(next(ids) % products + 1), 1000),
+        ('get_product_cached', lambda: cached_product.get_product(1), 10000),
+        ('get_customer', lambda: customer.get_customer(next(ids) % customers + 1), 1000),
+        ('get_products_batch_100', lambda: product.get_products(range(1, min(products, 100) + 1)), 100),
+        ('calculate_total_sales', sales.calculate_total_sales, 1000),
+        ('calculate_total_sales_month',
+         lambda: sales.calculate_total_sales(start='2024-04-01', end='2024-04-30'), 100),
+        ('calculate_total_sales_product', lambda: sales.calculate_total_sales(product_id=1), 100),
+        ('sales_per_product', sales.sales_per_product, 10),
+        ('sales_series_day', sales.sales_series, 100),
+        ('sales_series_week_product', lambda: sales.sales_series('week', product_id=1), 100),
+        ('rolling_sales_28_days', lambda: sales.rolling_sales(28, start='2024-01-01', end='2024-12-31'), 100),
+        ('year_over_year_month', lambda: sales.year_over_year('month', start='2024-01-01', end='2024-12-31'), 100),
+        ('top_products_10', lambda: sales.top_products(10), 1000),
+        ('top_products_10_month', lambda: sales.top_products(10, start='2024-04-01', end='2024-04-30'), 100),
+        ('bottom_customers_10', lambda: sales.bottom_customers(10), 1000),
+        ('revenue_per_day', sales.revenue_per_day, 10),
+        ('average_basket_value', sales.average_basket_value, 10),
+        ('customer_rfm', lambda: customer.rfm(as_of='2024-12-31'), 1),
+        ('customer_segments', lambda: customer.segments(as_of='2024-12-31'), 1),
+        ('query_product_prices', query(PRODUCT_PRICES_QUERY), 10),
+        ('query_sales_by_product', query(SALES_BY_PRODUCT_QUERY), 10),
+        ('query_area_code_distribution', query(AREA_CODE_DISTRIBUTION_QUERY), 10),
+        ('query_sales_over_time', query(SALES_OVER_TIME_QUERY), 10),
+        ('query_sales_by_customer', query(SALES_BY_CUSTOMER_QUERY), 10),
+        ('plot_product_prices', render(product.plot_product_prices), 1),
+        ('plot_sales_by_product', render(product.plot_sales_by_product), 1),
+        ('plot_customer_contact_distribution', render(customer.plot_customer_contact_distribution), 1),
+        ('plot_sales_over_time', render(sales.plot_sales_over_time), 1),
+        ('plot_sales_by_customer', render(sales.plot_sales_by_customer), 1),
+        ('plot_sales_by_product_cached', lambda: product.plot_sales_by_product(fmt='png'), 100),
+        ('load_products', product.load_products, 1),
+        ('load_customers', customer.load_customers, 1),
+        ('load_sales', sales.load_sales, 1),
+        ('add_sale', lambda: sales.add_sale(sale), 100),
+        ('add_sales_1000', lambda: sales.add_sales([sale] * 1000), 1),
+    ]
+
+
+# Generates a dataset of the given size, or copies an existing one, times every hot path on it and returns the
+# results with the settings they were measured under, only the cases whose names contain one of only are timed
+def run_suite(products=1000, customers=10000, sales=100000, seed=0, warmup=1, repeat=5, dataset=None, only=None):
+    folder = tempfile.mkdtemp(prefix='store-bench-')
+    db_path = os.path.join(folder, 'bench.db')
+    try:
+        if dataset is not None:
+            shutil.copy(dataset, db_path)  # Writes go to the copy so the dataset can be reused
+            with sqlite3.connect(db_path) as conn:
+                products = conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+                customers = conn.execute('SELECT COUNT(*) FROM customers').fetchone()[0]
+                sales = conn.execute('SELECT COUNT(*) FROM sales').fetchone()[0]
+            conn.close()
+        else:
+            generate_database(db_path, products=products, customers=customers, sales=sales, seed=seed)
+        results = {}
+        for name, function, number in hot_path_cases(db_path, products, customers):
+            if only is None or any(part in name for part in only):
+                results[name] = time_case(function, warmup, repeat, number)
+        get_pool(db_path).close()
+    finally:
+        shutil.rmtree(folder)
+    return {
+        'settings': {'products': products, 'customers': customers, 'sales': sales, 'seed': seed,
+                     'warmup': warmup, 'repeat': repeat},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'machine': platform.machine(), 'processor': platform.processor()},
+        'results': results,
+    }
+
+
+# Returns (name, baseline seconds, current seconds, change) for every case whose median got slower than its baseline
+# median by more than threshold, 0.1 being 10%, cases missing from either run are left out
+def compare(current, baseline, threshold=0.1):
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None or not before['median']:
+            continue
+        change = result['median'] / before['median'] - 1
+        if change > threshold:
+            regressions.append((name, before['median'], result['median'], change))
+    return regressions
+
+
+# Runs in a fresh interpreter: imports Store, does the CRUD a short-lived worker does and prints what it cost
+_STARTUP_SCRIPT = '''
+import json, resource, sys, time
+start = time.perf_counter()
+for name in sys.argv[2:]:
+    __import__(name)
+import Store
+import_seconds = time.perf_counter() - start
+product_id = Store.Product(sys.argv[1]).add_product("Butter", 2.3)
+Store.Product(sys.argv[1]).get_product(product_id)
+Store.SalesManager(sys.argv[1]).add_sale(Store.Sale(product_id, 1, 1, "2024-04-20"))
+print(json.dumps({
+    "import_seconds": import_seconds,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy_modules": sorted(name for name in ("pandas", "matplotlib", "matplotlib.pyplot") if name in sys.modules),
+}))
+'''
+
+
+# Imports Store in a fresh process after importing the preload modules, adds, gets and sells a product and returns
+# the seconds the import took, the peak memory in MB and which of pandas and matplotlib ended up loaded
+def measure_startup(db_path, preload=()):
+    folder = os.path.dirname(os.path.abspath(__file__))  # Store.py sits next to this file
+    output = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT, db_path, *preload], cwd=folder,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+# Compares a worker starting with the lazy imports against one paying for pandas and pyplot up front the way
+# Store.py used to, the eager import time includes the two libraries
+def bench_startup():
+    db_path = make_database()
+    lean = measure_startup(db_path)
+    eager = measure_startup(db_path, preload=('pandas', 'matplotlib.pyplot'))
+    shutil.rmtree(os.path.dirname(db_path))
+    return {'lean': lean, 'eager': eager}
+
+
+# The unit a comparison result is printed in and its decimal places, found from a part of its name, results naming
+# none of them are in ops/sec
+_RESULT_UNITS = [('_seconds', 'seconds', 3), ('_mb', 'MB', 1), ('cores', 'cores', 0),
+                 ('_per_update_', 'per update', 3)]
+
+
+# Returns the line printing a comparison result in the unit its name gives
+def _format_result(name, value):
+    unit, digits = next(((unit, digits) for part, unit, digits in _RESULT_UNITS if part in name), ('ops/sec', 0))
+    return f"{name:>24}: {value:12.{digits}f} {unit}"
+
+
+# Times every hot path and prints the results, --output saves them as JSON and --baseline exits with an error
+# when any case is slower than a saved run by more than --threshold, --comparisons runs the before and after
+# comparisons of the pool, high-throughput mode, async checkouts, record memory and startup instead
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Store.py hot paths")
+    parser.add_argument('--products', type=int, default=1000, help="Number of products in the generated dataset")
+    parser.add_argument('--customers', type=int, default=10000, help="Number of customers in the generated dataset")
+    parser.add_argument('--sales', type=int, default=100000, help="Number of sales in the generated dataset")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the generated dataset")
+    parser.add_argument('--dataset', help="Existing database to benchmark a copy of instead of generating one")
+    parser.add_argument('--warmup', type=int, default=1, help="Runs of each case thrown away before timing")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs of each case")
+    parser.add_argument('--only', nargs='+', help="Only time the cases whose names contain one of these")
+    parser.add_argument('--output', help="File to save the results to as JSON")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to check for regressions against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Slowdown flagged as a regression, 0.1 is 10%%")
+    parser.add_argument('--comparisons', action='store_true', help="Run the before and after comparisons instead")
+    args = parser.parse_args()
+
+    if args.comparisons:
+        for bench in (bench_connection_pool, bench_high_throughput, bench_async_checkouts, bench_instrumentation,
+                      bench_perishables, bench_revenue, bench_partitions, bench_snapshots,
+                      bench_contention, bench_reports):
+            for name, value in bench().items():
+                print(_format_result(name, value))
+        for name, value in bench_record_memory().items():
+            print(f"{name:>24}: {value:12.1f} bytes/sale")
+        for name, startup in bench_startup().items():
+            print(f"{name + '_import':>24}: {startup['import_seconds']:12.3f} seconds")
+            print(f"{name + '_peak_memory':>24}: {startup['max_rss_mb']:12.1f} MB")
+        raise SystemExit
+
+    report = run_suite(args.products, args.customers, args.sales, args.seed, args.warmup, args.repeat,
+                       args.dataset, args.only)
+    for name, result in report['results'].items():
+        print(f"{name:>36}: {result['median'] * 1e6:12.1f} us/op  {result['ops_per_sec']:12.0f} ops/sec"
+              f"  (+/- {result['stdev'] * 1e6:.1f} us)")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        for name, before, after, change in regressions:
+            print(f"REGRESSION {name}: {before * 1e6:.1f} us -> {after * 1e6:.1f} us ({change:+.0%})")
+        if regressions:
+            raise SystemExit(1)
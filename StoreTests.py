@@ -1,9 +1,52 @@
+import asyncio
+import os
+import shutil
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
 from Store import *
+from ConnectionPool import ConnectionPool, RetryPolicy
+from Cache import LRUCache
+from Instrumentation import Instrumentation, PrometheusSink
+from AsyncStore import AsyncStore
+from StoreBenchmarks import measure_startup, run_suite, compare
+from FillDatabase import generate_database
+from CreateDatabase import create_database, schema_version, LATEST_VERSION, MIGRATIONS
+from Partitions import Partition, partition_of
+from Snapshots import Snapshot
+from Reports import ReportRunner, Report, Aggregate
 
 # Define a constant for the database path to run the tests on
 DB_PATH = 'TESTshop.db'
 
 
+# Gives a test its own copy of the test database so it can write to it freely
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'shop.db')
+    shutil.copy(DB_PATH, path)
+    return path
+
+
+# Gives a test a new database holding a small set of known sales
+@pytest.fixture
+def sales_db(tmp_path):
+    path = str(tmp_path / 'sales.db')
+    Product(path).add_products([("Milk", 2.50), ("Bread", 1.20), ("Eggs", 3.00)])
+    Customer(path).add_customers([("Alex Jones", "2015550100"), ("Kevin Smith", "9735550101")])
+    SalesManager(path).add_sales([
+        Sale(1, 1, 3, "2024-04-01"),
+        Sale(2, 1, 1, "2024-04-01"),
+        Sale(1, 2, 5, "2024-04-02"),
+        Sale(3, 2, 2, "2024-04-15"),
+        Sale(1, 1, 4, "2024-05-01"),
+    ])
+    return path
+
+
 # Tests for the Products class------------------------------------------------------------------------------------------
 
 # Test for the add_product method
@@ -27,27 +70,26 @@ def test_add_product():
 def test_get_product():
     product = Product(DB_PATH)
     prod = product.get_product(1)
-    assert prod._Product__name == "Milk"
-    assert prod._Product__price == 2.5
+    assert prod.name == "Milk"
+    assert prod.price == 2.5
+    assert product.product_id is None  # Reads don't change the manager
 
 
 # Test for the update_product method
 def test_update_product():
     product = Product(DB_PATH)
-    product.get_product(1)
-    product._Product__name = "Updated Milk"
-    product._Product__price = 2.60
-    product.update_product()
+    prod = product.get_product(1)
+    product.update_product(prod._replace(name="Updated Milk", price=2.60))
 
-    assert product._Product__name == "Updated Milk"
-    assert product._Product__price == 2.6
+    updated_prod = product.get_product(1)
+    assert updated_prod.name == "Updated Milk"
+    assert updated_prod.price == 2.6
 
 
 # Test for the delete_product method
 def test_delete_product():
     product = Product(DB_PATH)
-    product.get_product(2)  # Picks the product_id as 2 to delete
-    product.delete_product()
+    product.delete_product(2)  # Picks the product_id as 2 to delete
 
     # Ensure the product was deleted
     with product._Product__connect() as conn:
@@ -59,12 +101,11 @@ def test_delete_product():
 # Test for the update_price method
 def test_update_price():
     product = Product(DB_PATH)
-    product.get_product(3)  # Picks the product_id as 3 to update_price
-    product.update_price(3.45)
+    product.update_price(3.45, product_id=3)  # Picks the product_id as 3 to update_price
 
     # Ensure the price was updated
     updated_prod = product.get_product(3)
-    assert updated_prod._Product__price == 3.45
+    assert updated_prod.price == 3.45
 
 
 # Test for the load_products method
@@ -75,6 +116,67 @@ def test_load_products():
     assert len(df) >= 5
 
 
+# Test for the add_products method
+def test_add_products(db_path):
+    ids = Product(db_path).add_products([("Flour", 1.10), ("Sugar", 0.95), ("Salt", 0.40)], chunk_size=2)
+    assert len(ids) == 3
+
+    # Ensure the returned IDs belong to the products in the order they were given
+    with sqlite3.connect(db_path) as conn:
+        names = [conn.execute('SELECT name FROM products WHERE product_id = ?', (product_id,)).fetchone()[0]
+                 for product_id in ids]
+    assert names == ["Flour", "Sugar", "Salt"]
+
+
+# Test that get_product is served from the cache and update_price invalidates it
+def test_get_product_cache(sales_db):
+    product = Product(sales_db, cache=LRUCache(maxsize=10))
+    product.get_product(1)
+    product.get_product(1)
+    assert product.cache.stats()['hits'] == 1
+
+    product.update_price(2.75, product_id=1)
+    assert Product(sales_db, cache=product.cache).get_product(1).price == 2.75  # Never the stale price
+
+    product.delete_product(1)
+    assert product.get_product(1) is None
+
+
+# Test that every read method returns records
+def test_reads_return_records(sales_db):
+    assert isinstance(Product(sales_db).get_product(1), ProductRecord)
+    assert isinstance(Customer(sales_db).get_customer(1), CustomerRecord)
+    assert next(SalesManager(sales_db).iter_sales(as_frame=False)) == SaleRecord(1, 1, 1, 3, "2024-04-01")
+    assert next(Product(sales_db).iter_products(as_frame=False)) == ProductRecord(1, "Milk", 2.50)
+
+
+# Test for the add_product method returning the new product_id
+def test_add_product_returns_id(sales_db):
+    product_id = Product(sales_db).add_product("Jam", 3.10)
+    assert Product(sales_db).get_product(product_id) == ProductRecord(product_id, "Jam", 3.10)
+
+
+# Test for the get_products method
+def test_get_products(sales_db):
+    product = Product(sales_db, cache=LRUCache())
+    product.get_product(2)  # Already cached, so only 3, 1 and 99 are read from the database
+    lookup = product.get_products([3, 1, 99, 2, 1], chunk_size=2)
+    assert [record and record.name for record in lookup.records] == ["Eggs", "Milk", None, "Bread", "Milk"]
+    assert lookup.missing == [99]
+    assert lookup.records[0] == ProductRecord(3, "Eggs", 3.00)
+    with pytest.raises(AttributeError):
+        lookup.records[0].price = 0  # Records can't be changed
+
+
+# Test for the iter_products method
+def test_iter_products(sales_db):
+    chunks = list(Product(sales_db).iter_products(chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert list(chunks[0].columns) == ['product_id', 'name', 'price']
+    assert list(Product(sales_db).iter_products(columns=['name'], as_frame=False)) == [("Milk",), ("Bread",),
+                                                                                      ("Eggs",)]
+
+
 # Tests for the PerishableProducts class-------------------------------------------------------------------------------
 
 # Test to initialize the perishable_product class
@@ -109,6 +211,49 @@ def test_get_expiry_date():
     assert product.get_expiry_date() == test_date
 
 
+# Test for the to_record method
+def test_perishable_to_record():
+    product = PerishableProduct(DB_PATH, 1, "Seasonal Fruit", 0.99, "2024-04-20")
+    assert product.to_record() == PerishableRecord(1, "Seasonal Fruit", 0.99, "2024-04-20")
+
+
+# Tests for the PerishableInventory class------------------------------------------------------------------------------
+
+# Gives a test the lots of the sales database, as of 10 April 2024 they have -1, 0, 1, 3 and 10 days left
+@pytest.fixture
+def inventory(sales_db):
+    inventory = PerishableInventory(sales_db)
+    inventory.add_lots([(1, 10, "2024-04-09"), (2, 5, "2024-04-10"), (3, 8, "2024-04-11"), (1, 4, "2024-04-13"),
+                        (2, 6, "2024-04-20")])
+    return inventory
+
+
+# Test for the expired and expiring_within methods
+def test_expired_and_expiring_lots(inventory):
+    assert [lot.lot_id for lot in inventory.expired(as_of="2024-04-10")] == [1, 2]
+    assert inventory.expiring_within(3, as_of="2024-04-10") == [LotRecord(3, 3, 8, "2024-04-11"),
+                                                                LotRecord(4, 1, 4, "2024-04-13")]
+
+
+# Test that the batch evaluator agrees with is_expired and the markdowns follow the schedule
+def test_evaluate_expiry_and_markdowns(inventory):
+    report = inventory.evaluate(as_of="2024-04-10", warning_days=3)
+    assert report.days_left.tolist() == [-1, 0, 1, 3, 10]
+    assert report.expired.tolist() == [True, True, False, False, False]
+    assert report.expiring.tolist() == [False, False, True, True, False]
+
+    yesterday = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    products = [PerishableProduct(inventory.db_path, 1, "Milk", 2.5, day) for day in (yesterday, tomorrow)]
+    assert evaluate_expiry([yesterday, tomorrow]).expired.tolist() == [product.is_expired() for product in products]
+    assert products[1].save_lot(2) == 6
+
+    markdowns = inventory.markdowns(as_of="2024-04-10")
+    assert markdowns.lot_id.tolist() == [3, 4]
+    assert markdowns.discount.tolist() == [0.5, 0.3]
+    assert markdowns.price.tolist() == [1.5, 1.75]
+
+
 # Tests for the Customer class------------------------------------------------------------------------------------------
 
 # Test for the add_customer method
@@ -151,9 +296,7 @@ def test_update_customer():
 
     # Update the customer information
     retrieved_customer = customer.get_customer(4)
-    retrieved_customer.name = "Christopher Fox"
-    retrieved_customer.contact = "1239875465"
-    retrieved_customer.update_customer()
+    customer.update_customer(retrieved_customer._replace(name="Christopher Fox", contact="1239875465"))
 
     # Verify customer information was updated properly
     updated_customer = customer.get_customer(4)
@@ -164,15 +307,13 @@ def test_update_customer():
 # Test for the delete_customer method
 def test_delete_customer():
     customer = Customer(DB_PATH)
-    customer.name = "Kevin Smith"
-    customer.contact = "9876543210"
-    customer.add_customer()
-    customer.delete_customer()
+    customer_id = customer.add_customer("Kevin Smith", "9876543210")
+    customer.delete_customer(customer_id)
 
     # Verify the customer was deleted from the database
     with sqlite3.connect(DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM customers WHERE customer_id = ?", (customer.customer_id,))
+        cursor.execute("SELECT * FROM customers WHERE customer_id = ?", (customer_id,))
         result = cursor.fetchone()
         assert result is None
 
@@ -185,6 +326,105 @@ def test_load_customers():
     assert len(df) > 0  # Ensures that the dataframe consists the proper amount of data
 
 
+# Test for the add_customers method
+def test_add_customers(db_path):
+    ids = Customer(db_path).add_customers(iter([("Nina Park", "2015550101"), ("Omar Diaz", "9735550102")]))
+
+    # Ensure both customers were added with the returned IDs
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute('SELECT customer_id, name FROM customers WHERE customer_id >= ? ORDER BY customer_id',
+                            (ids[0],)).fetchall()
+    assert rows == [(ids[0], "Nina Park"), (ids[1], "Omar Diaz")]
+
+
+# Test that get_customer is served from the shared cache and update_customer invalidates it for every manager
+def test_get_customer_cache(sales_db):
+    reader = Customer(sales_db)
+    writer = Customer(sales_db)
+    assert reader.cache is writer.cache  # Managers of the same database share one cache
+    reader.get_customer(2)
+    writer.update_customer(writer.get_customer(2)._replace(contact="9735550199"))
+    assert reader.get_customer(2).contact == "9735550199"
+
+
+# Tests for the LRUCache class
+def test_lru_cache_eviction_and_expiry():
+    now = [0.0]
+    cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')  # Makes 'b' the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+    now[0] = 11.0  # Moves past the time limit
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['evictions'], stats['expirations'], stats['hits']) == (1, 1, 2)
+
+
+# Test that a load racing an invalidation doesn't put the old value back in the cache
+def test_lru_cache_load_racing_invalidation():
+    cache = LRUCache()
+
+    def load(key):
+        cache.invalidate(key)  # A write commits while the old row is being read
+        return 'old'
+
+    assert cache.get_or_load('a', load) == 'old'
+    assert cache.get('a') is None
+
+
+# Test for the get_customers method
+def test_get_customers(sales_db):
+    lookup = Customer(sales_db, cache=LRUCache()).get_customers([2, 5, 1])
+    assert lookup.records == [CustomerRecord(2, "Kevin Smith", "9735550101"), None,
+                              CustomerRecord(1, "Alex Jones", "2015550100")]
+    assert lookup.missing == [5]
+
+
+# Test for the iter_customers method
+def test_iter_customers(sales_db):
+    rows = list(Customer(sales_db).iter_customers(chunk_size=1, after_id=1, as_frame=False))
+    assert rows == [(2, "Kevin Smith", "9735550101")]
+    with pytest.raises(ValueError):
+        list(Customer(sales_db).iter_customers(columns=['name; DROP TABLE customers']))
+
+
+# Test that area codes are normalized when customers are written and counted without 9 digit numbers
+def test_area_code_distribution(sales_db):
+    customer = Customer(sales_db)
+    customer.add_customers([("Sallie Boyer", "987654321"), ("Rita Clark", "(973) 323-8821")])
+    fern = customer.add_customer("Fern Kane", "+1 201-555-0199")
+    assert customer.area_code_distribution().to_dict() == {'201': 2, '973': 2}
+    customer.update_customer(CustomerRecord(fern, "Fern Kane", "8915550199"))
+    assert customer.area_code_distribution().to_dict() == {'973': 2, '201': 1, '891': 1}
+
+
+# Test that the migration fills in the area code of customers recorded before it
+def test_area_code_backfill(tmp_path):
+    db_path = str(tmp_path / 'old.db')
+    with sqlite3.connect(db_path) as conn:
+        for step in MIGRATIONS[0][1]:
+            conn.execute(step)
+        conn.executemany('INSERT INTO customers (name, contact) VALUES (?, ?)',
+                         [("Alex Jones", "1234567890"), ("Kevin Smith", "9876543210")])
+    assert Customer(db_path).area_code_distribution().to_dict() == {'987': 1}
+
+
+# Test for the rfm and segments methods
+def test_rfm(sales_db):
+    customer = Customer(sales_db)
+    rfm = customer.rfm(as_of="2024-05-10")
+    assert rfm['recency'].to_dict() == {1: 9, 2: 25}
+    assert rfm['frequency'].to_dict() == {1: 3, 2: 2}
+    assert rfm['monetary'].round(2).to_dict() == {1: 18.7, 2: 18.5}
+    assert rfm.loc[1, ['r', 'f', 'm']].tolist() == [2, 2, 2]  # Customer 1 bought more recently, often and more
+    assert customer.rfm(as_of="2024-04-01")['frequency'].to_dict() == {1: 2}  # Later sales aren't counted
+    assert customer.segments(as_of="2024-05-10")['customers'].sum() == 2
+
+
 # Tests for the SalesManager class-------------------------------------------------------------------------------------
 
 # Test for the add_sale method
@@ -204,6 +444,45 @@ def test_add_sale():
         assert result[0] == 10
 
 
+# Test for the add_sales method
+def test_add_sales(db_path):
+    manager = SalesManager(db_path)
+    sales = (Sale(1, 1, quantity, "2024-05-01") for quantity in range(1, 8))  # A generator, never held in memory
+    ids = manager.add_sales(sales, chunk_size=3)
+    assert len(ids) == 7
+
+    # Ensure every sale was added with its own quantity
+    with sqlite3.connect(db_path) as conn:
+        quantities = [row[0] for row in conn.execute(
+            'SELECT quantity FROM sales WHERE sale_id BETWEEN ? AND ? ORDER BY sale_id', (ids[0], ids[-1]))]
+    assert quantities == list(range(1, 8))
+
+
+# Test that high-throughput mode switches to write-ahead logging and acknowledges each sale with its sale_id
+def test_add_sale_high_throughput(db_path):
+    manager = SalesManager(db_path, high_throughput=True, batch_size=4, max_delay=0.01)
+    futures = [manager.add_sale(Sale(2, 3, quantity, "2024-05-02")) for quantity in range(1, 11)]
+    ids = [future.result(timeout=5) for future in futures]
+    manager.close()
+
+    # Ensure every acknowledged sale is in the database under the sale_id it was given
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        for sale_id, quantity in zip(ids, range(1, 11)):
+            assert conn.execute('SELECT quantity FROM sales WHERE sale_id = ?', (sale_id,)).fetchone() == (quantity,)
+
+
+# Test that a sale the database rejects only fails its own future
+def test_sales_writer_isolates_failures(db_path):
+    writer = SalesWriter(db_path, max_delay=0.05)
+    good = writer.submit(Sale(1, 1, 2, "2024-05-03"))
+    bad = writer.submit(Sale(1, 1, 2, object()))  # A date sqlite3 can't store
+    writer.flush()
+    writer.close()
+    assert good.result() > 0
+    assert isinstance(bad.exception(), sqlite3.Error)
+
+
 # Test for the load_sales method
 def test_load_sales():
     manager = SalesManager(DB_PATH)
@@ -212,6 +491,15 @@ def test_load_sales():
     assert len(sales_df.index) > 0  # Ensures that the dataframe consists the proper amount of data
 
 
+# Test for the iter_sales method
+def test_iter_sales(sales_db):
+    manager = SalesManager(sales_db)
+    chunks = list(manager.iter_sales(chunk_size=2, columns=['quantity', 'date']))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert sum(chunk['quantity'].sum() for chunk in chunks) == manager.calculate_total_sales()
+    assert [row[0] for row in manager.iter_sales(columns=['sale_id'], after_id=3, as_frame=False)] == [4, 5]
+
+
 # Test for the calculate_total_sales method
 def test_calculate_total_sales():
     manager = SalesManager(DB_PATH)
@@ -225,3 +513,657 @@ def test_sales_per_product():
     sales_summary = manager.sales_per_product()
     assert not sales_summary.empty
     assert sales_summary.iloc[0] > 0  # Ensures the dataframe isn't empty showing that the dataframe is filled with data
+
+
+# Test for the calculate_total_sales filters
+def test_calculate_total_sales_filters(sales_db):
+    manager = SalesManager(sales_db)
+    assert manager.calculate_total_sales() == 15
+    assert manager.calculate_total_sales(start="2024-04-01", end="2024-04-30") == 11
+    assert manager.calculate_total_sales(end=datetime.date(2024, 4, 2)) == 9  # The end date is included
+    assert manager.calculate_total_sales(product_id=1, customer_id=1) == 7
+    assert manager.calculate_total_sales(start="2025-01-01") == 0
+
+
+# Test for the sales_per_product filters
+def test_sales_per_product_filters(sales_db):
+    manager = SalesManager(sales_db)
+    assert manager.sales_per_product().to_dict() == {1: 12, 2: 1, 3: 2}
+    assert manager.sales_per_product(start="2024-04-02", end="2024-04-30").to_dict() == {1: 5, 3: 2}
+    assert manager.sales_per_product(customer_id=2).to_dict() == {1: 5, 3: 2}
+
+
+# Test for the sales_series method
+def test_sales_series(sales_db):
+    manager = SalesManager(sales_db)
+    monthly = manager.sales_series('month')
+    assert monthly.periods.tolist() == [np.datetime64('2024-04'), np.datetime64('2024-05')]
+    assert monthly.quantity.tolist() == [11, 4] and monthly.sale_count.tolist() == [4, 1]
+    weekly = manager.sales_series('week', start="2024-04-01", end="2024-04-14")
+    assert weekly.quantity.tolist() == [9, 0]  # Weeks starting Monday 1 and Monday 8 April
+    by_customer = manager.sales_series(customer_id=1, fill=False)
+    assert by_customer.periods.astype(str).tolist() == ['2024-04-01', '2024-05-01']
+    assert by_customer.quantity.tolist() == [4, 4]
+    with pytest.raises(ValueError):
+        manager.sales_series('fortnight')
+
+
+# Test that sales recorded with a time of day are bucketed on their day
+def test_sales_series_timestamps(sales_db):
+    manager = SalesManager(sales_db)
+    manager.add_sales([Sale(1, 1, 2, "2024-05-02 10:00"), Sale(2, 2, 3, "2024-05-02 15:30:00")])
+    daily = manager.sales_series(start="2024-05-01", end="2024-05-02")
+    assert daily.periods.astype(str).tolist() == ['2024-05-01', '2024-05-02']
+    assert daily.quantity.tolist() == [4, 5] and daily.sale_count.tolist() == [1, 2]
+
+
+# Test for the rolling_sales and year_over_year methods
+def test_rolling_and_year_over_year(sales_db):
+    manager = SalesManager(sales_db)
+    rolling = manager.rolling_sales(2, start="2024-04-02", end="2024-04-03")
+    assert rolling.quantity.tolist() == [5, 0]
+    assert rolling.mean.tolist() == [4.5, 2.5]  # The window of 2 April reaches back to 1 April
+
+    manager.add_sale(Sale(1, 1, 2, "2023-04-10"))
+    yearly = manager.year_over_year('month', start="2024-04-01", end="2024-05-31")
+    assert yearly.quantity.tolist() == [11, 4]
+    assert yearly.previous.tolist() == [2, 0]
+    assert yearly.change[0] == 4.5 and np.isnan(yearly.change[1])
+
+
+# Test that revenue is kept at the prices sales were made at and margins and baskets are summed from the sales
+def test_revenue_snapshots(sales_db):
+    manager = SalesManager(sales_db)
+    product = Product(sales_db)
+    assert manager.calculate_revenue() == pytest.approx(37.2)
+    product.update_price(10.00, product_id=1)
+    assert manager.calculate_revenue() == pytest.approx(37.2)  # Past sales keep the price they were made at
+    product.update_cost(1.00, product_id=1)
+    manager.add_sales([Sale(1, 1, 2, "2024-05-02"), Sale(2, 1, 1, "2024-05-02", unit_price=0.99)])
+    assert manager.calculate_revenue(start="2024-05-02") == pytest.approx(20.99)
+    assert manager.calculate_margin() == pytest.approx(Margin(20, 2, 18, 0.9))  # Only the sale with a known cost
+    assert manager.revenue_per_day(end="2024-04-02").round(2).to_dict() == {"2024-04-01": 8.7, "2024-04-02": 12.5}
+    assert manager.average_basket_value(end="2024-04-30") == pytest.approx((8.7 + 12.5 + 6) / 3)
+    assert manager.average_basket_value(start="2025-01-01") == 0
+
+
+# Test that the migration prices the sales recorded before it at their product's price
+def test_price_backfill(tmp_path):
+    db_path = str(tmp_path / 'old.db')
+    with sqlite3.connect(db_path) as conn:
+        for step in MIGRATIONS[0][1]:
+            conn.execute(step)
+        conn.execute("INSERT INTO products (name, price) VALUES ('Milk', 2.5)")
+        conn.execute("INSERT INTO sales (product_id, customer_id, quantity, date) VALUES (1, 1, 4, '2024-04-01')")
+    assert SalesManager(db_path).calculate_revenue() == 10
+
+
+# Test for the top and bottom products and customers, all-time and within a date window
+def test_top_and_bottom(sales_db):
+    manager = SalesManager(sales_db)
+    assert manager.top_products(2) == [Ranking(1, 'Milk', 12, 3), Ranking(3, 'Eggs', 2, 1)]
+    assert manager.bottom_products(2) == [Ranking(2, 'Bread', 1, 1), Ranking(3, 'Eggs', 2, 1)]
+    assert [ranking.id for ranking in manager.top_products(start="2024-04-01", end="2024-04-30")] == [1, 3, 2]
+    assert manager.top_customers() == [Ranking(1, 'Alex Jones', 8, 3), Ranking(2, 'Kevin Smith', 7, 2)]
+    assert manager.top_customers(start="2024-04-02") == [Ranking(2, 'Kevin Smith', 7, 2),
+                                                         Ranking(1, 'Alex Jones', 4, 1)]
+    with sqlite3.connect(sales_db) as conn:
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN SELECT product_id, quantity FROM '
+                                               'sales_product_totals ORDER BY quantity DESC, product_id LIMIT 5')]
+    assert any('COVERING INDEX idx_product_totals_rank' in step for step in plan)
+    assert not any('TEMP B-TREE' in step for step in plan)
+    assert manager.check_rollups() == []
+    with pytest.raises(ValueError):
+        manager.top_products(0)
+
+
+# Test that a leaderboard starts from the day's sales and follows the sales recorded afterwards
+def test_leaderboard(sales_db):
+    manager = SalesManager(sales_db)
+    board = manager.leaderboard(k=2, date="2024-04-01")
+    assert board.top() == [Ranking(1, None, 3, 1), Ranking(2, None, 1, 1)]
+    manager.add_sale(Sale(3, 1, 2, "2024-04-01"))
+    manager.add_sales([Sale(2, 2, 5, "2024-04-01"), Sale(1, 2, 9, "2024-03-31")])  # The earlier day isn't counted
+    assert [(ranking.id, ranking.quantity) for ranking in board.top()] == [(2, 6), (1, 3)]
+    manager.add_sale(Sale(1, 1, 1, "2024-04-02"))
+    assert board.date == "2024-04-02" and board.top() == [Ranking(1, None, 1, 1)]
+
+
+# Test the leaderboard against recounting every total after each sale, returns included
+def test_leaderboard_matches_recount():
+    rng = np.random.default_rng(7)
+    board = Leaderboard(k=5, date="2024-04-01")
+    totals = {}
+    for key, quantity in zip(rng.integers(1, 40, 2000).tolist(), rng.integers(-2, 10, 2000).tolist()):
+        board.add(key, quantity)
+        totals[key] = totals.get(key, 0) + quantity
+        expected = sorted(((-total, key) for key, total in totals.items() if total > 0))[:5]
+        assert [(ranking.id, ranking.quantity) for ranking in board.top()] == [(key, -total) for total, key in expected]
+
+
+# Test the partition each period puts a date in
+def test_partition_of():
+    assert partition_of("2024-04-15") == Partition("sales_2024_04", "2024-04-01", "2024-05-01", None)
+    assert partition_of("2024-12-31 23:00", "month").end == "2025-01-01"
+    assert partition_of("2024-11-02", "quarter") == Partition("sales_2024_q4", "2024-10-01", "2025-01-01", None)
+    assert partition_of("2024-04-15", "year") == Partition("sales_2024", "2024-01-01", "2025-01-01", None)
+    with pytest.raises(ValueError):
+        partition_of("2024-04-15", "week")
+
+
+# Test that splitting sales into partitions leaves every read, aggregate and rollup unchanged, that reads only touch
+# the partitions their dates overlap and that new sales keep getting new IDs
+def test_split_partitions(sales_db):
+    manager = SalesManager(sales_db)
+    before = (manager.load_sales(), manager.calculate_total_sales(), manager.calculate_revenue(),
+              manager.average_basket_value("2024-04-01", "2024-04-30"), manager.sales_per_product(customer_id=2))
+    assert manager.split_partitions("2024-05-01") == 4
+    assert manager.list_partitions() == [Partition("sales_2024_04", "2024-04-01", "2024-05-01", None)]
+    after = (manager.load_sales(), manager.calculate_total_sales(), manager.calculate_revenue(),
+             manager.average_basket_value("2024-04-01", "2024-04-30"), manager.sales_per_product(customer_id=2))
+    pd.testing.assert_frame_equal(after[0], before[0])
+    assert after[1:4] == before[1:4]
+    pd.testing.assert_series_equal(after[4], before[4])
+    assert [record.sale_id for record in manager.iter_sales(chunk_size=2, as_frame=False)] == [1, 2, 3, 4, 5]
+    assert manager.check_rollups() == []
+    assert list(Customer(sales_db).rfm("2024-05-01")["frequency"]) == [3, 2]
+
+    with manager._SalesManager__connect("2024-05-01", "2024-05-31") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sales").fetchone()[0] == 1  # April isn't read
+    with manager._SalesManager__connect("2024-04-30") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sales").fetchone()[0] == 5
+
+    assert manager.add_sale(Sale(2, 2, 1, "2024-04-20")) == 6
+    assert manager.calculate_revenue("2024-04-01", "2024-04-30") == pytest.approx(28.4)
+    assert manager.split_partitions("2024-05-01") == 0  # The sale with the highest ID stays behind
+
+
+# Test that an archived partition leaves the database and the totals, and comes back with them when restored
+def test_archive_partition(sales_db, tmp_path):
+    manager = SalesManager(sales_db, partition_by="quarter")
+    manager.split_partitions("2024-07-01")
+    assert [partition.name for partition in manager.list_partitions()] == ["sales_2024_q2"]
+    manager.add_sale(Sale(1, 1, 2, "2024-07-01"))
+
+    path = manager.archive_partition("sales_2024_q2", str(tmp_path / "archive"))
+    assert path.endswith("sales_2024_q2.db.gz") and os.path.exists(path)
+    assert manager.list_partitions()[0].archive == path
+    assert manager.calculate_total_sales() == 6 and len(manager.load_sales()) == 2  # Sale 5 stayed behind
+    assert manager.check_rollups() == []
+    with pytest.raises(ValueError):
+        manager.archive_partition("sales_2024_q2")
+
+    assert manager.restore_partition("sales_2024_q2") == 4
+    assert not os.path.exists(path) and manager.list_partitions()[0].archive is None
+    assert manager.calculate_total_sales() == 17 and len(manager.load_sales()) == 6
+    assert manager.check_rollups() == []
+
+
+# Tests for the ConnectionPool class------------------------------------------------------------------------------------
+
+# Test that the managers of one database share a single pool
+def test_pool_is_shared():
+    assert Product(DB_PATH).pool is Customer(DB_PATH).pool
+    assert Customer(DB_PATH).pool is SalesManager(DB_PATH).pool
+
+
+# Test that a connection handed back to the pool is reused by the next caller
+def test_pool_reuses_connections(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    pool.close()
+
+
+# Test that a broken connection is replaced by a working one
+def test_pool_recovers_from_broken_connection(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1)
+    with pytest.raises(sqlite3.ProgrammingError):
+        with pool.connection() as conn:
+            conn.close()  # Breaks the connection while it is checked out
+            conn.execute('SELECT 1')
+    with pool.connection() as conn:
+        assert conn.execute('SELECT 1').fetchone() == (1,)
+    pool.close()
+
+
+# Test that the pool doesn't open more connections than its size
+def test_pool_size_limit(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(TimeoutError):
+            with pool.connection():
+                pass
+    pool.close()
+
+
+# Test that thread mode pins a separate connection to each thread
+def test_pool_thread_mode(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=2, mode='thread')
+    barrier = threading.Barrier(2)
+    seen = {}
+
+    def worker():
+        barrier.wait()  # Both threads ask for their connections at the same time
+        with pool.connection() as first:
+            barrier.wait()  # Both hold a connection before either asks again
+            with pool.connection() as second:
+                seen[threading.get_ident()] = (first, second)
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(seen) == 2
+    assert all(first is second for first, second in seen.values())  # A thread always gets its own connection back
+    (first, _), (other, _) = seen.values()
+    assert first is not other  # Each thread has a connection of its own
+    pool.close()
+
+
+# Test that a read-only pool reads the database but refuses every write
+def test_pool_read_only(db_path):
+    pool = ConnectionPool(db_path, size=1, read_only=True)
+    with pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM products').fetchone()[0] > 0
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO products (name, price) VALUES ('Tea', 1.0)")
+    pool.close()
+
+
+# Tests for the CreateDatabase migrations-------------------------------------------------------------------------------
+
+# Test that a new database is created at the latest schema version
+def test_create_database(tmp_path):
+    path = str(tmp_path / 'new.db')
+    assert create_database(path) == LATEST_VERSION
+    assert create_database(path) == LATEST_VERSION  # Running it again changes nothing
+
+
+# Test that an existing database is migrated in place without losing its data
+def test_migrate_existing_database(tmp_path):
+    db_path = str(tmp_path / 'old.db')
+    with sqlite3.connect(db_path) as conn:
+        for step in MIGRATIONS[0][1]:
+            conn.execute(step)  # Builds the tables the way the database looked before the migrations existed
+        conn.execute("INSERT INTO sales (product_id, customer_id, quantity, date) VALUES (1, 1, 4, '2024-04-01')")
+        assert schema_version(conn) == 0
+        sales_before = conn.execute('SELECT COUNT(*) FROM sales').fetchone()[0]
+
+    SalesManager(db_path)  # The managers migrate the database the first time they use it
+
+    with sqlite3.connect(db_path) as conn:
+        assert schema_version(conn) == LATEST_VERSION
+        assert conn.execute('SELECT COUNT(*) FROM sales').fetchone()[0] == sales_before
+
+
+# Test that the sales reports are served from the rollups and their covering indexes, never the sales table
+@pytest.mark.parametrize('query, expected', [
+    (SALES_BY_PRODUCT_QUERY, 'COVERING INDEX idx_daily_product_product'),
+    (SALES_BY_CUSTOMER_QUERY, 'COVERING INDEX idx_daily_customer_customer'),
+    (SALES_OVER_TIME_QUERY, 'SCAN sales_daily_product'),
+    (AREA_CODE_DISTRIBUTION_QUERY, 'COVERING INDEX idx_customers_area_code'),
+])
+def test_sales_queries_use_indexes(db_path, query, expected):
+    create_database(db_path)
+    with sqlite3.connect(db_path) as conn:
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query)]
+    assert any(expected in step for step in plan)
+    assert not any(step.startswith(('SCAN sales ', 'SEARCH sales ')) or step == 'SCAN sales' for step in plan)
+    assert 'USE TEMP B-TREE FOR GROUP BY' not in plan
+
+
+# Test that the rollups follow every way of writing sales
+def test_rollups_stay_consistent(sales_db):
+    manager = SalesManager(sales_db)
+    manager.add_sale(Sale(2, 2, 6, "2024-04-02"))
+    manager.add_sales([Sale(3, 1, 1, "2024-05-01"), Sale(1, 2, 2, "2024-05-02")])
+    with sqlite3.connect(sales_db) as conn:
+        conn.execute("UPDATE sales SET quantity = 9, date = '2024-03-31' WHERE sale_id = 1")
+        conn.execute('DELETE FROM sales WHERE sale_id = 2')
+    assert manager.check_rollups() == []
+    assert manager.calculate_total_sales() == 29
+    assert manager.calculate_total_sales(start="2024-04-01", end="2024-04-30") == 13
+
+
+# Test that rebuild_rollups repairs rollups that drifted from the sales table
+def test_rebuild_rollups(sales_db):
+    manager = SalesManager(sales_db)
+    with sqlite3.connect(sales_db) as conn:
+        conn.execute('UPDATE sales_totals SET quantity = 0')
+        conn.execute('DELETE FROM sales_daily_customer')
+    assert len(manager.check_rollups()) > 0
+    manager.rebuild_rollups()
+    assert manager.check_rollups() == []
+    assert manager.calculate_total_sales() == 15
+
+
+# Tests for the AsyncStore class----------------------------------------------------------------------------------------
+
+# Test the async managers against the same database as the sync ones
+def test_async_store(sales_db):
+    async def checkout():
+        async with AsyncStore(sales_db, max_pending=4) as store:
+            basket = await store.products.get_products([1, 3])
+            sale_ids = await asyncio.gather(*(store.sales.add_sale(Sale(record.product_id, 2, 1, "2024-05-03"))
+                                              for record in basket.records))
+            customer = await store.customers.get_customer(2)
+            total = await store.sales.calculate_total_sales(customer_id=2)
+        return sale_ids, customer, total
+
+    sale_ids, customer, total = asyncio.run(checkout())
+    assert len(set(sale_ids)) == 2
+    assert customer.name == "Kevin Smith"
+    assert total == 9
+
+
+# Test that an operation waiting for room under max_pending can be cancelled before it ever runs
+def test_async_store_cancellation(sales_db):
+    started = []
+
+    def slow_read():
+        started.append('slow')
+        time.sleep(0.1)
+
+    def never_read():
+        started.append('never')
+
+    async def run():
+        store = AsyncStore(sales_db, max_pending=1)
+        first = asyncio.create_task(store._read(slow_read))
+        second = asyncio.create_task(store._read(never_read))  # Waits behind the first one
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await first
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        await store.close()
+
+    asyncio.run(run())
+    assert started == ['slow']
+
+
+# Test that sales queued for a group commit count against max_pending until they are committed
+def test_async_add_sale_backpressure(sales_db):
+    queued = []
+
+    def queue_sale(sale):  # Stands in for the sales writer, the sales wait until the test commits them
+        future = Future()
+        queued.append(future)
+        return future
+
+    async def run():
+        async with AsyncStore(sales_db, max_pending=3, high_throughput=True) as store:
+            store.sales.manager.add_sale = queue_sale
+            checkouts = [asyncio.create_task(store.sales.add_sale(Sale(1, 1, 1, "2024-05-03"))) for _ in range(10)]
+            await asyncio.sleep(0.05)
+            assert len(queued) == 3  # The others wait even though the queued sales handed their threads back
+            while not all(checkout.done() for checkout in checkouts):
+                assert sum(not future.done() for future in queued) <= 3
+                for future in queued:
+                    if not future.done():
+                        future.set_result(len(queued))
+                await asyncio.sleep(0.01)
+            return [checkout.result() for checkout in checkouts]
+
+    assert len(asyncio.run(run())) == 10
+
+
+# Tests for the chart rendering-----------------------------------------------------------------------------------------
+
+# Test that every plot method renders headless PNG and SVG bytes
+@pytest.mark.parametrize('fmt, signature', [('png', b'\x89PNG'), ('svg', b'<svg')])
+def test_plots_render_bytes(sales_db, fmt, signature):
+    charts = [
+        Product(sales_db).plot_product_prices(fmt=fmt),
+        Product(sales_db).plot_sales_by_product(fmt=fmt),
+        Customer(sales_db).plot_customer_contact_distribution(fmt=fmt),
+        SalesManager(sales_db).plot_sales_over_time(fmt=fmt),
+        SalesManager(sales_db).plot_sales_by_customer(fmt=fmt),
+    ]
+    assert all(signature in chart[:200] for chart in charts)
+
+
+# Test that a rendered chart is served from the cache until a write changes its data
+def test_plot_cache_follows_data_version(sales_db):
+    product = Product(sales_db)
+    sales = SalesManager(sales_db)
+    first = product.plot_sales_by_product(fmt='png')
+    assert product.plot_sales_by_product(fmt='png') is first  # Neither the query nor the render ran again
+    sales.add_sale(Sale(2, 2, 6, "2024-04-02"))
+    second = product.plot_sales_by_product(fmt='png')
+    assert second is not first
+    Customer(sales_db).add_customer("Sam Lee", "2015550102")  # Customers aren't drawn on this chart
+    assert product.plot_sales_by_product(fmt='png') is second
+    with pytest.raises(ValueError):
+        product.plot_sales_by_product(fmt='jpg')
+
+
+# Test that importing Store and doing CRUD in a fresh process never loads pandas or matplotlib
+def test_lean_startup(db_path):
+    assert measure_startup(db_path)['heavy_modules'] == []
+
+
+# Tests for the synthetic data generator--------------------------------------------------------------------------------
+
+# Test that the same seed generates the same dataset whatever the batch size, with rollups and indexes rebuilt
+def test_generate_database(tmp_path):
+    first, second = str(tmp_path / 'first.db'), str(tmp_path / 'second.db')
+    assert generate_database(first, products=50, customers=200, sales=5000, seed=7, batch_size=700) == 5000
+    generate_database(second, products=50, customers=200, sales=5000, seed=7)
+    with sqlite3.connect(first) as conn, sqlite3.connect(second) as other:
+        query = 'SELECT * FROM sales ORDER BY sale_id'
+        assert conn.execute(query).fetchall() == other.execute(query).fetchall()
+        indexes = conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'idx_sales_date_revenue'"
+                               ).fetchone()[0]
+        assert indexes == 1
+    manager = SalesManager(first)
+    assert manager.check_rollups() == []
+    assert len(Customer(first).load_customers()) == 200
+
+
+# Tests for the benchmark harness---------------------------------------------------------------------------------------
+
+# Test that the suite times the chosen hot paths on a generated dataset and flags a slowdown against a baseline
+def test_benchmark_suite():
+    report = run_suite(products=20, customers=50, sales=500, warmup=0, repeat=2, only=['get_customer', 'total_sales'])
+    assert set(report['results']) == {'get_customer', 'calculate_total_sales', 'calculate_total_sales_month',
+                                      'calculate_total_sales_product'}
+    assert all(result['median'] > 0 for result in report['results'].values())
+    assert compare(report, report) == []
+
+    slower = {'results': {name: dict(result, median=result['median'] * 2)
+                          for name, result in report['results'].items()}}
+    assert [name for name, *_ in compare(slower, report, threshold=0.5)] == list(report['results'])
+
+
+# Tests for the instrumentation-----------------------------------------------------------------------------------------
+
+# Test that an instrumented pool times statements, fetches, checkouts and commits and captures slow query plans
+def test_instrumentation(sales_db):
+    pool = ConnectionPool(sales_db)
+    sink = PrometheusSink()
+    pool.instrument(Instrumentation([sink], slow_query_seconds=0))  # Every statement counts as slow
+    Product(sales_db, pool=pool, cache=LRUCache(maxsize=0)).get_product(2)
+    SalesManager(sales_db, pool=pool).add_sale(Sale(1, 1, 2, "2024-05-02"))
+
+    stats = sink.stats()
+    lookup = stats['statements']['SELECT product_id, name, price FROM products WHERE product_id = ?']
+    assert lookup['count'] == 1 and lookup['rows'] == 1 and lookup['fetch']['count'] == 1
+    assert stats['statements'][INSERT_SALE]['rows'] == 1
+    assert stats['acquire']['count'] >= 2 and stats['commit']['count'] >= 2
+    plans = {event.statement: event.plan for event in stats['slow_queries']}
+    assert plans['SELECT product_id, name, price FROM products WHERE product_id = ?'] == [
+        'SEARCH products USING INTEGER PRIMARY KEY (rowid=?)']
+    assert 'store_sql_execute_seconds_bucket{statement="SELECT product_id' in sink.dump()
+
+    pool.instrument(None)  # Back to plain connections
+    with pool.connection() as conn:
+        assert type(conn) is sqlite3.Connection
+    pool.close()
+
+
+# Tests for the Snapshot class------------------------------------------------------------------------------------------
+
+# Test that a snapshot loads the same tables as the database, with numbers and dates mapped from its files
+def test_snapshot_export(sales_db, tmp_path):
+    snapshot = Snapshot(str(tmp_path / "snapshot"))
+    assert snapshot.export(sales_db, chunk_size=2) == {"sales": 5, "products": 3, "customers": 2}
+    sales = snapshot.load("sales")
+    expected = SalesManager(sales_db).load_sales()
+    assert sales["sale_id"].tolist() == expected["sale_id"].tolist()
+    assert sales["quantity"].tolist() == expected["quantity"].tolist()
+    assert str(sales["date"].dtype) == "datetime64[s]" and str(sales["date"].iloc[0])[:10] == "2024-04-01"
+    array = sales["quantity"].to_numpy()
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    assert isinstance(array, np.memmap)  # Not copied out of the file
+    assert snapshot.load("products")["name"].tolist() == ["Milk", "Bread", "Eggs"]
+    assert snapshot.load("customers", ["contact"]).columns.tolist() == ["contact"]
+    with pytest.raises(ValueError):
+        snapshot.load("customers", ["email"])
+
+
+# Test that later exports only append the new sales and rewrite products and customers once they change
+def test_snapshot_is_incremental(sales_db, tmp_path):
+    snapshot = Snapshot(str(tmp_path / "snapshot"))
+    snapshot.export(sales_db)
+    assert snapshot.export(sales_db) == {"sales": 0, "products": 0, "customers": 0}
+    SalesManager(sales_db).add_sale(Sale(3, 2, 7, "2024-05-01 18:20"))
+    Product(sales_db).add_product("Tea", None)
+    assert snapshot.export(sales_db) == {"sales": 1, "products": 4, "customers": 0}
+    assert snapshot.rows("sales") == 6 and snapshot.load("sales")["quantity"].iloc[-1] == 7
+    assert snapshot.load("sales")["date"].iloc[-1] == pd.Timestamp("2024-05-01 18:20")  # Keeps the time of day
+    assert snapshot.load("products")["price"].isna().tolist() == [False, False, False, True]
+
+
+# Tests for the ReportRunner class--------------------------------------------------------------------------------------
+
+# Test that a pack of reports returns each method's result by name and refuses reports that can't run
+def test_report_runner(sales_db):
+    reports = [Report("total", "sales", "calculate_total_sales"),
+               Report("products", "products", "load_products"),
+               Report("april", "sales", "calculate_total_sales", {"start": "2024-04-01", "end": "2024-04-30"}),
+               Aggregate("per_product", "product_id", ("quantity", "line_total"))]
+    with ReportRunner(sales_db) as runner:
+        results = runner.run(reports)
+        assert list(results) == ["total", "products", "april", "per_product"]
+        assert results["total"] == 15 and results["april"] == 11 and len(results["products"]) == 3
+        assert results["per_product"]["quantity"].to_dict() == {1: 12, 2: 1, 3: 2}
+        with pytest.raises(ValueError):
+            runner.run([Report("chart", "sales", "plot_sales_over_time")])  # Would open a window
+        with pytest.raises(sqlite3.OperationalError):
+            runner.run([Report("write", "sales", "add_sale", {"sale": Sale(1, 1, 1, "2024-05-01")})])
+
+
+# Test that an aggregate split across processes adds up to the same totals as the database
+def test_report_runner_splits_aggregates(sales_db):
+    manager = SalesManager(sales_db)
+    manager.add_sale(Sale(2, 2, 6, "2024-04-03 18:45"))  # Made during the end date
+    manager.split_partitions("2024-04-03")
+    with ReportRunner(sales_db, processes=2, split_rows=2) as runner:
+        totals = runner.aggregate(Aggregate("totals", None, ("quantity", "line_total")))
+        assert totals["quantity"] == manager.calculate_total_sales() and totals["sale_count"] == 6
+        assert totals["line_total"] == pytest.approx(manager.calculate_revenue())
+        per_day = runner.aggregate(Aggregate("per_day", "date", start="2024-04-02", end="2024-04-03"))
+        assert per_day["quantity"].sum() == manager.calculate_total_sales("2024-04-02", "2024-04-03") == 11
+
+
+# Tests for lock contention and optimistic updates----------------------------------------------------------------------
+
+# Test that an update given the version it read is refused once someone else has updated the row
+def test_update_product_version_conflict(db_path):
+    product = Product(db_path, pool=ConnectionPool(db_path), cache=LRUCache(maxsize=0))
+    record, version = product.get_versioned_product(1)
+    assert product.update_price(9.99, 1, version=version) == version + 1
+    with pytest.raises(ConflictError):
+        product.update_product(record._replace(name="Stale Milk"), version=version)
+    assert product.get_product(1).price == 9.99 and product.pool.write_stats.conflicts == 1
+    assert product.update_product(record._replace(name="Milk")) == version + 2  # No version, the last update wins
+    assert product.update_price(1.0, 999) is None  # Nothing to update
+    with pytest.raises(ConflictError):
+        product.update_price(1.0, 999, version=0)  # Deleted since it was read
+
+
+# Test that a customer update checks the version the same way and keeps the area code in step with the contact
+def test_update_customer_version_conflict(db_path):
+    customer = Customer(db_path, pool=ConnectionPool(db_path))
+    record, version = customer.get_versioned_customer(1)
+    assert customer.update_customer(record._replace(contact="9735550123"), version) == version + 1
+    with pytest.raises(ConflictError):
+        customer.update_customer(record._replace(name="Someone Else"), version)
+    assert customer.get_customer(1).contact == "9735550123"
+
+
+# Test that a write waits out another connection's lock by retrying instead of failing
+def test_write_retries_while_locked(db_path):
+    pool = ConnectionPool(db_path, busy_timeout=0.01, retry=RetryPolicy(attempts=50, base_delay=0.01, max_delay=0.05))
+    product = Product(db_path, pool=pool)  # Brings the database up to date before it is locked
+    blocker = sqlite3.connect(db_path, check_same_thread=False)
+    blocker.execute("BEGIN IMMEDIATE")  # Holds the write lock like a lane in the middle of a sale
+    release = threading.Timer(0.2, blocker.commit)
+    release.start()
+    assert product.add_product("Tea", 1.50) > 0
+    release.join()
+    blocker.close()
+    assert pool.write_stats.retries > 0 and pool.write_stats.lock_failures == 0
+    pool.close()
+
+
+# Test that a write gives up with the locked error once the retry policy runs out, and the pool stays usable
+def test_write_gives_up_when_locked(db_path):
+    pool = ConnectionPool(db_path, size=1, busy_timeout=0.01, retry=RetryPolicy(2, 0.001, 0.001))
+    product = Product(db_path, pool=pool)
+    blocker = sqlite3.connect(db_path)
+    blocker.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        product.add_product("Tea", 1.50)
+    blocker.rollback()
+    blocker.close()
+    assert pool.write_stats.stats() == {"retries": 1, "lock_failures": 1, "conflicts": 0}
+    assert product.add_product("Tea", 1.50) > 0
+    pool.close()
+
+
+# Stress test: lanes with their own connections raise one price by read, check and retry while recording sales, and
+# every increment and sale has to make it into the database
+def test_concurrent_updates_lose_nothing(db_path):
+    lanes, rounds = 6, 20
+    Product(db_path).update_price(1.0, 1)
+    # Write-ahead logging as in high-throughput mode, so only the writers contend and the short busy timeout makes
+    # them fall back on the retries
+    pools = [ConnectionPool(db_path, size=1, busy_timeout=0.05, pragmas={"journal_mode": "WAL"}) for _ in range(lanes)]
+    before = SalesManager(db_path).calculate_total_sales()
+    errors = []
+
+    def lane(pool):
+        try:
+            run_lane(Product(db_path, pool=pool), SalesManager(db_path, pool=pool))
+        except Exception as error:
+            errors.append(error)
+
+    def run_lane(product, sales):
+        for _ in range(rounds):
+            while True:
+                record, version = product.get_versioned_product(1)
+                try:
+                    product.update_price(record.price + 1, 1, version=version)
+                    break
+                except ConflictError:
+                    continue  # Someone else raised it first, read their price and go again
+            sales.add_sale(Sale(1, 1, 1, "2024-06-01"))
+
+    threads = [threading.Thread(target=lane, args=(pool,)) for pool in pools]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert Product(db_path).get_versioned_product(1).record.price == 1.0 + lanes * rounds
+    assert SalesManager(db_path).calculate_total_sales() == before + lanes * rounds
+    assert sum(pool.write_stats.lock_failures for pool in pools) == 0
+    for pool in pools:
+        pool.close()